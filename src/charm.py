@@ -5,14 +5,18 @@
 """SlurmctldCharm."""
 
 import copy
+import hashlib
+import json
 import logging
 import shlex
 import subprocess
+import tarfile
+import time
 from pathlib import Path
 from typing import List
 
 from charms.fluentbit.v0.fluentbit import FluentbitClient
-from etcd_ops import EtcdOps
+from etcd_ops import EtcdOps, EtcdOpsError
 from interface_elasticsearch import Elasticsearch
 from interface_grafana_source import GrafanaSource
 from interface_influxdb import InfluxDB, generate_password
@@ -21,11 +25,15 @@ from interface_slurmctld_peer import SlurmctldPeer
 from interface_slurmd import Slurmd
 from interface_slurmdbd import Slurmdbd
 from interface_slurmrestd import Slurmrestd
+from metrics_ops import MetricsOps
 from ops.charm import CharmBase, LeaderElectedEvent
 from ops.framework import StoredState
 from ops.main import main
 from ops.model import ActiveStatus, BlockedStatus, ModelError, WaitingStatus
 from slurm_ops_manager import SlurmManager
+from slurmctld_ops import SlurmctldOps, SlurmctldOpsError, strip_slurmctld_parameters
+from state_sync_ops import StateSyncOps
+from systemd_ops import atomic_write
 
 logger = logging.getLogger()
 
@@ -41,6 +49,7 @@ class SlurmctldCharm(CharmBase):
 
         self._stored.set_default(
             jwt_key=str(),
+            jwt_rsa=str(),
             munge_key=str(),
             slurm_installed=False,
             slurmd_available=False,
@@ -48,10 +57,20 @@ class SlurmctldCharm(CharmBase):
             slurmdbd_available=False,
             down_nodes=[],
             etcd_configured=False,
+            etcd_resource_digest=str(),
+            etcd_binaries_digest={},
+            etcd_tls_fingerprint=str(),
+            etcd_jwt_key=str(),
+            etcd_last_maintenance=0.0,
             etcd_root_pass=str(),
             etcd_slurmd_pass=str(),
+            etcd_initial_cluster=str(),
+            etcd_initial_cluster_state="new",
+            etcd_cluster_id=str(),
             use_tls=False,
             use_tls_ca=False,
+            state_sync_secret=str(),
+            standby_config_digest=str(),
         )
 
         self._slurm_manager = SlurmManager(self, "slurmctld")
@@ -68,12 +87,15 @@ class SlurmctldCharm(CharmBase):
         self._fluentbit = FluentbitClient(self, "fluentbit")
 
         self._etcd = EtcdOps(self)
+        self._state_sync = StateSyncOps(self)
+        self._metrics = MetricsOps(self)
+        self._slurmctld_ops = SlurmctldOps(self)
 
         event_handler_bindings = {
             self.on.install: self._on_install,
             self.on.upgrade_charm: self._on_upgrade,
             self.on.update_status: self._on_update_status,
-            self.on.config_changed: self._on_write_slurm_config,
+            self.on.config_changed: self._on_config_changed,
             self.on.leader_elected: self._on_leader_elected,
             # slurm component lifecycle events
             self._slurmdbd.on.slurmdbd_available: self._on_slurmdbd_available,
@@ -83,7 +105,8 @@ class SlurmctldCharm(CharmBase):
             self._slurmd.on.slurmd_departed: self._on_write_slurm_config,
             self._slurmrestd.on.slurmrestd_available: self._on_slurmrestd_available,
             self._slurmrestd.on.slurmrestd_unavailable: self._on_write_slurm_config,
-            self._slurmctld_peer.on.slurmctld_peer_available: self._on_write_slurm_config,  # NOTE: a second slurmctld should get the jwt/munge keys and configure them
+            self._slurmctld_peer.on.slurmctld_peer_available: self._on_write_slurm_config,
+            self._slurmctld_peer.on.etcd_cluster_changed: self._on_etcd_cluster_changed,
             # fluentbit
             self.on["fluentbit"].relation_created: self._on_fluentbit_relation_created,
             # Addons lifecycle events
@@ -102,6 +125,13 @@ class SlurmctldCharm(CharmBase):
             self.on.etcd_get_root_password_action: self._etcd_get_root_password,
             self.on.etcd_get_slurmd_password_action: self._etcd_get_slurmd_password,
             self.on.etcd_create_munge_account_action: self._create_etcd_user_for_munge_key_ops,
+            self.on.etcd_maintenance_action: self._etcd_maintenance_action,
+            self.on.etcd_benchmark_action: self._etcd_benchmark_action,
+            self.on.job_table_sizing_action: self._job_table_sizing_action,
+            self.on.rpc_stats_action: self._rpc_stats_action,
+            self.on.failover_benchmark_action: self._failover_benchmark_action,
+            self.on.etcd_snapshot_action: self._etcd_snapshot_action,
+            self.on.etcd_restore_action: self._etcd_restore_action,
         }
         for event, handler in event_handler_bindings.items():
             self.framework.observe(event, handler)
@@ -116,6 +146,11 @@ class SlurmctldCharm(CharmBase):
         """Return the port."""
         return self._slurm_manager.port
 
+    @property
+    def ingress_address(self):
+        """Return the ingress address of this unit."""
+        return self._slurmctld_peer.ingress_address
+
     @property
     def cluster_name(self) -> str:
         """Return the cluster name."""
@@ -248,16 +283,14 @@ class SlurmctldCharm(CharmBase):
             # NOTE: Use leadership settings instead of stored state when
             # leadership settings support becomes available in the framework.
             if self._is_leader():
-                # NOTE the backup controller should also have the jwt and munge
-                #      keys configured. We should move these information to the
-                #      peer relation.
+                # the leader publishes the keys to the other controllers on
+                # the peer relation
                 self._stored.jwt_rsa = self._slurm_manager.generate_jwt_rsa()
                 self._stored.munge_key = self._slurm_manager.get_munge_key()
                 self._slurm_manager.configure_jwt_rsa(self.get_jwt_rsa())
             else:
-                # NOTE: the secondary slurmctld should get the jwt and munge
-                #       keys from the peer relation here
                 logger.debug("secondary slurmctld")
+                self._configure_controller_keys()
 
             # all slurmctld should restart munged here, as it would assure
             # munge is working
@@ -276,7 +309,13 @@ class SlurmctldCharm(CharmBase):
             event.defer()
             return
 
-        self._etcd.install(etcd_path)
+        try:
+            self._etcd.install(etcd_path)
+        except (EtcdOpsError, tarfile.TarError) as e:
+            logger.error(f"## Error installing etcd: {e}")
+            self.unit.status = BlockedStatus("Error installing etcd")
+            event.defer()
+            return
 
         self._check_status()
 
@@ -291,11 +330,159 @@ class SlurmctldCharm(CharmBase):
     def _on_upgrade(self, event):
         """Perform upgrade operations."""
         self.unit.set_workload_version(Path("version").read_text().strip())
+
+        # the etcd resource may have been updated along with the charm. This
+        # is a no-op if the installed binaries already match the resource
+        try:
+            etcd_path = self.model.resources.fetch("etcd")
+            if self._etcd.install(etcd_path) and self._stored.etcd_configured:
+                self._etcd.restart()
+        except (ModelError, EtcdOpsError, tarfile.TarError) as e:
+            logger.error(f"## Could not update etcd: {e}")
+
         self._configure_etcd()
+        self._on_etcd_cluster_changed(event)
 
     def _on_update_status(self, event):
         """Handle update status."""
         self._check_status()
+        self._on_etcd_cluster_changed(event)
+        self._configure_node_watcher()
+        self._configure_state_sync()
+        self._configure_sdiag_collector()
+        self._configure_prometheus_exporter()
+        self._run_scheduled_etcd_maintenance()
+
+    def _configure_controller_keys(self):
+        """Publish the munge and JWT keys on the leader, install them elsewhere."""
+        if self._is_leader():
+            if not self._stored.state_sync_secret:
+                self._stored.state_sync_secret = generate_password()
+            self._slurmctld_peer.set_controller_keys(
+                self._stored.munge_key, self._stored.jwt_rsa, self._stored.state_sync_secret
+            )
+            return
+
+        keys = self._slurmctld_peer.get_controller_keys()
+        if keys.get("munge_key") and keys["munge_key"] != self._stored.munge_key:
+            logger.debug("## installing the munge key of the leader")
+            self._stored.munge_key = keys["munge_key"]
+            self._slurm_manager.configure_munge_key(keys["munge_key"])
+            self._slurm_manager.restart_munged()
+        if keys.get("jwt_rsa") and keys["jwt_rsa"] != self._stored.jwt_rsa:
+            logger.debug("## installing the JWT key of the leader")
+            self._stored.jwt_rsa = keys["jwt_rsa"]
+            self._slurm_manager.configure_jwt_rsa(keys["jwt_rsa"])
+
+    def _configure_standby(self):
+        """Keep slurm.conf on a non-leader in sync with the leader's.
+
+        Backup controllers run slurmctld and are restarted when it changes,
+        the other standbys only keep it ready for when they are promoted.
+        """
+        slurm_config = self._assemble_slurm_config()
+        if not slurm_config:
+            return
+
+        is_backup = self.unit.name in self._slurmctld_peer.get_backup_controllers()
+        digest = hashlib.sha256(
+            json.dumps([slurm_config, is_backup], sort_keys=True).encode()
+        ).hexdigest()
+        if digest == self._stored.standby_config_digest:
+            return
+
+        logger.debug(f"## rendering slurm.conf on a standby controller, backup: {is_backup}")
+        self._slurm_manager.render_slurm_configs(slurm_config)
+        self._stored.standby_config_digest = digest
+        self._slurm_manager.slurm_systemctl("restart" if is_backup else "stop")
+
+    def _configure_state_sync(self):
+        """Replicate the StateSaveLocation from the leader to the standby units.
+
+        Backup controllers run slurmctld and own their StateSaveLocation, so
+        they are never synced into; they need shared storage instead.
+        """
+        interval = self.config.get("state-sync-interval")
+        secret = self._slurmctld_peer.get_controller_keys().get("state_sync_secret")
+        if not (self._stored.slurm_installed and interval > 0 and secret):
+            self._state_sync.stop()
+            return
+
+        if self._is_leader():
+            self._state_sync.setup_server(
+                self._slurmctld_peer.ingress_address,
+                self._slurmctld_peer.get_peer_addresses(),
+                secret,
+            )
+        elif self.unit.name in self._slurmctld_peer.get_backup_controllers():
+            self._state_sync.stop()
+        else:
+            source = (self._slurmctld_info or {}).get("active_controller_ingress_address")
+            if source:
+                self._state_sync.setup_client(source, secret, interval)
+
+    def _configure_sdiag_collector(self):
+        """Collect the scheduler statistics into InfluxDB, on the leader only."""
+        influxdb_info = self._get_influxdb_info()
+        interval = self.config.get("sdiag-collect-interval")
+        if not (self._is_leader() and self._stored.slurm_installed and influxdb_info):
+            self._metrics.stop_sdiag_collector()
+            return
+        if interval <= 0:
+            self._metrics.stop_sdiag_collector()
+            return
+
+        self._metrics.setup_sdiag_collector(influxdb_info, interval)
+
+    def _configure_prometheus_exporter(self):
+        """Serve the Slurm state to Prometheus, on the leader only."""
+        port = self.config.get("prometheus-exporter-port")
+        if not (self._is_leader() and self._stored.slurm_installed and port > 0):
+            self._metrics.stop_prometheus_exporter()
+            return
+        if self._metrics.check_config():
+            self._metrics.stop_prometheus_exporter()
+            return
+
+        self._metrics.setup_prometheus_exporter(
+            port, self.config.get("prometheus-exporter-interval")
+        )
+
+    def _configure_node_watcher(self):
+        """Run the daemon applying node state changes, on the leader only."""
+        if not (self._is_leader() and self._stored.etcd_configured):
+            self._etcd.stop_node_watcher()
+            return
+
+        ttl = self.config.get("node-heartbeat-ttl")
+        self._etcd.setup_node_watcher(
+            self._stored.etcd_root_pass,
+            {
+                "batch_interval": self.config.get("node-watcher-batch-interval"),
+                "batch_size": self.config.get("node-watcher-batch-size"),
+                "heartbeat": ttl > 0,
+            },
+        )
+        self._slurmd.set_node_heartbeat_ttl(ttl)
+
+    def _run_scheduled_etcd_maintenance(self):
+        """Compact and defragment etcd if the maintenance interval elapsed."""
+        interval = self.config.get("etcd-maintenance-interval")
+        if not (self._stored.etcd_configured and interval > 0):
+            return
+
+        if time.time() - self._stored.etcd_last_maintenance < interval * 3600:
+            return
+
+        try:
+            result = self._etcd.maintenance(self._stored.etcd_root_pass)
+            logger.info(f"## Scheduled etcd maintenance: {result}")
+        except EtcdOpsError as e:
+            logger.error(f"## {e}")
+
+        # try again on the next interval even on failures, to not run the
+        # maintenance on every update-status while etcd is unhealthy
+        self._stored.etcd_last_maintenance = time.time()
 
     def _configure_etcd(self):
         """Handle initial configuration for etcd.
@@ -303,7 +490,15 @@ class SlurmctldCharm(CharmBase):
         - set passwords for root and slurmd account
         - store munge key in db
         """
-        if not self._stored.etcd_configured:
+        # stateless JWT tokens survive etcd restarts, unlike simple tokens
+        if not self._stored.etcd_jwt_key and self._is_leader():
+            self._stored.etcd_jwt_key = self._etcd.generate_jwt_key()
+            if self._stored.etcd_configured:
+                self._configure_etcd_tls()
+                self._reconcile_etcd_cluster()
+
+        # only the leader bootstraps a cluster, the other units join it
+        if not self._stored.etcd_configured and self._is_leader():
             logger.debug("### configuring etcd")
             self._stored.etcd_configured = True
 
@@ -321,16 +516,134 @@ class SlurmctldCharm(CharmBase):
 
         logger.debug("### etcd configured")
 
+    def _on_etcd_cluster_changed(self, event):
+        """Reconcile the etcd members on the leader, join the cluster elsewhere."""
+        if self._stored.etcd_resource_digest:
+            self._slurmctld_peer.set_etcd_ready()
+
+        if self._is_leader():
+            self._reconcile_etcd_cluster()
+        else:
+            self._join_etcd_cluster()
+
+    def _reconcile_etcd_cluster(self):
+        """Add and remove etcd members as slurmctld peers come and go."""
+        if not self._stored.etcd_configured:
+            return
+
+        peers = self._slurmctld_peer.get_etcd_peers()
+        if not peers.get(self.unit.name):
+            logger.debug("## no peer relation yet, running a single etcd member")
+            return
+
+        desired = {
+            unit.replace("/", "-"): self._etcd.peer_url(address) for unit, address in peers.items()
+        }
+        try:
+            cluster = self._etcd.reconcile_members(self._stored.etcd_root_pass, desired)
+        except EtcdOpsError as e:
+            logger.error(f"## {e}")
+            return
+
+        logger.debug(f"## etcd cluster: {cluster}")
+        self._slurmctld_peer.set_etcd_cluster(
+            cluster,
+            self._stored.etcd_root_pass,
+            self._stored.etcd_slurmd_pass,
+            self._stored.etcd_jwt_key,
+        )
+        self._slurmd.set_etcd_endpoints(cluster["client_urls"])
+
+    def _join_etcd_cluster(self):
+        """Start the local etcd member once the leader added it to the cluster."""
+        cluster = self._slurmctld_peer.get_etcd_cluster()
+
+        # all members must sign auth tokens with the same key
+        jwt_key = cluster.get("jwt_key", "")
+        if cluster and jwt_key != self._stored.etcd_jwt_key:
+            self._stored.etcd_jwt_key = jwt_key
+            if self._stored.etcd_configured:
+                self._etcd.setup_tls()
+
+        if self._stored.etcd_configured and not self._leave_standalone_etcd(cluster):
+            return
+
+        members = cluster.get("members", {})
+        if self._etcd.member_name not in members:
+            logger.debug("## waiting to be added to the etcd cluster")
+            return
+
+        self._stored.etcd_root_pass = cluster["root_pass"]
+        self._stored.etcd_slurmd_pass = cluster["slurmd_pass"]
+        self._stored.use_tls = bool(self.model.config["tls-key"]) and bool(
+            self.model.config["tls-cert"]
+        )
+        self._stored.use_tls_ca = bool(self.model.config["tls-ca-cert"])
+
+        initial_cluster = ",".join(f"{name}={url}" for name, url in members.items())
+        self._etcd.join(initial_cluster)
+        self._stored.etcd_configured = True
+
+    def _leave_standalone_etcd(self, cluster: dict) -> bool:
+        """Stop the local etcd if it is not a member of the cluster of the leader.
+
+        A non-leader may run an etcd cluster of its own, e.g. one it set up
+        before the peers shared a cluster. Its data is removed, so it joins
+        the cluster of the leader afresh.
+
+        Returns:
+            True if the local etcd was stopped and has to join the cluster.
+        """
+        cluster_id = cluster.get("cluster_id", "")
+        if not cluster_id or cluster_id == self._stored.etcd_cluster_id:
+            return False
+
+        local_id = self._etcd.cluster_id()
+        if not local_id:
+            # not running, check again later
+            return False
+        if local_id == cluster_id:
+            self._stored.etcd_cluster_id = cluster_id
+            return False
+
+        logger.warning(f"## leaving etcd cluster {local_id} to join cluster {cluster_id}")
+        self._etcd.reset()
+        self._stored.etcd_configured = False
+        return True
+
     def _on_leader_elected(self, event: LeaderElectedEvent) -> None:
         logger.debug("## slurmctld - leader elected")
 
         self._configure_etcd()
+        self._reconcile_etcd_cluster()
+        self._configure_node_watcher()
+        self._configure_controller_keys()
+        self._configure_state_sync()
+        self._configure_sdiag_collector()
+        self._configure_prometheus_exporter()
 
         # populate etcd with the nodelist
+        self._etcd.set_list_of_accounted_nodes(
+            self._stored.etcd_root_pass, self._accounted_nodes()
+        )
+
+    def _accounted_nodes(self) -> List[str]:
+        """Return the nodes of all partitions."""
         slurm_config = self._assemble_slurm_config()
         accounted_nodes = self._assemble_all_nodes(slurm_config.get("partitions", []))
-        logger.debug(f"## Sending to etcd list of accounted nodes: {accounted_nodes}")
-        self._etcd.set_list_of_accounted_nodes(self._stored.etcd_root_pass, accounted_nodes)
+        logger.debug(f"## accounted nodes: {accounted_nodes}")
+        return accounted_nodes
+
+    def _populate_etcd(self):
+        """Store the munge key of the controller and the accounted nodes in etcd."""
+        self._etcd.store_cluster_state(
+            self._stored.etcd_root_pass, self._stored.munge_key, self._accounted_nodes()
+        )
+
+    @property
+    def etcd_endpoints(self) -> List[str]:
+        """Return the client URLs of the etcd cluster members."""
+        return self._slurmctld_peer.get_etcd_cluster().get("client_urls", [])
 
     @property
     def etcd_slurmd_password(self) -> str:
@@ -353,7 +666,18 @@ class SlurmctldCharm(CharmBase):
             self.unit.status = BlockedStatus("Error installing slurmctld")
             return False
 
-        if self._is_leader() and not self._etcd.is_active():
+        config_error = (
+            self._etcd.check_config()
+            or self._slurmctld_ops.check_config(self._slurmd_info)
+            or self._slurmrestd.check_config()
+            or self._metrics.check_config()
+        )
+        if config_error:
+            self.unit.status = BlockedStatus(config_error)
+            return False
+
+        # the leader always runs etcd, other units once they joined the cluster
+        if (self._is_leader() or self._stored.etcd_configured) and not self._etcd.is_active():
             self.unit.status = WaitingStatus("Initializing charm")
             return False
 
@@ -432,6 +756,21 @@ class SlurmctldCharm(CharmBase):
 
         return slurmd_info_tmp
 
+    def _job_table_sizing(self) -> dict:
+        """Return the job table sizing for the host of the leader.
+
+        Only the leader, the active controller, sizes the job table, and
+        shares it with the standbys over the peer relation.
+        """
+        if self.config.get("job-submission-rate") <= 0:
+            return {}
+        if not self._is_leader():
+            return self._slurmctld_peer.get_job_table_sizing()
+
+        sizing = self._slurmctld_ops.job_table_sizing()
+        self._slurmctld_peer.set_job_table_sizing(sizing)
+        return sizing
+
     def _assemble_slurm_config(self):
         """Assemble and return the slurm config."""
         logger.debug("## Assembling new slurm.conf")
@@ -459,6 +798,20 @@ class SlurmctldCharm(CharmBase):
         logger.debug(f"#### partitions_info: {partitions_info}")
         logger.debug(f"#### Down nodes: {down_nodes}")
 
+        # the slurm.conf template renders the active and the first backup
+        # controller, the other backups follow in failover order
+        extra_hosts = [
+            f"SlurmctldHost={backup['hostname']}({backup['ingress_address']})"
+            for backup in slurmctld_info.get("backup_controllers", [])[1:]
+        ]
+        # the user supplied config comes last, so it overrides the derived
+        # one, except for SlurmctldParameters which are merged
+        cluster_info["custom_config"] = "\n".join(
+            extra_hosts
+            + self._slurmctld_ops.slurm_conf_lines(slurmd_info, self._job_table_sizing())
+            + [strip_slurmctld_parameters(cluster_info["custom_config"])]
+        )
+
         return {
             "partitions": partitions_info,
             "down_nodes": down_nodes,
@@ -485,6 +838,7 @@ class SlurmctldCharm(CharmBase):
             self._slurmrestd.set_slurm_config_on_app_relation_data(
                 slurm_config,
             )
+            self._slurmrestd.set_cache_config_on_app_relation_data()
             self._slurmrestd.restart_slurmrestd()
 
     def _on_slurmdbd_available(self, event):
@@ -495,29 +849,43 @@ class SlurmctldCharm(CharmBase):
         self._set_slurmdbd_available(False)
         self._check_status()
 
+    def _on_config_changed(self, event):
+        """Reschedule the controllers and rewrite slurm.conf."""
+        # a change of the backup controllers rewrites slurm.conf by itself
+        if self._slurmctld_peer.schedule_controllers():
+            return
+
+        self._on_write_slurm_config(event)
+
     def _on_write_slurm_config(self, event):
         """Check that we have what we need before we proceed."""
         logger.debug("### Slurmctld - _on_write_slurm_config()")
 
         # only the leader should write the config, restart, and scontrol reconf
         if not self._is_leader():
+            # but every etcd member needs the current TLS and tuning settings
+            if self._stored.etcd_configured:
+                self._configure_etcd_tls()
+
+            # and every controller is kept ready to take over
+            if self._stored.slurm_installed:
+                self._configure_controller_keys()
+                self._configure_standby()
+                self._configure_state_sync()
+            self._configure_sdiag_collector()
+            self._configure_prometheus_exporter()
             return
 
         if not self._check_status():
             event.defer()
             return
 
-        # check if both certificates are supplied
-        tls_key = self.model.config["tls-key"]
-        tls_cert = self.model.config["tls-cert"]
-        self._stored.use_tls = bool(tls_key) and bool(tls_cert)
-        self._stored.use_tls_ca = bool(self.model.config["tls-ca-cert"])
-        logger.debug(f"## _on_write_slurm_config(): use_tls: {self._stored.use_tls}")
-        logger.debug(f"## _on_write_slurm_config(): use_tls_ca: {self._stored.use_tls_ca}")
-
-        # TODO this will fire every time a the configuration changed, we don't
-        #      need that. This should happen only if the tls configs changed
-        self._etcd.setup_tls()
+        self._configure_etcd_tls()
+        self._configure_node_watcher()
+        self._configure_controller_keys()
+        self._configure_state_sync()
+        self._configure_sdiag_collector()
+        self._configure_prometheus_exporter()
 
         slurm_config = self._assemble_slurm_config()
         if slurm_config:
@@ -547,12 +915,26 @@ class SlurmctldCharm(CharmBase):
             # slurmrestd needs the slurm.conf file, so send it every time it changes
             if self._stored.slurmrestd_available:
                 self._slurmrestd.set_slurm_config_on_app_relation_data(slurm_config)
+                self._slurmrestd.set_cache_config_on_app_relation_data()
                 # NOTE: scontrol reconfigure does not restart slurmrestd
                 self._slurmrestd.restart_slurmrestd()
         else:
             logger.debug("## Should rewrite slurm.conf, but we don't have it. " "Deferring.")
             event.defer()
 
+    def _configure_etcd_tls(self):
+        """Apply the TLS settings to the local etcd member."""
+        # check if both certificates are supplied
+        tls_key = self.model.config["tls-key"]
+        tls_cert = self.model.config["tls-cert"]
+        self._stored.use_tls = bool(tls_key) and bool(tls_cert)
+        self._stored.use_tls_ca = bool(self.model.config["tls-ca-cert"])
+        logger.debug(f"## _configure_etcd_tls(): use_tls: {self._stored.use_tls}")
+        logger.debug(f"## _configure_etcd_tls(): use_tls_ca: {self._stored.use_tls_ca}")
+
+        # only rewrites the certificates and restarts etcd if they changed
+        self._etcd.setup_tls()
+
     @staticmethod
     def _assemble_all_nodes(slurmd_info: list) -> List[str]:
         """Parse slurmd_info and return a list with all hostnames."""
@@ -670,6 +1052,124 @@ class SlurmctldCharm(CharmBase):
         self._etcd.create_new_munge_user(self._stored.etcd_root_pass, user, pw)
         event.set_results({"created-new-user": user})
 
+    def _etcd_maintenance_action(self, event):
+        """Compact and defragment etcd."""
+        force_defrag = event.params.get("force-defrag", False)
+        try:
+            result = self._etcd.maintenance(self._stored.etcd_root_pass, force_defrag)
+            self._stored.etcd_last_maintenance = time.time()
+            event.set_results(result)
+        except EtcdOpsError as e:
+            event.fail(message=str(e))
+
+    def _etcd_snapshot_action(self, event):
+        """Save a compressed etcd snapshot along with the etcd credentials."""
+        timestamp = time.strftime("%Y%m%d-%H%M%S")
+        path = Path(
+            event.params.get("path") or f"/var/backups/etcd/etcd-snapshot-{timestamp}.db.gz"
+        )
+        try:
+            result = self._etcd.snapshot(self._stored.etcd_root_pass, path)
+        except EtcdOpsError as e:
+            event.fail(message=str(e))
+            return
+
+        # written with its mode set, as an existing file keeps its own
+        atomic_write(
+            Path(f"{path}.json"),
+            json.dumps(
+                {
+                    "sha256": result["sha256"],
+                    "root_pass": self._stored.etcd_root_pass,
+                    "slurmd_pass": self._stored.etcd_slurmd_pass,
+                }
+            ),
+            mode=0o600,
+        )
+        event.set_results(result)
+
+    def _etcd_restore_action(self, event):
+        """Restore an etcd snapshot and the etcd credentials saved with it."""
+        if not self._is_leader():
+            event.fail(message="Restore must run on the leader.")
+            return
+
+        if len(self._slurmctld_peer.get_etcd_cluster().get("members", {})) > 1:
+            event.fail(message="etcd has other members. Restore on a fresh deployment.")
+            return
+
+        path = Path(event.params["path"])
+        metadata_path = Path(f"{path}.json")
+        metadata = json.loads(metadata_path.read_text()) if metadata_path.exists() else {}
+        sha256 = event.params.get("sha256") or metadata.get("sha256", "")
+
+        try:
+            self._etcd.restore(path, sha256)
+        except (EtcdOpsError, OSError) as e:
+            event.fail(message=f"Error restoring {path}: {e}")
+            return
+
+        if metadata.get("root_pass"):
+            self._stored.etcd_root_pass = metadata["root_pass"]
+            self._stored.etcd_slurmd_pass = metadata["slurmd_pass"]
+        self._stored.etcd_configured = True
+        self._reconcile_etcd_cluster()
+
+        # the slurmd units stay related, so hand them the restored password,
+        # and replace the munge key and nodes of the snapshot with the current
+        self._slurmd.set_etcd_slurmd_pass(self._stored.etcd_slurmd_pass)
+        self._populate_etcd()
+
+        event.set_results({"restored": path.as_posix()})
+
+    def _etcd_benchmark_action(self, event):
+        """Benchmark the local etcd member."""
+        key_count = event.params.get("key-count", 1000)
+        value_size = event.params.get("value-size", 256)
+        event.log(f"Benchmarking etcd with {key_count} keys of {value_size} bytes.")
+        try:
+            event.set_results(
+                self._etcd.benchmark(self._stored.etcd_root_pass, key_count, value_size)
+            )
+        except EtcdOpsError as e:
+            event.fail(message=str(e))
+
+    def _job_table_sizing_action(self, event):
+        """Show the sizing of the job table."""
+        sizing = self._slurmctld_ops.job_table_sizing(
+            event.params.get("job-submission-rate"), event.params.get("average-array-size")
+        )
+        event.set_results({key: str(value) for key, value in sizing.items()})
+
+    def _rpc_stats_action(self, event):
+        """Report the RPC throttling counters."""
+        try:
+            stats = self._slurmctld_ops.rpc_stats(
+                event.params.get("top", 5), event.params.get("reset", False)
+            )
+            event.set_results({key: str(value) for key, value in stats.items()})
+        except SlurmctldOpsError as e:
+            event.fail(message=str(e))
+
+    def _failover_benchmark_action(self, event):
+        """Measure how long scheduling is unavailable when the controller fails."""
+        if not self._is_leader():
+            event.fail(message="Run this action on the leader, the active controller.")
+            return
+        if self.config.get("state-sync-interval") > 0:
+            # the backup would take over from a copy of the state, set
+            # state-sync-interval to 0 and use shared storage instead
+            event.fail(message="Failover is unsafe while state-sync-interval is set.")
+            return
+
+        timeout = event.params.get("timeout", 600)
+        partition = event.params.get("partition", "")
+        event.log("Killing the active slurmctld.")
+        try:
+            event.set_results(self._slurmctld_ops.failover_benchmark(timeout, partition))
+        except SlurmctldOpsError as e:
+            event.fail(message=str(e))
+
 
 if __name__ == "__main__":
     main(SlurmctldCharm)
@@ -1,21 +1,109 @@
 """etcd operations."""
 
+import asyncio
+import base64
+import gzip
+import hashlib
 import json
 import logging
+import os
+import queue
+import re
 import shlex
 import shutil
 import subprocess
+import sys
 import tarfile
-from pathlib import Path
+import time
+from pathlib import Path, PurePosixPath
 from tempfile import TemporaryDirectory
-from typing import List
+from typing import Dict, List, Optional
 
+import requests
+from etcd3gw.exceptions import Etcd3Exception
+from etcd3gw.utils import _encode, _increment_last_byte
+from etcd3gw.watch import Watcher
 from jinja2 import Environment, FileSystemLoader
-from omnietcd3 import Etcd3AuthClient
+from omnietcd3 import AsyncEtcd3AuthClient, Etcd3AuthClient
 from slurm_ops_manager.utils import operating_system
+from systemd_ops import atomic_write
 
 logger = logging.getLogger()
 
+ETCD_BINARIES = ("etcd", "etcdutl", "etcdctl")
+
+# defragmenting blocks the member, only do it when enough space can be freed
+DEFRAG_MIN_FREE_RATIO = 0.1
+
+
+class EtcdOpsError(Exception):
+    """Raised when an etcd operation cannot be completed."""
+
+
+def _sha256sum(path: Path) -> str:
+    """Return the sha256 hex digest of a file, reading it in chunks."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _latency_summary(samples: List[float], elapsed: float) -> dict:
+    """Summarize latency samples, in seconds, as percentiles in ms and throughput."""
+    if not samples:
+        return {}
+
+    samples = sorted(samples)
+
+    def percentile(p):
+        return round(samples[min(len(samples) - 1, int(p * len(samples)))] * 1000, 3)
+
+    return {
+        "count": len(samples),
+        "p50-ms": percentile(0.5),
+        "p90-ms": percentile(0.9),
+        "p99-ms": percentile(0.99),
+        "max-ms": round(samples[-1] * 1000, 3),
+        "ops-per-second": round(len(samples) / elapsed, 1) if elapsed else 0,
+    }
+
+
+def _parse_histogram(metrics: str, name: str) -> Optional[dict]:
+    """Parse a Prometheus histogram from etcd's /metrics output.
+
+    Returns:
+        The cumulative bucket counts as a printable string, the sample
+        count and the mean in ms, or None if the metric is missing.
+    """
+    buckets = []
+    total = count = 0.0
+    for line in metrics.splitlines():
+        if line.startswith(f"{name}_bucket"):
+            bound = re.search(r'le="([^"]+)"', line).group(1)
+            buckets.append(f"{bound}:{int(float(line.split()[-1]))}")
+        elif line.startswith(f"{name}_sum"):
+            total = float(line.split()[-1])
+        elif line.startswith(f"{name}_count"):
+            count = float(line.split()[-1])
+
+    if not buckets:
+        return None
+
+    return {
+        "buckets": " ".join(buckets),
+        "count": int(count),
+        "mean-ms": round(total / count * 1000, 3) if count else 0,
+    }
+
+
+def _remove(path: Path) -> None:
+    """Remove a file or a directory tree."""
+    if path.is_dir():
+        shutil.rmtree(path)
+    else:
+        path.unlink()
+
 
 class EtcdOps:
     """ETCD ops."""
@@ -28,6 +116,8 @@ class EtcdOps:
         self._etcd_user = "etcd"
         self._etcd_group = "etcd"
         self._etcd_service = "etcd.service"
+        self._bin_dir = Path("/usr/bin")
+        self._varlib = Path("/var/lib/etcd")
 
         if operating_system() == "ubuntu":
             self._etcd_environment_file = Path("/etc/default/etcd")
@@ -39,29 +129,124 @@ class EtcdOps:
         self._tls_crt_path = self._certs_path / "tls.crt"
         self._tls_ca_crt_path = self._certs_path / "tls-ca.crt"
 
-    def install(self, resource_path: Path):
-        """Install etcd."""
-        # extract resource tarball
-        with TemporaryDirectory(prefix="omni") as tmp_dir:
-            logger.debug(f"## extracting {resource_path} to {tmp_dir}")
-            with tarfile.open(resource_path, "r") as tar:
-                tar.extractall(path=tmp_dir)
+        self._node_watcher_service = "slurmctld-node-watcher.service"
+        self._node_watcher_path = Path("/var/lib/slurmctld-node-watcher")
+        self._node_watcher_config = self._node_watcher_path / "config.json"
+
+        self._jwt_path = self._varlib / "jwt"
+        self._jwt_key_path = self._jwt_path / "jwt.key"
+        self._jwt_pub_path = self._jwt_path / "jwt.pub"
+
+    def install(self, resource_path: Path) -> bool:
+        """Install etcd.
+
+        The binaries are streamed out of the resource tarball straight to
+        their destination. If the installed binaries already match the
+        resource, nothing is done.
+
+        Returns:
+            True if the binaries were (re)installed, False if they were
+            already up to date.
+        """
+        resource_digest = _sha256sum(resource_path)
+        if self._binaries_up_to_date(resource_digest):
+            logger.debug("## etcd binaries already match the resource, skipping install")
+            return False
 
-            usrbin = Path("/usr/bin")
-            logger.debug(f"## installing etcd in {usrbin}")
-            source = Path(tmp_dir) / "etcd-v3.5.0-linux-amd64"
-            for abin in ["etcd", "etcdutl", "etcdctl"]:
-                shutil.copy2(source / abin, usrbin / abin)
+        logger.debug(f"## installing etcd from {resource_path} in {self._bin_dir}")
+        binaries = self._extract_binaries(resource_path)
 
         self._create_etcd_user_group()
 
-        varlib = Path("/var/lib/etcd")
-        if not varlib.exists():
-            varlib.mkdir()
-        shutil.chown(varlib, user=self._etcd_user, group=self._etcd_group)
+        if not self._varlib.exists():
+            self._varlib.mkdir()
+        shutil.chown(self._varlib, user=self._etcd_user, group=self._etcd_group)
 
         self._setup_systemd()
 
+        self._charm._stored.etcd_resource_digest = resource_digest
+        self._charm._stored.etcd_binaries_digest = binaries
+        return True
+
+    def _binaries_up_to_date(self, resource_digest: str) -> bool:
+        """Check if the installed binaries come from the given resource."""
+        if self._charm._stored.etcd_resource_digest != resource_digest:
+            return False
+
+        installed = self._charm._stored.etcd_binaries_digest
+        for abin in ETCD_BINARIES:
+            path = self._bin_dir / abin
+            if not path.exists() or _sha256sum(path) != installed.get(abin):
+                return False
+        return True
+
+    def _extract_binaries(self, resource_path: Path) -> Dict[str, str]:
+        """Stream the etcd binaries out of the tarball.
+
+        Only the members for the etcd binaries are extracted. They must live
+        in the archive's top-level directory (e.g. `etcd-v3.5.0-linux-amd64`),
+        which is detected from the first member instead of being hard-coded.
+
+        The binaries are staged next to their destination and only replace
+        the installed ones once all of them were extracted, so a broken
+        resource never leaves a mix of etcd versions behind.
+
+        Returns:
+            Mapping of binary name to the sha256 digest of the installed file.
+        """
+        digests = {}
+        top_level = None
+        try:
+            with tarfile.open(resource_path, "r|*") as tar:
+                for member in tar:
+                    parts = [p for p in PurePosixPath(member.name).parts if p != "."]
+                    if not parts:
+                        continue
+                    if top_level is None:
+                        top_level = parts[0] if len(parts) > 1 or member.isdir() else ""
+                        logger.debug(f"## etcd archive top-level directory: '{top_level}'")
+
+                    parent = "/".join(parts[:-1])
+                    name = parts[-1]
+                    if not member.isfile() or parent != top_level or name not in ETCD_BINARIES:
+                        continue
+
+                    digests[name] = self._stage_binary(tar.extractfile(member), name)
+
+            missing = set(ETCD_BINARIES) - set(digests)
+            if missing:
+                raise EtcdOpsError(f"etcd resource is missing: {', '.join(sorted(missing))}")
+        except BaseException:
+            for name in ETCD_BINARIES:
+                self._staged_path(name).unlink(missing_ok=True)
+            raise
+
+        for name, expected in digests.items():
+            dest = self._bin_dir / name
+            os.replace(self._staged_path(name), dest)
+            if _sha256sum(dest) != expected:
+                raise EtcdOpsError(f"checksum mismatch for installed {dest}")
+            logger.debug(f"## installed {dest} ({expected})")
+
+        return digests
+
+    def _staged_path(self, name: str) -> Path:
+        return self._bin_dir / f".{name}.tmp"
+
+    def _stage_binary(self, source, name: str) -> str:
+        """Write a binary next to its destination and return its sha256."""
+        tmp = self._staged_path(name)
+
+        digest = hashlib.sha256()
+        with open(tmp, "wb") as f:
+            for chunk in iter(lambda: source.read(1 << 20), b""):
+                digest.update(chunk)
+                f.write(chunk)
+            f.flush()
+            os.fsync(f.fileno())
+        tmp.chmod(0o755)
+        return digest.hexdigest()
+
     def _create_etcd_user_group(self):
         logger.debug("## creating etcd user and group")
         cmd = f"groupadd {self._etcd_group}"
@@ -92,8 +277,8 @@ class EtcdOps:
 
         subprocess.call(["systemctl", "daemon-reload"])
 
-    def _setup_environment_file(self):
-        logger.debug("## creating environment file for etcd")
+    def _render_environment_file(self) -> str:
+        """Render the etcd environment file."""
         template_dir = Path(__file__).parent / "templates"
         environment = Environment(loader=FileSystemLoader(template_dir))
 
@@ -111,45 +296,192 @@ class EtcdOps:
         else:
             ctxt = {"use_tls": False, "protocol": "http"}
 
-        self._etcd_environment_file.write_text(template.render(ctxt))
+        ctxt.update(self._tuning_context())
+        ctxt.update(self._cluster_context(ctxt["protocol"]))
+
+        if self._charm._stored.etcd_jwt_key:
+            ctxt["auth_token"] = (
+                f"jwt,pub-key={self._jwt_pub_path},priv-key={self._jwt_key_path},"
+                f"sign-method=RS256,ttl={self._charm.model.config.get('etcd-auth-token-ttl')}"
+            )
+
+        return template.render(ctxt)
+
+    @property
+    def member_name(self) -> str:
+        """Return the etcd member name of this unit."""
+        return self._charm.unit.name.replace("/", "-")
+
+    def peer_url(self, address: str) -> str:
+        """Return the etcd peer URL for a unit address."""
+        protocol = "https" if self._charm._stored.use_tls else "http"
+        return f"{protocol}://{address}:2380"
+
+    def _cluster_context(self, protocol: str) -> dict:
+        """Return the etcd cluster membership settings of this unit."""
+        address = self._charm.ingress_address
+        peer_url = self.peer_url(address or "localhost")
+        return {
+            "name": self.member_name,
+            "client_address": address or "0.0.0.0",
+            "peer_url": peer_url,
+            # only used the first time etcd starts, i.e. with no data dir
+            "initial_cluster": self._charm._stored.etcd_initial_cluster
+            or f"{self.member_name}={peer_url}",
+            "initial_cluster_state": self._charm._stored.etcd_initial_cluster_state,
+        }
+
+    def _tuning_context(self) -> dict:
+        """Return the etcd storage and timing settings from the charm config."""
+        config = self._charm.model.config
+        return {
+            "data_dir": config.get("etcd-data-dir") or self._varlib.as_posix(),
+            "wal_dir": config.get("etcd-wal-dir"),
+            "quota_backend_bytes": config.get("etcd-quota-backend-bytes"),
+            "snapshot_count": config.get("etcd-snapshot-count"),
+            "heartbeat_interval": config.get("etcd-heartbeat-interval"),
+            "election_timeout": config.get("etcd-election-timeout"),
+            "auto_compaction_mode": config.get("etcd-auto-compaction-mode"),
+            "auto_compaction_retention": config.get("etcd-auto-compaction-retention"),
+            "max_request_bytes": config.get("etcd-max-request-bytes"),
+        }
+
+    def check_config(self) -> str:
+        """Validate the etcd tuning options.
+
+        Returns:
+            A message describing the first invalid option, or an empty
+            string if the configuration is valid.
+        """
+        ctxt = self._tuning_context()
+
+        for key in ["quota_backend_bytes", "snapshot_count", "max_request_bytes"]:
+            if ctxt[key] < 0:
+                return f"etcd-{key.replace('_', '-')} must not be negative"
+
+        if ctxt["heartbeat_interval"] <= 0:
+            return "etcd-heartbeat-interval must be positive"
+        if ctxt["election_timeout"] < 5 * ctxt["heartbeat_interval"]:
+            return "etcd-election-timeout must be at least 5x etcd-heartbeat-interval"
+
+        if ctxt["auto_compaction_mode"] not in ["periodic", "revision"]:
+            return "etcd-auto-compaction-mode must be periodic or revision"
+
+        ttl = self._charm.model.config.get("etcd-auth-token-ttl")
+        if not re.fullmatch(r"(\d+(\.\d+)?(ns|us|ms|s|m|h))+", ttl):
+            return "etcd-auth-token-ttl must be a duration, e.g. 1h"
+
+        for key in ["data_dir", "wal_dir"]:
+            if ctxt[key] and not Path(ctxt[key]).is_absolute():
+                return f"etcd-{key.replace('_', '-')} must be an absolute path"
+
+        return ""
+
+    def _setup_environment_file(self):
+        logger.debug("## creating environment file for etcd")
+
+        # etcd runs unprivileged, make sure it owns its data and wal dirs
+        ctxt = self._tuning_context()
+        for directory in [ctxt["data_dir"], ctxt["wal_dir"]]:
+            if directory:
+                path = Path(directory)
+                if not path.exists():
+                    path.mkdir(mode=0o700, parents=True)
+                shutil.chown(path, user=self._etcd_user, group=self._etcd_group)
+
+        atomic_write(self._etcd_environment_file, self._render_environment_file())
+
+    def _tls_fingerprint(self) -> str:
+        """Return a digest of the TLS material and the rendered environment file."""
+        digest = hashlib.sha256()
+        for item in [
+            str(self._charm._stored.use_tls),
+            self._charm.model.config["tls-key"],
+            self._charm.model.config["tls-cert"],
+            self._charm.model.config["tls-ca-cert"],
+            self._charm._stored.etcd_jwt_key,
+            self._render_environment_file(),
+        ]:
+            digest.update(item.encode())
+            # separator, so that moving data between items changes the digest
+            digest.update(b"\0")
+        return digest.hexdigest()
+
+    @staticmethod
+    def generate_jwt_key() -> str:
+        """Generate a private key to sign etcd JWT auth tokens."""
+        logger.debug("## generating etcd jwt signing key")
+        cmd = "openssl genpkey -algorithm RSA -pkeyopt rsa_keygen_bits:2048"
+        return subprocess.check_output(shlex.split(cmd)).decode()
+
+    def _write_jwt_keys(self, private_key: str) -> None:
+        """Write the JWT signing key pair for etcd."""
+        logger.debug("## creating jwt key files")
+        if not self._jwt_path.exists():
+            self._jwt_path.mkdir(parents=True)
+
+        atomic_write(self._jwt_key_path, private_key, mode=0o600)
+        public_key = subprocess.check_output(
+            ["openssl", "pkey", "-pubout"], input=private_key.encode()
+        ).decode()
+        atomic_write(self._jwt_pub_path, public_key)
+
+        for path in [self._jwt_key_path, self._jwt_pub_path]:
+            shutil.chown(path, user=self._etcd_user, group=self._etcd_group)
+        self._jwt_key_path.chmod(0o400)
+        shutil.chown(self._jwt_path, user=self._etcd_user, group=self._etcd_group)
+        self._jwt_path.chmod(0o500)
+
+    def setup_tls(self) -> bool:
+        """Set up the files for TLS and JWT auth tokens.
+
+        The certificates, signing keys and the environment file are only
+        rewritten, and etcd restarted, if any of them changed since the last
+        call.
+
+        Returns:
+            True if etcd was restarted, False otherwise.
+        """
+        fingerprint = self._tls_fingerprint()
+        if fingerprint == self._charm._stored.etcd_tls_fingerprint:
+            logger.debug("## etcd tls settings unchanged")
+            return False
 
-    def setup_tls(self):
-        """Set up the files for TLS."""
         logger.debug("## setting tls files for etcd")
 
-        # safeguard
-        if not self._charm._stored.use_tls:
-            logger.debug("## no certificates provided")
+        if self._charm._stored.use_tls:
+            # create dir to store certs
+            if not self._certs_path.exists():
+                logger.debug("## creating directory to store certs")
+                self._certs_path.mkdir(parents=True)
+
+            # create the files
+            logger.debug("## creating cert files")
+            atomic_write(self._tls_key_path, self._charm.model.config["tls-key"])
+            atomic_write(self._tls_crt_path, self._charm.model.config["tls-cert"])
+
+            ca_crt = self._charm.model.config["tls-ca-cert"]
+            if ca_crt:
+                logger.debug("## creating ca cert file")
+                atomic_write(self._tls_ca_crt_path, ca_crt)
+
+            # set correct permissions
+            shutil.chown(self._certs_path, user=self._etcd_user, group=self._etcd_group)
+            self._certs_path.chmod(0o500)
+        else:
             # must restart if user removed certs
-            self._setup_environment_file()
-            self.restart()
-            return
-
-        # create dir to store certs
-        if not self._certs_path.exists():
-            logger.debug("## creating directory to store certs")
-            self._certs_path.mkdir(parents=True)
-
-        # create the files
-        logger.debug("## creating cert files")
-        key = self._charm.model.config["tls-key"]
-        self._tls_key_path.write_text(key)
-        crt = self._charm.model.config["tls-cert"]
-        self._tls_crt_path.write_text(crt)
-
-        ca_crt = self._charm.model.config["tls-ca-cert"]
-        if ca_crt:
-            logger.debug("## creating ca cert file")
-            self._tls_ca_crt_path.write_text(ca_crt)
-
-        # set correct permissions
-        shutil.chown(self._certs_path, user=self._etcd_user, group=self._etcd_group)
-        self._certs_path.chmod(0o500)
+            logger.debug("## no certificates provided")
+
+        if self._charm._stored.etcd_jwt_key:
+            self._write_jwt_keys(self._charm._stored.etcd_jwt_key)
 
         # update configurations and restart
         self._setup_environment_file()
         self.restart()
 
+        self._charm._stored.etcd_tls_fingerprint = fingerprint
+        return True
+
     def stop(self):
         """Stop etcd service."""
         logger.debug("## stopping etcd")
@@ -188,6 +520,117 @@ class EtcdOps:
         # some configs can only be applied with the server running
         self.setup_default_roles(root_pass=root_pass, slurmd_pass=slurmd_pass)
 
+    def reset(self) -> None:
+        """Stop etcd and remove its data, e.g. of a cluster this unit must leave."""
+        self.stop()
+        ctxt = self._tuning_context()
+        stale = [Path(ctxt["data_dir"]) / "member"]
+        if ctxt["wal_dir"]:
+            stale.extend(Path(ctxt["wal_dir"]).glob("*"))
+        for path in stale:
+            if path.exists():
+                logger.debug(f"## removing stale etcd data {path}")
+                _remove(path)
+
+    def cluster_id(self) -> str:
+        """Return the ID of the cluster the local etcd member belongs to, if it runs."""
+        try:
+            return str(self._client("", authenticate=False).status()["header"]["cluster_id"])
+        except (Etcd3Exception, requests.exceptions.RequestException, KeyError) as e:
+            logger.debug(f"## could not get the etcd cluster ID: {e}")
+            return ""
+
+    def join(self, initial_cluster: str) -> None:
+        """Join an existing etcd cluster this unit was added to as a member."""
+        logger.debug(f"## joining etcd cluster {initial_cluster}")
+
+        # a new member must start without data from a previous cluster
+        self.reset()
+        self._charm._stored.etcd_initial_cluster = initial_cluster
+        self._charm._stored.etcd_initial_cluster_state = "existing"
+        self.setup_tls()
+        self.start()
+
+    def reconcile_members(self, root_pass: str, desired: Dict[str, str]) -> dict:
+        """Make the etcd cluster membership match the desired members.
+
+        New members are added as learners, so they do not count towards the
+        quorum until they are in sync and promoted. etcd only accepts one
+        learner at a time, so members are added one by one on successive
+        calls. Members that are not desired anymore are removed.
+
+        Args:
+            root_pass: etcd root password.
+            desired: Mapping of member name to peer URL.
+
+        Returns:
+            The resulting membership, mapping member name to peer URL, the
+            client URLs of the started members and the ID of the cluster.
+        """
+        names_by_url = {url: name for name, url in desired.items()}
+        try:
+            client = self._client(root_pass)
+            header = client.status()["header"]
+            local_id = str(header["member_id"])
+
+            for member in client.members():
+                name = member.get("name") or names_by_url.get(member["peerURLs"][0], "")
+                if str(member["ID"]) == local_id:
+                    # never remove ourselves, even if registered with an old name
+                    name = self.member_name
+
+                if name not in desired:
+                    logger.debug(f"## removing etcd member {member}")
+                    client.post(
+                        client.get_url("/cluster/member/remove"), json={"ID": member["ID"]}
+                    )
+                elif member["peerURLs"] != [desired[name]]:
+                    logger.debug(f"## updating etcd member {name} peer URL to {desired[name]}")
+                    client.post(
+                        client.get_url("/cluster/member/update"),
+                        json={"ID": member["ID"], "peerURLs": [desired[name]]},
+                    )
+                elif member.get("isLearner") and member.get("name"):
+                    self._promote_member(client, member)
+
+            members = client.members()
+            current_urls = [url for member in members for url in member["peerURLs"]]
+            missing = [url for url in desired.values() if url not in current_urls]
+            learners = [member for member in members if member.get("isLearner")]
+            if missing and not learners:
+                logger.debug(f"## adding etcd learner {missing[0]}")
+                client.post(
+                    client.get_url("/cluster/member/add"),
+                    json={"peerURLs": [missing[0]], "isLearner": True},
+                )
+                members = client.members()
+        except Etcd3Exception as e:
+            raise EtcdOpsError(f"could not reconcile etcd members: {e.detail_text}")
+
+        return {
+            "members": {
+                names_by_url[member["peerURLs"][0]]: member["peerURLs"][0]
+                for member in members
+                if member["peerURLs"][0] in names_by_url
+            },
+            "client_urls": [
+                url
+                for member in members
+                if member.get("name") and not member.get("isLearner")
+                for url in member.get("clientURLs", [])
+            ],
+            "cluster_id": str(header["cluster_id"]),
+        }
+
+    @staticmethod
+    def _promote_member(client: Etcd3AuthClient, member: dict) -> None:
+        """Promote a learner to a voting member if it caught up with the leader."""
+        try:
+            client.post(client.get_url("/cluster/member/promote"), json={"ID": member["ID"]})
+            logger.debug(f"## promoted etcd learner {member['name']}")
+        except Etcd3Exception as e:
+            logger.debug(f"## etcd learner {member['name']} not ready: {e.detail_text}")
+
     def setup_default_roles(self, root_pass: str, slurmd_pass: str) -> None:
         """Set up default etcd roles.
 
@@ -200,29 +643,46 @@ class EtcdOps:
             - has r permissions for munge/* keys
         """
         logger.debug("## creating default etcd roles/users")
-        cmds = [  # create root account
-            f"etcdctl user add root:{root_pass}",
-            # create root role
-            "etcdctl role add root",
-            "etcdctl user grant-role root root",
-            # create slurmd user
-            f"etcdctl user add slurmd:{slurmd_pass}",
-            # create slurmd role
-            "etcdctl role add slurmd",
-            "etcdctl role grant-permission slurmd readwrite --prefix=true nodes/",
-            # grant slurmd user the slurmd role
-            "etcdctl user grant-role slurmd slurmd",
-            # create munge role
-            "etcdctl role add munge-readers",
-            "etcdctl role grant-permission munge-readers read --prefix=true munge/",
-            # enable auth
-            "etcdctl auth enable",
+
+        def grant(role, perm_type, prefix):
+            return (
+                "/auth/role/grant",
+                {
+                    "name": role,
+                    "perm": {
+                        "permType": perm_type,
+                        "key": _encode(prefix),
+                        "range_end": _encode(_increment_last_byte(prefix)),
+                    },
+                },
+            )
+
+        # each stage only depends on the previous ones, so its requests are
+        # sent concurrently; auth is enabled last
+        stages = [
+            [
+                ("/auth/user/add", {"name": "root", "password": root_pass}),
+                ("/auth/user/add", {"name": "slurmd", "password": slurmd_pass}),
+                ("/auth/role/add", {"name": "root"}),
+                ("/auth/role/add", {"name": "slurmd"}),
+                ("/auth/role/add", {"name": "munge-readers"}),
+            ],
+            [
+                ("/auth/user/grant", {"user": "root", "role": "root"}),
+                ("/auth/user/grant", {"user": "slurmd", "role": "slurmd"}),
+                grant("slurmd", "READWRITE", "nodes/"),
+                grant("munge-readers", "READ", "munge/"),
+            ],
+            [("/auth/enable", {})],
         ]
 
-        for cmd in cmds:
-            cmd_without_password = cmd.split(":")[0]
-            logger.debug(f"## executing command: {cmd_without_password}")
-            subprocess.run(shlex.split(cmd))
+        client = self._client(root_pass, authenticate=False)
+        for stage in stages:
+            responses = client.post_many(stage, return_exceptions=True)
+            for (path, _), response in zip(stage, responses):
+                if isinstance(response, Exception):
+                    detail = getattr(response, "detail_text", response)
+                    logger.warning(f"## etcd {path} failed: {detail}")
 
     def create_new_munge_user(self, root_pass: str, user: str, password: str) -> None:
         """Create new user in etcd with munge-readers role."""
@@ -236,10 +696,71 @@ class EtcdOps:
         cmd = f"etcdctl {auth} user grant-role {user} munge-readers"
         subprocess.run(shlex.split(cmd))
 
-    def _client(self, root_pass: str) -> Etcd3AuthClient:
+    def setup_node_watcher(self, root_pass: str, settings: dict) -> None:
+        """Configure and start the daemon that watches the etcd node keys.
+
+        The daemon is only restarted if its configuration changed.
+        """
+        config = {
+            "protocol": "https" if self._charm._stored.use_tls else "http",
+            "root_pass": root_pass,
+            "state_file": (self._node_watcher_path / "state.json").as_posix(),
+            **settings,
+        }
+        if self._charm._stored.use_tls:
+            config["cert"] = self._tls_crt_path.as_posix()
+            if self._charm._stored.use_tls_ca:
+                config["ca_cert"] = self._tls_ca_crt_path.as_posix()
+        rendered = json.dumps(config, sort_keys=True)
+
+        if not self._node_watcher_path.exists():
+            self._node_watcher_path.mkdir(mode=0o700, parents=True)
+
+        template_dir = Path(__file__).parent / "templates"
+        environment = Environment(loader=FileSystemLoader(template_dir))
+        template = environment.get_template("node-watcher.service.tmpl")
+        unit = template.render(
+            {
+                "charm_dir": self._charm.charm_dir,
+                "python": sys.executable,
+                "config_file": self._node_watcher_config,
+            }
+        )
+        unit_path = Path("/etc/systemd/system/") / self._node_watcher_service
+
+        changed = False
+        if not unit_path.exists() or unit_path.read_text() != unit:
+            atomic_write(unit_path, unit)
+            subprocess.call(["systemctl", "daemon-reload"])
+            changed = True
+        if (
+            not self._node_watcher_config.exists()
+            or self._node_watcher_config.read_text() != rendered
+        ):
+            atomic_write(self._node_watcher_config, rendered, mode=0o600)
+            changed = True
+
+        if changed or not self._is_service_active(self._node_watcher_service):
+            logger.debug("## (re)starting node watcher")
+            subprocess.call(["systemctl", "enable", self._node_watcher_service])
+            subprocess.call(["systemctl", "restart", self._node_watcher_service])
+
+    def stop_node_watcher(self) -> None:
+        """Stop the node watcher, e.g. when this unit is not the leader anymore."""
+        if self._is_service_active(self._node_watcher_service):
+            logger.debug("## stopping node watcher")
+            subprocess.call(["systemctl", "disable", "--now", self._node_watcher_service])
+
+    @staticmethod
+    def _is_service_active(service: str) -> bool:
+        return subprocess.call(["systemctl", "is-active", "--quiet", service]) == 0
+
+    def _client(self, root_pass: str, authenticate: bool = True) -> Etcd3AuthClient:
         """Build an etcd client with the correct protocol.
 
-        Use https if we have TLS certs and HTTP otherwise.
+        Use https if we have TLS certs and HTTP otherwise. Without
+        `authenticate`, the client sends no credentials, e.g. before auth is
+        enabled.
         """
         protocol = "http"
         tls_cert = None
@@ -253,13 +774,14 @@ class EtcdOps:
                 cacert = self._tls_ca_crt_path.as_posix()
         logger.debug(f"## Created new etcd client using {protocol}, {tls_cert} and {cacert}")
         client = Etcd3AuthClient(
-            username="root",
-            password=root_pass,
+            username="root" if authenticate else None,
+            password=root_pass if authenticate else None,
             protocol=protocol,
             ca_cert=cacert,
             cert_cert=tls_cert,
         )
-        client.authenticate()
+        if authenticate:
+            client.authenticate()
         return client
 
     def set_list_of_accounted_nodes(self, root_pass: str, nodes: List[str]) -> None:
@@ -273,3 +795,310 @@ class EtcdOps:
         logger.debug("## Storing munge key on etcd: munge/key")
         client = self._client(root_pass)
         client.put(key="munge/key", value=key)
+
+    def store_cluster_state(self, root_pass: str, munge_key: str, nodes: List[str]) -> None:
+        """Store the munge key and the list of accounted nodes on etcd in one round."""
+        logger.debug(f"## storing on etcd: munge/key, nodes/all_nodes/{nodes}")
+        client = self._client(root_pass)
+        client.put_many({"munge/key": munge_key, "nodes/all_nodes": json.dumps(nodes)})
+
+    def maintenance(self, root_pass: str, force_defrag: bool = False) -> dict:
+        """Compact the key history and defragment the backend database.
+
+        History is compacted up to the current revision. The compaction is
+        applied by etcd in small batches, so it does not block clients. The
+        defragmentation does block the member while it runs, so it is
+        skipped if less than `DEFRAG_MIN_FREE_RATIO` of the database would
+        be freed, unless `force_defrag` is set.
+
+        Returns:
+            Revision compacted to, database sizes before and after, and the
+            time taken in seconds.
+        """
+        logger.debug("## running etcd maintenance")
+        start = time.monotonic()
+        try:
+            client = self._client(root_pass)
+
+            before = client.status()
+            revision = int(before["header"]["revision"])
+            try:
+                client.post(
+                    client.get_url("/kv/compaction"),
+                    json={"revision": revision, "physical": True},
+                )
+            except Etcd3Exception as e:
+                # nothing was written since the last compaction
+                if "compacted" not in str(e.detail_text):
+                    raise
+                logger.debug(f"## etcd already compacted at revision {revision}")
+
+            compacted = client.status()
+            db_size = int(compacted.get("dbSize", 0))
+            in_use = int(compacted.get("dbSizeInUse", db_size))
+            defrag = force_defrag or (
+                db_size and (db_size - in_use) / db_size >= DEFRAG_MIN_FREE_RATIO
+            )
+            if defrag:
+                logger.debug("## defragmenting etcd")
+                client.post(client.get_url("/maintenance/defragment"), json={})
+
+            after = client.status()
+        except Etcd3Exception as e:
+            raise EtcdOpsError(f"etcd maintenance failed: {e.detail_text}")
+
+        result = {
+            "revision": revision,
+            "defragmented": bool(defrag),
+            "db-size-before": int(before.get("dbSize", 0)),
+            "db-size-after": int(after.get("dbSize", 0)),
+            "duration": round(time.monotonic() - start, 3),
+        }
+        logger.debug(f"## etcd maintenance done: {result}")
+        return result
+
+    def benchmark(self, root_pass: str, key_count: int, value_size: int) -> dict:
+        """Measure the latency and throughput of the local etcd member.
+
+        Runs `key_count` puts (sequential and concurrent), gets and
+        transactions with values of `value_size` bytes under the `benchmark/`
+        prefix, measures how long watchers take to be notified of writes, and
+        reports the disk sync histograms from etcd's /metrics endpoint. The
+        keys are deleted afterwards.
+        """
+        prefix = "benchmark/"
+        value = "x" * value_size
+        keys = [f"{prefix}{i:08d}" for i in range(key_count)]
+        results = {}
+
+        try:
+            client = self._client(root_pass)
+
+            def timed(operation):
+                samples = []
+                start = time.monotonic()
+                for key in keys:
+                    t0 = time.monotonic()
+                    operation(key)
+                    samples.append(time.monotonic() - t0)
+                return _latency_summary(samples, time.monotonic() - start)
+
+            def txn(key):
+                encoded_key = base64.b64encode(key.encode()).decode()
+                client.transaction(
+                    {
+                        "compare": [
+                            {
+                                "key": encoded_key,
+                                "result": "GREATER",
+                                "target": "CREATE",
+                                "create_revision": 0,
+                            }
+                        ],
+                        "success": [
+                            {
+                                "request_put": {
+                                    "key": encoded_key,
+                                    "value": base64.b64encode(value.encode()).decode(),
+                                }
+                            }
+                        ],
+                        "failure": [],
+                    }
+                )
+
+            try:
+                results["put"] = timed(lambda key: client.put(key, value))
+                results["put-concurrent"] = self._benchmark_concurrent_puts(client, keys, value)
+                results["get"] = timed(client.get)
+                results["txn"] = timed(txn)
+                results["watch"] = self._benchmark_watch(
+                    client, f"{prefix}watch/", value, key_count
+                )
+            finally:
+                client.delete_prefix(prefix)
+
+        except Etcd3Exception as e:
+            raise EtcdOpsError(f"etcd benchmark failed: {e.detail_text}")
+
+        try:
+            response = client.session.get(
+                f"{client.protocol}://{client.host}:{client.port}/metrics"
+            )
+            response.raise_for_status()
+        except requests.exceptions.RequestException as e:
+            logger.warning(f"## Could not get etcd metrics: {e}")
+            return results
+
+        for metric, result_key in [
+            ("etcd_disk_wal_fsync_duration_seconds", "wal-fsync"),
+            ("etcd_disk_backend_commit_duration_seconds", "backend-commit"),
+        ]:
+            histogram = _parse_histogram(response.text, metric)
+            if histogram:
+                results[result_key] = histogram
+
+        return results
+
+    @staticmethod
+    def _benchmark_concurrent_puts(
+        client: Etcd3AuthClient, keys: List[str], value: str, max_in_flight: int = 8
+    ) -> dict:
+        """Time puts of the keys issued concurrently with `AsyncEtcd3AuthClient`."""
+        samples = []
+
+        async def put(aclient, key):
+            t0 = time.monotonic()
+            await aclient.put(key, value)
+            samples.append(time.monotonic() - t0)
+
+        async def run():
+            async with AsyncEtcd3AuthClient(client, max_in_flight) as aclient:
+                await asyncio.gather(*(put(aclient, key) for key in keys))
+
+        start = time.monotonic()
+        asyncio.run(run())
+        return _latency_summary(samples, time.monotonic() - start)
+
+    @staticmethod
+    def _benchmark_watch(client: Etcd3AuthClient, prefix: str, value: str, count: int) -> dict:
+        """Measure the delay between a write and the watch event for it."""
+        events = queue.Queue()
+        watcher = Watcher(
+            client,
+            prefix,
+            lambda event: events.put(time.monotonic()),
+            range_end=prefix[:-1] + chr(ord(prefix[-1]) + 1),
+        )
+
+        samples = []
+        start = time.monotonic()
+        try:
+            for i in range(count):
+                t0 = time.monotonic()
+                client.put(f"{prefix}{i:08d}", value)
+                try:
+                    samples.append(events.get(timeout=5) - t0)
+                except queue.Empty:
+                    logger.warning("## etcd benchmark: watch event not received")
+                    break
+        finally:
+            watcher.stop()
+
+        return _latency_summary(samples, time.monotonic() - start)
+
+    def snapshot(self, root_pass: str, path: Path) -> dict:
+        """Stream a snapshot of the etcd database to a gzip compressed file.
+
+        The snapshot is written chunk by chunk as it is received, so it is
+        never held in memory. etcd appends a sha256 of the database to the
+        snapshot, which is verified before the file is kept.
+
+        Returns:
+            The path and sha256 of the uncompressed snapshot, and its size.
+        """
+        logger.debug(f"## saving etcd snapshot to {path}")
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(f".{path.name}.tmp")
+
+        file_digest = hashlib.sha256()
+        db_digest = hashlib.sha256()
+        tail = b""
+        size = 0
+        try:
+            client = self._client(root_pass)
+            response = client.session.post(
+                client.get_url("/maintenance/snapshot"), json={}, stream=True
+            )
+            if response.status_code != requests.codes["ok"]:
+                raise EtcdOpsError(f"etcd snapshot failed: {response.text}")
+
+            with gzip.open(tmp, "wb") as f:
+                for line in response.iter_lines():
+                    if not line:
+                        continue
+                    message = json.loads(line)
+                    if "error" in message:
+                        raise EtcdOpsError(f"etcd snapshot failed: {message['error']}")
+
+                    chunk = base64.b64decode(message["result"].get("blob", ""))
+                    f.write(chunk)
+                    file_digest.update(chunk)
+                    size += len(chunk)
+
+                    # the last 32 bytes are the sha256 of everything before
+                    tail += chunk
+                    db_digest.update(tail[:-32])
+                    tail = tail[-32:]
+        except (Etcd3Exception, requests.exceptions.RequestException) as e:
+            tmp.unlink(missing_ok=True)
+            raise EtcdOpsError(f"etcd snapshot failed: {e}")
+        except EtcdOpsError:
+            tmp.unlink(missing_ok=True)
+            raise
+
+        if db_digest.digest() != tail:
+            tmp.unlink(missing_ok=True)
+            raise EtcdOpsError("etcd snapshot is corrupted: hash mismatch")
+
+        tmp.chmod(0o600)
+        os.replace(tmp, path)
+
+        result = {"path": path.as_posix(), "sha256": file_digest.hexdigest(), "size": size}
+        logger.debug(f"## etcd snapshot saved: {result}")
+        return result
+
+    def restore(self, path: Path, sha256: str = "") -> None:
+        """Replace the local etcd data with a snapshot taken with `snapshot`.
+
+        The restored member forms a new single member cluster. Any other
+        member must rejoin it.
+        """
+        logger.debug(f"## restoring etcd snapshot {path}")
+        tuning = self._tuning_context()
+        cluster = self._cluster_context("")
+        data_dir = Path(tuning["data_dir"])
+
+        with TemporaryDirectory(prefix="omni", dir=data_dir.parent) as tmp_dir:
+            db = Path(tmp_dir) / "snapshot.db"
+            digest = hashlib.sha256()
+            with gzip.open(path, "rb") as src, open(db, "wb") as dst:
+                for chunk in iter(lambda: src.read(1 << 20), b""):
+                    digest.update(chunk)
+                    dst.write(chunk)
+            if sha256 and digest.hexdigest() != sha256:
+                raise EtcdOpsError(f"etcd snapshot {path} does not match sha256 {sha256}")
+
+            restored = Path(tmp_dir) / "restored"
+            cmd = [
+                self._bin_dir / "etcdutl",
+                "snapshot",
+                "restore",
+                db,
+                f"--data-dir={restored}",
+                f"--name={cluster['name']}",
+                f"--initial-cluster={cluster['name']}={cluster['peer_url']}",
+                f"--initial-advertise-peer-urls={cluster['peer_url']}",
+            ]
+            if tuning["wal_dir"]:
+                cmd.append(f"--wal-dir={restored / 'wal'}")
+            try:
+                subprocess.check_output(cmd, stderr=subprocess.STDOUT)
+            except subprocess.CalledProcessError as e:
+                raise EtcdOpsError(f"etcd snapshot restore failed: {e.output.decode()}")
+
+            self.stop()
+            shutil.rmtree(data_dir / "member", ignore_errors=True)
+            shutil.move(restored / "member", data_dir / "member")
+            if tuning["wal_dir"]:
+                wal_dir = Path(tuning["wal_dir"])
+                for stale in wal_dir.glob("*"):
+                    _remove(stale)
+                for wal in (restored / "wal").glob("*"):
+                    shutil.move(wal, wal_dir / wal.name)
+                subprocess.call(["chown", "-R", f"{self._etcd_user}:{self._etcd_group}", wal_dir])
+            subprocess.call(
+                ["chown", "-R", f"{self._etcd_user}:{self._etcd_group}", data_dir / "member"]
+            )
+
+        self.start()
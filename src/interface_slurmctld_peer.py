@@ -1,14 +1,21 @@
 #!/usr/bin/env python3
 """SlurmctldPeer."""
-import copy
 import json
 import logging
-import subprocess
+import os
+from typing import List
 
 from ops.framework import EventBase, EventSource, Object, ObjectEvents
 
 logger = logging.getLogger()
 
+# the unit data a peer needs to be a backup controller, by slurmctld_info key
+BACKUP_CONTROLLER_KEYS = {
+    "ingress_address": "ingress-address",
+    "hostname": "hostname",
+    "port": "port",
+}
+
 
 class SlurmctldPeerAvailableEvent(EventBase):
     """Emitted when a slurmctld peer is available."""
@@ -18,11 +25,16 @@ class SlurmctldPeerUnavailableEvent(EventBase):
     """Emitted when the slurmctld peer departs the relation."""
 
 
+class EtcdClusterChangedEvent(EventBase):
+    """Emitted when the peers or the etcd cluster membership change."""
+
+
 class SlurmctldPeerRelationEvents(ObjectEvents):
     """Slurmctld peer relation events."""
 
     slurmctld_peer_available = EventSource(SlurmctldPeerAvailableEvent)
     slurmctld_peer_unavailable = EventSource(SlurmctldPeerUnavailableEvent)
+    etcd_cluster_changed = EventSource(EtcdClusterChangedEvent)
 
 
 class SlurmctldPeer(Object):
@@ -35,6 +47,9 @@ class SlurmctldPeer(Object):
         super().__init__(charm, relation_name)
         self._charm = charm
         self._relation_name = relation_name
+        # the peers cannot change during a dispatch, so look them up once
+        self._active_peers = None
+        self._active_peers_context = None
 
         self.framework.observe(
             self._charm.on[self._relation_name].relation_created,
@@ -69,92 +84,232 @@ class SlurmctldPeer(Object):
 
     def _on_relation_changed(self, event):
         """Use the leader and app relation data to schedule the controllers."""
+        if self.framework.model.unit.is_leader():
+            self.schedule_controllers()
+        else:
+            # the other units mirror the keys and config published by the
+            # leader, so they are ready to take over
+            self.on.slurmctld_peer_available.emit()
+
+        # every unit runs an etcd member, let the charm reconcile the cluster
+        self.on.etcd_cluster_changed.emit()
+
+    def schedule_controllers(self) -> bool:
+        """Assemble the slurmctld_info and emit slurmctld_peer_available.
+
+        Returns:
+            True if the active or backup controllers changed and the event
+            was emitted.
+        """
         # We only modify the slurmctld controller queue
         # if we are the leader. As such, we don't need to perform
         # any operations if we are not the leader.
-        if self.framework.model.unit.is_leader():
-            relation = self._relation
+        relation = self._relation
+        if not (relation and self.framework.model.unit.is_leader()):
+            return False
 
-            app_relation_data = relation.data[self.model.app]
-            unit_relation_data = relation.data[self.model.unit]
-
-            slurmctld_peers = _get_active_peers()
-            slurmctld_peers_tmp = copy.deepcopy(slurmctld_peers)
-
-            active_controller = app_relation_data.get("active_controller")
-            backup_controller = app_relation_data.get("backup_controller")
-
-            # Account for the active controller
-            # In this case, tightly couple the active controller to the leader.
-            #
-            # If we are the leader but are not the active controller,
-            # then the previous leader or active controller must have died.
-            if active_controller != self.model.unit.name:
-                app_relation_data["active_controller"] = self.model.unit.name
-
-            # Account for the backup and standby controllers
-            #
-            # If the backup controller exists in the application relation data
-            # then check that it also exists in the slurmctld_peers. If it does
-            # exist in the slurmctld peers then remove it from the list of
-            # active peers and set the rest of the peers to be standby
-            # controllers.
-            if backup_controller:
-                # Just because the backup_controller exists in the application
-                # data doesn't mean that it really exists. Check that the
-                # backup_controller that we have in the application data still
-                # exists in the list of active units. If the backup_controller
-                # isn't in the list of active units then check for
-                # slurmctld_peers > 0 and try to promote a standby to a backup.
-                if backup_controller in slurmctld_peers:
-                    slurmctld_peers_tmp.remove(backup_controller)
-                    app_relation_data["standby_controllers"] = json.dumps(slurmctld_peers_tmp)
-                else:
-                    if len(slurmctld_peers) > 0:
-                        app_relation_data["backup_controller"] = slurmctld_peers_tmp.pop()
-                        app_relation_data["standby_controllers"] = json.dumps(slurmctld_peers_tmp)
-                    else:
-                        app_relation_data["backup_controller"] = ""
-                        app_relation_data["standby_controllers"] = json.dumps([])
-            else:
-                if len(slurmctld_peers) > 0:
-                    app_relation_data["backup_controller"] = slurmctld_peers_tmp.pop()
-                    app_relation_data["standby_controllers"] = json.dumps(slurmctld_peers_tmp)
-                else:
-                    app_relation_data["standby_controllers"] = json.dumps([])
-
-            ctxt = {}
-            backup_controller = app_relation_data.get("backup_controller")
-
-            # NOTE: We only care about the active and backup controllers.
-            # Set the active controller info and check for and set the
-            # backup controller information if one exists.
-            ctxt["active_controller_ingress_address"] = unit_relation_data["ingress-address"]
-            ctxt["active_controller_hostname"] = self._charm.hostname
-            ctxt["active_controller_port"] = str(self._charm.port)
-
-            # If we have > 0 controllers (also have a backup), iterate over
-            # them retrieving the info for the backup and set it along with
-            # the info for the active controller, then emit the
-            # 'slurmctld_peer_available' event.
-            if backup_controller:
-                for unit in relation.units:
-                    if unit.name == backup_controller:
-                        unit_data = relation.data[unit]
-                        ctxt["backup_controller_ingress_address"] = unit_data["ingress-address"]
-                        ctxt["backup_controller_hostname"] = unit_data["hostname"]
-                        ctxt["backup_controller_port"] = unit_data["port"]
-            else:
-                ctxt["backup_controller_ingress_address"] = ""
-                ctxt["backup_controller_hostname"] = ""
-                ctxt["backup_controller_port"] = ""
-
-            app_relation_data["slurmctld_info"] = json.dumps(ctxt)
-            self.on.slurmctld_peer_available.emit()
+        app_relation_data = relation.data[self.model.app]
+        unit_relation_data = relation.data[self.model.unit]
+
+        slurmctld_peers = self._get_active_peers()
+        max_backups = max(0, self._charm.config.get("backup-controllers"))
+
+        # Account for the active controller
+        # In this case, tightly couple the active controller to the leader.
+        #
+        # If we are the leader but are not the active controller,
+        # then the previous leader or active controller must have died.
+        active_controller = self.model.unit.name
+
+        # Account for the backup and standby controllers
+        #
+        # Slurm fails over through the backups in order, so keep the backups
+        # that still exist in their current order and fill the free slots
+        # with standbys, lowest unit number first. The remaining peers are
+        # standby controllers, as are the peers that did not publish their
+        # address yet.
+        units = {unit.name: unit for unit in relation.units}
+        ready_peers = [
+            unit
+            for unit in slurmctld_peers
+            if all(relation.data[units[unit]].get(key) for key in BACKUP_CONTROLLER_KEYS.values())
+        ]
+        backup_controllers = [
+            unit
+            for unit in json.loads(app_relation_data.get("backup_controllers", "[]"))
+            if unit in ready_peers
+        ]
+        for unit in ready_peers:
+            if unit not in backup_controllers:
+                backup_controllers.append(unit)
+        backup_controllers = backup_controllers[:max_backups]
+        standby_controllers = [unit for unit in slurmctld_peers if unit not in backup_controllers]
+
+        ctxt = {}
+
+        # Set the active controller info and the info of every backup
+        # controller, in failover order.
+        ctxt["active_controller_ingress_address"] = unit_relation_data["ingress-address"]
+        ctxt["active_controller_hostname"] = self._charm.hostname
+        ctxt["active_controller_port"] = str(self._charm.port)
+
+        ctxt["backup_controllers"] = []
+        for name in backup_controllers:
+            unit_data = relation.data[units[name]]
+            ctxt["backup_controllers"].append(
+                {key: unit_data.get(data_key) for key, data_key in BACKUP_CONTROLLER_KEYS.items()}
+            )
+
+        # the first backup is also set on its own, for slurm.conf templates
+        # that know about a single backup controller
+        first_backup = ctxt["backup_controllers"][0] if backup_controllers else {}
+        ctxt["backup_controller_ingress_address"] = first_backup.get("ingress_address", "")
+        ctxt["backup_controller_hostname"] = first_backup.get("hostname", "")
+        ctxt["backup_controller_port"] = first_backup.get("port", "")
+
+        # Only write what changed, and only emit 'slurmctld_peer_available'
+        # (which rewrites slurm.conf and restarts slurmctld) when the
+        # identity or address of the active or backup controllers changed.
+        _update(app_relation_data, "active_controller", active_controller)
+        _update(app_relation_data, "backup_controller", "".join(backup_controllers[:1]))
+        _update(app_relation_data, "backup_controllers", json.dumps(backup_controllers))
+        _update(app_relation_data, "standby_controllers", json.dumps(standby_controllers))
+
+        stored_info = app_relation_data.get("slurmctld_info")
+        if stored_info and json.loads(stored_info) == ctxt:
+            logger.debug("## slurmctld_info unchanged")
+            return False
+
+        app_relation_data["slurmctld_info"] = json.dumps(ctxt, sort_keys=True)
+        self.on.slurmctld_peer_available.emit()
+        return True
 
     def _on_relation_departed(self, event):
         self._on_relation_changed(event)
-        self.on.slurmctld_peer_available.emit()
+
+    @property
+    def ingress_address(self):
+        """Return the ingress address of this unit on the peer relation."""
+        relation = self._relation
+        if relation:
+            return relation.data[self.model.unit].get("ingress-address")
+        return None
+
+    def set_etcd_ready(self):
+        """Tell the leader this unit has etcd installed and can join the cluster."""
+        relation = self._relation
+        if relation:
+            relation.data[self.model.unit]["etcd_ready"] = "true"
+
+    def get_etcd_peers(self) -> dict:
+        """Return the ingress address of the units that can run an etcd member.
+
+        This unit is always included.
+        """
+        relation = self._relation
+        if not relation:
+            return {}
+
+        peers = {self.model.unit.name: self.ingress_address}
+        for unit in relation.units:
+            unit_data = relation.data[unit]
+            if unit_data.get("etcd_ready") == "true" and unit_data.get("ingress-address"):
+                peers[unit.name] = unit_data["ingress-address"]
+        return peers
+
+    def set_etcd_cluster(self, cluster: dict, root_pass: str, slurmd_pass: str, jwt_key: str):
+        """Publish the etcd cluster membership and credentials to the peers."""
+        relation = self._relation
+        if relation and self.framework.model.unit.is_leader():
+            app_relation_data = relation.data[self.model.app]
+            app_relation_data["etcd_cluster"] = json.dumps(cluster)
+            app_relation_data["etcd_root_pass"] = root_pass
+            app_relation_data["etcd_slurmd_pass"] = slurmd_pass
+            app_relation_data["etcd_jwt_key"] = jwt_key
+
+    def get_etcd_cluster(self) -> dict:
+        """Return the etcd cluster membership and credentials set by the leader."""
+        relation = self._relation
+        if relation:
+            app_data = relation.data[self.model.app]
+            cluster = app_data.get("etcd_cluster")
+            if cluster:
+                return {
+                    **json.loads(cluster),
+                    "root_pass": app_data.get("etcd_root_pass", ""),
+                    "slurmd_pass": app_data.get("etcd_slurmd_pass", ""),
+                    "jwt_key": app_data.get("etcd_jwt_key", ""),
+                }
+        return {}
+
+    def _get_active_peers(self) -> List[str]:
+        """Return the names of the other units on the peer relation.
+
+        The names are sorted by unit number, so every unit agrees on which
+        peer is promoted next.
+        """
+        context = os.environ.get("JUJU_CONTEXT_ID")
+        if self._active_peers is None or not context or context != self._active_peers_context:
+            self._active_peers_context = context
+            relation = self._relation
+            units = relation.units if relation else []
+            self._active_peers = sorted(
+                (unit.name for unit in units), key=lambda name: int(name.split("/")[-1])
+            )
+        return list(self._active_peers)
+
+    def get_peer_addresses(self) -> List[str]:
+        """Return the ingress address of the other units on the peer relation."""
+        relation = self._relation
+        if not relation:
+            return []
+
+        addresses = [relation.data[unit].get("ingress-address") for unit in relation.units]
+        return [address for address in addresses if address]
+
+    def get_backup_controllers(self) -> List[str]:
+        """Return the names of the backup controllers, in failover order."""
+        relation = self._relation
+        if relation:
+            return json.loads(relation.data[self.model.app].get("backup_controllers", "[]"))
+        return []
+
+    def set_controller_keys(self, munge_key: str, jwt_rsa: str, state_sync_secret: str):
+        """Publish the keys every controller needs to the peers."""
+        relation = self._relation
+        if relation and self.framework.model.unit.is_leader():
+            app_relation_data = relation.data[self.model.app]
+            _update(app_relation_data, "munge_key", munge_key)
+            _update(app_relation_data, "jwt_rsa", jwt_rsa)
+            _update(app_relation_data, "state_sync_secret", state_sync_secret)
+
+    def set_job_table_sizing(self, sizing: dict):
+        """Publish the job table sizing of the leader to the peers."""
+        relation = self._relation
+        if relation and self.framework.model.unit.is_leader():
+            _update(
+                relation.data[self.model.app],
+                "job_table_sizing",
+                json.dumps(sizing, sort_keys=True),
+            )
+
+    def get_job_table_sizing(self) -> dict:
+        """Return the job table sizing published by the leader."""
+        relation = self._relation
+        if relation:
+            return json.loads(relation.data[self.model.app].get("job_table_sizing", "{}"))
+        return {}
+
+    def get_controller_keys(self) -> dict:
+        """Return the keys published by the leader."""
+        relation = self._relation
+        if not relation:
+            return {}
+
+        app_data = relation.data[self.model.app]
+        return {
+            key: app_data.get(key, "") for key in ["munge_key", "jwt_rsa", "state_sync_secret"]
+        }
 
     def get_slurmctld_info(self):
         """Return slurmctld info."""
@@ -170,22 +325,7 @@ class SlurmctldPeer(Object):
         return None
 
 
-def _related_units(relid):
-    """List of related units."""
-    units_cmd_line = ["relation-list", "--format=json", "-r", relid]
-    return json.loads(subprocess.check_output(units_cmd_line).decode("UTF-8")) or []
-
-
-def _relation_ids(reltype):
-    """List of relation_ids."""
-    relid_cmd_line = ["relation-ids", "--format=json", reltype]
-    return json.loads(subprocess.check_output(relid_cmd_line).decode("UTF-8")) or []
-
-
-def _get_active_peers():
-    """Return the active_units."""
-    active_units = []
-    for rel_id in _relation_ids("slurmctld-peer"):
-        for unit in _related_units(rel_id):
-            active_units.append(unit)
-    return active_units
+def _update(data, key: str, value: str) -> None:
+    """Set a relation data key, unless it already has that value."""
+    if data.get(key) != value:
+        data[key] = value
@@ -4,6 +4,7 @@ import copy
 import json
 import logging
 
+from node_watcher import HEARTBEAT_PREFIX, REQUESTS_PREFIX
 from ops.framework import EventBase, EventSource, Object, ObjectEvents, StoredState
 
 logger = logging.getLogger()
@@ -81,6 +82,9 @@ class Slurmd(Object):
         app_relation_data["slurmctld_host"] = self._charm.hostname
         app_relation_data["slurmctld_port"] = self._charm.port
         app_relation_data["etcd_port"] = "2379"
+        etcd_endpoints = self._charm.etcd_endpoints
+        if etcd_endpoints:
+            app_relation_data["etcd_endpoints"] = ",".join(etcd_endpoints)
 
         app_relation_data["cluster_name"] = self._charm.config.get("cluster-name")
 
@@ -88,6 +92,10 @@ class Slurmd(Object):
 
         app_relation_data["etcd_slurmd_pass"] = self._charm.etcd_slurmd_password
 
+        app_relation_data["node_heartbeat_prefix"] = HEARTBEAT_PREFIX
+        app_relation_data["node_requests_prefix"] = REQUESTS_PREFIX
+        app_relation_data["node_heartbeat_ttl"] = str(self._charm.config.get("node-heartbeat-ttl"))
+
         app_relation_data["tls_cert"] = self._charm.model.config["tls-cert"]
         app_relation_data["ca_cert"] = self._charm.model.config["tls-ca-cert"]
 
@@ -179,6 +187,29 @@ class Slurmd(Object):
         else:
             logger.debug("## slurmd not joined")
 
+    def set_node_heartbeat_ttl(self, ttl: int):
+        """Send the TTL of the etcd heartbeat leases to all slurmd."""
+        if self.is_joined:
+            relations = self._charm.framework.model.relations.get(self._relation_name)
+            for relation in relations:
+                relation.data[self.model.app]["node_heartbeat_prefix"] = HEARTBEAT_PREFIX
+                relation.data[self.model.app]["node_requests_prefix"] = REQUESTS_PREFIX
+                relation.data[self.model.app]["node_heartbeat_ttl"] = str(ttl)
+
+    def set_etcd_endpoints(self, client_urls: list):
+        """Send the client URLs of all etcd members to all slurmd."""
+        if self.is_joined and client_urls:
+            relations = self._charm.framework.model.relations.get(self._relation_name)
+            for relation in relations:
+                relation.data[self.model.app]["etcd_endpoints"] = ",".join(client_urls)
+
+    def set_etcd_slurmd_pass(self, password: str):
+        """Send the password of the etcd slurmd account to all slurmd."""
+        if self.is_joined and password:
+            relations = self._charm.framework.model.relations.get(self._relation_name)
+            for relation in relations:
+                relation.data[self.model.app]["etcd_slurmd_pass"] = password
+
     def set_tls_settings(self):
         """Send TLS settings to all slurmd."""
         tls_cert = self._charm.model.config["tls-cert"]
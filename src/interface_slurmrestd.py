@@ -1,13 +1,95 @@
 #!/usr/bin/env python3
 """SlurmrestdProvides."""
+import base64
+import gzip
+import hashlib
 import json
 import logging
-import uuid
 
 from ops.framework import EventBase, EventSource, Object, ObjectEvents
 
 logger = logging.getLogger()
 
+# read-only endpoints slurmrestd may serve from its cache, by the paths of
+# their collection and items
+CACHEABLE_ENDPOINTS = {
+    "jobs": r"^/slurm/v[0-9.]+/(jobs|job/[^/]+)$",
+    "nodes": r"^/slurm/v[0-9.]+/(nodes|node/[^/]+)$",
+    "partitions": r"^/slurm/v[0-9.]+/(partitions|partition/[^/]+)$",
+}
+
+# slurm_config is sent in sections, so a change to the nodes does not resend
+# the rest of the config. Keys not listed here go in the `config` section.
+# Until slurmrestd lists this version in the `slurm_config_versions` of its
+# application data, the plain JSON of the first version is sent as well.
+SLURM_CONFIG_VERSION = "2"
+SLURM_CONFIG_SECTIONS = {
+    "nodes": ["partitions", "down_nodes"],
+}
+
+# slurmrestd reads the controllers, auth and cluster settings from slurm.conf,
+# but queries slurmctld for the nodes, so it only restarts when these change
+RESTART_KEYS = ["slurm_config_config", "munge_key", "jwt_rsa"]
+# settings of custom_config derived from the number of nodes, which
+# slurmrestd does not use, so growing the cluster does not restart it
+RESTART_IGNORED_SETTINGS = ["TreeWidth", "SlurmdTimeout"]
+RESTART_MODES = ["restart", "reload-or-restart"]
+
+
+def _canonical_json(data) -> bytes:
+    return json.dumps(data, sort_keys=True, separators=(",", ":")).encode()
+
+
+def encode_slurm_config(slurm_config: dict) -> dict:
+    """Return the relation data for the slurm_config.
+
+    Each section is sent as gzip compressed, base64 encoded JSON under
+    `slurm_config_<section>`, along with the sha256 of the whole config in
+    `slurm_config_hash` and the format in `slurm_config_version`.
+    """
+    sections = {section: {} for section in SLURM_CONFIG_SECTIONS}
+    sections["config"] = {}
+    for key, value in slurm_config.items():
+        section = next((s for s, keys in SLURM_CONFIG_SECTIONS.items() if key in keys), "config")
+        sections[section][key] = value
+
+    data = {
+        "slurm_config_version": SLURM_CONFIG_VERSION,
+        "slurm_config_hash": hashlib.sha256(_canonical_json(slurm_config)).hexdigest(),
+    }
+    for section, content in sections.items():
+        # no timestamp in the gzip header, so the same config encodes the same
+        compressed = gzip.compress(_canonical_json(content), mtime=0)
+        data[f"slurm_config_{section}"] = base64.b64encode(compressed).decode()
+    return data
+
+
+def decode_slurm_config(data: dict) -> dict:
+    """Return the slurm_config from the relation data set by `encode_slurm_config`."""
+    slurm_config = {}
+    for section in [*SLURM_CONFIG_SECTIONS, "config"]:
+        compressed = base64.b64decode(data[f"slurm_config_{section}"])
+        slurm_config.update(json.loads(gzip.decompress(compressed)))
+    return slurm_config
+
+
+def _restart_digest(app_relation_data) -> str:
+    """Return the digest of the data slurmrestd uses."""
+    values = []
+    for key in RESTART_KEYS:
+        value = app_relation_data.get(key, "")
+        if key == "slurm_config_config" and value:
+            config = json.loads(gzip.decompress(base64.b64decode(value)))
+            if config.get("custom_config"):
+                config["custom_config"] = "\n".join(
+                    line
+                    for line in config["custom_config"].splitlines()
+                    if line.partition("=")[0].strip() not in RESTART_IGNORED_SETTINGS
+                )
+            value = _canonical_json(config).decode()
+        values.append(value)
+    return hashlib.sha256("\n".join(values).encode()).hexdigest()
+
 
 class SlurmrestdAvailableEvent(EventBase):
     """Emitted when slurmrestd is available."""
@@ -75,21 +157,130 @@ class Slurmrestd(Object):
         self._charm.set_slurmrestd_available(False)
         self.on.slurmrestd_unavailable.emit()
 
-    def set_slurm_config_on_app_relation_data(self, slurm_config):
+    def set_slurm_config_on_app_relation_data(self, slurm_config) -> bool:
         """Set the slurm_conifg to the app data on the relation.
 
         Setting data on the relation forces the units of related applications
         to observe the relation-changed event so they can acquire and
-        render the updated slurm_config.
+        render the updated slurm_config. Nothing is written when the hash of
+        the config is unchanged, and only the changed sections otherwise.
+
+        Returns:
+            True if the slurm_config changed on any relation.
         """
+        data = encode_slurm_config(slurm_config)
+        changed = False
+
         relations = self._charm.framework.model.relations.get(self._relation_name)
         for relation in relations:
             app_relation_data = relation.data[self.model.app]
-            app_relation_data["slurm_config"] = json.dumps(slurm_config)
+            legacy = SLURM_CONFIG_VERSION not in self._slurm_config_versions(relation)
+            if (
+                app_relation_data.get("slurm_config_hash") == data["slurm_config_hash"]
+                and ("slurm_config" in app_relation_data) == legacy
+            ):
+                continue
+
+            logger.debug(f"## sending slurm_config {data['slurm_config_hash']} to {relation.app}")
+            # the plain JSON of the first version of the format
+            if legacy:
+                app_relation_data["slurm_config"] = json.dumps(slurm_config)
+            elif "slurm_config" in app_relation_data:
+                del app_relation_data["slurm_config"]
+            for key, value in data.items():
+                if app_relation_data.get(key) != value:
+                    app_relation_data[key] = value
+            changed = True
+        return changed
+
+    @staticmethod
+    def _slurm_config_versions(relation) -> set:
+        """Return the slurm_config format versions slurmrestd supports."""
+        if not relation.app:
+            return set()
+        versions = relation.data[relation.app].get("slurm_config_versions", "")
+        return {version.strip() for version in versions.split(",")}
+
+    def cache_ttls(self) -> dict:
+        """Return the cache TTL in seconds of each endpoint, from `endpoint=ttl,...`."""
+        ttls = {}
+        for item in filter(None, self._charm.config.get("slurmrestd-cache-ttls").split(",")):
+            endpoint, _, ttl = item.strip().partition("=")
+            ttls[endpoint.strip()] = ttl.strip()
+        return ttls
+
+    def check_config(self) -> str:
+        """Validate the slurmrestd cache options.
+
+        The options only apply to a related slurmrestd, so they are not
+        checked without a slurmrestd relation.
+
+        Returns:
+            A message describing the first invalid option, or an empty
+            string if the configuration is valid.
+        """
+        if not self._charm.framework.model.relations.get(self._relation_name):
+            return ""
+
+        for endpoint, ttl in self.cache_ttls().items():
+            if endpoint not in CACHEABLE_ENDPOINTS:
+                return (
+                    f"slurmrestd-cache-ttls: {endpoint} is not one of "
+                    f"{', '.join(CACHEABLE_ENDPOINTS)}"
+                )
+            if not ttl.isdigit() or int(ttl) == 0:
+                return f"slurmrestd-cache-ttls: the TTL of {endpoint} must be a positive number"
+
+        if self._charm.config.get("slurmrestd-restart-mode") not in RESTART_MODES:
+            return f"slurmrestd-restart-mode must be one of {', '.join(RESTART_MODES)}"
+        return ""
+
+    def set_cache_config_on_app_relation_data(self):
+        """Set the configuration of the slurmrestd response cache.
+
+        slurmrestd serves GET requests to the configured endpoints from a
+        cache for their TTL, answers `If-None-Match` with the ETag of the
+        cached response, and coalesces identical concurrent requests into a
+        single query to slurmctld. The data is only updated if it changed,
+        so the units of slurmrestd are not woken up for nothing.
+        """
+        ttls = self.cache_ttls()
+        cache_config = ""
+        if ttls and not self.check_config():
+            cache_config = json.dumps(
+                {
+                    "methods": ["GET", "HEAD"],
+                    "etag": True,
+                    "coalesce": self._charm.config.get("slurmrestd-cache-coalesce"),
+                    "endpoints": {
+                        endpoint: {"path": CACHEABLE_ENDPOINTS[endpoint], "ttl": int(ttl)}
+                        for endpoint, ttl in ttls.items()
+                    },
+                },
+                sort_keys=True,
+            )
+
+        relations = self._charm.framework.model.relations.get(self._relation_name)
+        for relation in relations:
+            app_relation_data = relation.data[self.model.app]
+            if app_relation_data.get("cache_config", "") != cache_config:
+                app_relation_data["cache_config"] = cache_config
 
     def restart_slurmrestd(self):
-        """Send a restart signal to related slurmd applications."""
+        """Send a restart signal to related slurmrestd applications.
+
+        The signal is a digest of the data slurmrestd uses, so slurmrestd
+        only restarts when that data changed. `restart_slurmrestd_mode` is
+        sent along for slurmrestd charms that can reload instead.
+        """
+        mode = self._charm.config.get("slurmrestd-restart-mode")
         relations = self._charm.framework.model.relations.get(self._relation_name)
         for relation in relations:
             app_relation_data = relation.data[self.model.app]
-            app_relation_data["restart_slurmrestd_uuid"] = str(uuid.uuid4())
+            digest = _restart_digest(app_relation_data)
+            # the key name predates the digest, slurmrestd only compares it
+            if app_relation_data.get("restart_slurmrestd_uuid") != digest:
+                logger.debug(f"## restarting slurmrestd of {relation.app}, {mode}")
+                app_relation_data["restart_slurmrestd_uuid"] = digest
+            if app_relation_data.get("restart_slurmrestd_mode") != mode:
+                app_relation_data["restart_slurmrestd_mode"] = mode
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""MetricsOps."""
+import json
+import logging
+import sys
+from pathlib import Path
+
+from systemd_ops import SystemdOps
+
+logger = logging.getLogger()
+
+
+class MetricsOps:
+    """Run the daemons that export the slurmctld statistics."""
+
+    def __init__(self, charm):
+        """Initialize class."""
+        self._charm = charm
+
+        self._path = Path("/etc/slurmctld-metrics")
+        self._systemd = SystemdOps(self._path)
+
+        self._sdiag_collector_config = self._path / "sdiag-collector.json"
+        self._sdiag_collector_service = "slurmctld-sdiag-collector.service"
+        self._prometheus_exporter_config = self._path / "prometheus-exporter.json"
+        self._prometheus_exporter_service = "slurmctld-prometheus-exporter.service"
+
+    def check_config(self) -> str:
+        """Return an error message if the metrics settings are invalid."""
+        config = self._charm.model.config
+        if not 0 <= config.get("prometheus-exporter-port") <= 65535:
+            return "prometheus-exporter-port must be between 0 and 65535"
+        if config.get("prometheus-exporter-interval") < 1:
+            return "prometheus-exporter-interval must be at least 1"
+        return ""
+
+    def setup_sdiag_collector(self, influxdb_info: dict, interval: int) -> None:
+        """Write the `sdiag` statistics to InfluxDB every interval seconds.
+
+        The daemon is only restarted if its configuration changed.
+        """
+        config = {
+            **influxdb_info,
+            "interval": interval,
+            "cluster": self._charm.cluster_name,
+            "host": self._charm.hostname,
+        }
+        unit = self._systemd.render(
+            "sdiag-collector.service.tmpl",
+            {
+                "charm_dir": self._charm.charm_dir,
+                "python": sys.executable,
+                "config_file": self._sdiag_collector_config,
+            },
+        )
+
+        changed = self._systemd.write(
+            self._sdiag_collector_config, json.dumps(config, sort_keys=True), mode=0o600
+        )
+        changed |= self._systemd.write_unit(self._sdiag_collector_service, unit)
+        self._systemd.start(self._sdiag_collector_service, changed)
+
+    def stop_sdiag_collector(self) -> None:
+        """Stop collecting the `sdiag` statistics."""
+        self._systemd.stop(self._sdiag_collector_service)
+
+    def setup_prometheus_exporter(self, port: int, interval: int) -> None:
+        """Serve snapshots of the Slurm state, taken every interval, on port.
+
+        The daemon is only restarted if its configuration changed.
+        """
+        config = {"port": port, "interval": interval}
+        unit = self._systemd.render(
+            "prometheus-exporter.service.tmpl",
+            {
+                "charm_dir": self._charm.charm_dir,
+                "python": sys.executable,
+                "config_file": self._prometheus_exporter_config,
+            },
+        )
+
+        changed = self._systemd.write(
+            self._prometheus_exporter_config, json.dumps(config, sort_keys=True)
+        )
+        changed |= self._systemd.write_unit(self._prometheus_exporter_service, unit)
+        self._systemd.start(self._prometheus_exporter_service, changed)
+
+    def stop_prometheus_exporter(self) -> None:
+        """Stop the Prometheus exporter."""
+        self._systemd.stop(self._prometheus_exporter_service)
@@ -0,0 +1,326 @@
+#!/usr/bin/env python3
+"""Watch the etcd node keys and apply batched node state changes.
+
+This daemon runs on the leader, managed by `EtcdOps.setup_node_watcher`.
+Every slurmd keeps a heartbeat key under `nodes/heartbeat/` attached to a
+lease with a short TTL. When a node dies, its lease expires and etcd
+deletes the key. The deletions are collected and the nodes are drained in
+batches with a single `scontrol update`, and resumed the same way once
+their heartbeat comes back.
+
+Slurmd units also post state requests under `nodes/requests/<node>`, as
+JSON like `{"state": "resume", "reason": ""}`. They are applied in the same
+batches, one `scontrol update` per state and reason, and the request keys
+are deleted once applied.
+"""
+
+import base64
+import json
+import logging
+import queue
+import re
+import subprocess
+import sys
+import threading
+import time
+from pathlib import Path
+
+from omnietcd3 import Etcd3AuthClient
+
+logger = logging.getLogger("node-watcher")
+
+NODES_PREFIX = "nodes/"
+HEARTBEAT_PREFIX = "nodes/heartbeat/"
+REQUESTS_PREFIX = "nodes/requests/"
+DRAIN_REASON = "etcd heartbeat expired"
+
+# queued when etcd cancels the watch, e.g. because the revision to resume
+# from was compacted
+WATCH_CANCELED = {"canceled": True}
+
+# node names come from keys written by slurmd units, only accept hostnames so
+# they cannot add arguments to `scontrol update`
+NODE_NAME = re.compile(r"^[A-Za-z0-9]([A-Za-z0-9._-]{0,62})$")
+
+# node states slurmd units may request
+REQUEST_STATES = {"down", "drain", "power_down", "power_up", "resume", "undrain"}
+
+
+def hostlist(nodes) -> str:
+    """Return the nodes as a compressed Slurm hostlist, e.g. `node-[1-3]`."""
+    nodes = ",".join(sorted(nodes))
+    try:
+        return subprocess.check_output(["scontrol", "show", "hostlist", nodes]).decode().strip()
+    except (OSError, subprocess.CalledProcessError) as e:
+        logger.warning(f"## Could not compress hostlist: {e}")
+        return nodes
+
+
+def scontrol_update(nodes, state: str, reason: str = "") -> bool:
+    """Set the state of the nodes with a single `scontrol update`."""
+    cmd = ["scontrol", "update", f"nodename={hostlist(nodes)}", f"state={state}"]
+    if reason:
+        cmd.append(f"reason={reason}")
+
+    logger.info(f"## {' '.join(cmd)}")
+    try:
+        subprocess.check_output(cmd, stderr=subprocess.STDOUT)
+        return True
+    except subprocess.CalledProcessError as e:
+        logger.error(f"## scontrol failed: {e.output.decode()}")
+    except OSError as e:
+        logger.error(f"## scontrol failed: {e}")
+    return False
+
+
+def _range_end(prefix: str) -> str:
+    """Return the end of the etcd key range for a prefix."""
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+def _encode(data: str) -> str:
+    return base64.b64encode(data.encode()).decode()
+
+
+class NodeWatcher:
+    """Collect node key events from etcd and apply them in batches."""
+
+    def __init__(self, config: dict):
+        """Initialize class."""
+        self._config = config
+        self._batch_interval = config.get("batch_interval", 5)
+        self._batch_size = config.get("batch_size", 100)
+        self._heartbeat = config.get("heartbeat", True)
+        self._state_file = Path(config["state_file"])
+
+        self._pending_drain = set()
+        self._pending_resume = set()
+        # node -> (state, reason, mod_revision of the request key)
+        self._pending_requests = {}
+
+        # nodes drained by us, so we never resume nodes drained by an admin
+        self._drained = set()
+        if self._state_file.exists():
+            self._drained = set(json.loads(self._state_file.read_text()))
+
+        self._client = Etcd3AuthClient(
+            username="root",
+            password=config["root_pass"],
+            protocol=config.get("protocol", "http"),
+            ca_cert=config.get("ca_cert"),
+            cert_cert=config.get("cert"),
+        )
+
+    @property
+    def pending(self) -> int:
+        """Return the number of node state changes waiting to be applied."""
+        return len(self._pending_drain) + len(self._pending_resume) + len(self._pending_requests)
+
+    def handle_event(self, event: dict) -> None:
+        """Queue the node state change for an etcd watch event."""
+        key = base64.b64decode(event["kv"]["key"]).decode()
+        prefix, node = key[: key.rfind("/") + 1], key[key.rfind("/") + 1 :]
+        if prefix not in [REQUESTS_PREFIX, HEARTBEAT_PREFIX]:
+            return
+        if not NODE_NAME.match(node):
+            logger.warning(f"## Ignoring {key}: invalid node name")
+            return
+        if prefix == REQUESTS_PREFIX:
+            self._handle_request(node, event)
+            return
+        if not self._heartbeat:
+            return
+
+        if event.get("type") == "DELETE":
+            logger.debug(f"## heartbeat of {node} expired")
+            self._pending_resume.discard(node)
+            self._pending_drain.add(node)
+        elif node in self._drained or node in self._pending_drain:
+            logger.debug(f"## heartbeat of {node} is back")
+            self._pending_drain.discard(node)
+            if node in self._drained:
+                self._pending_resume.add(node)
+
+    def _handle_request(self, node: str, event: dict) -> None:
+        """Queue the state requested by a slurmd unit."""
+        if event.get("type") == "DELETE":
+            return
+
+        try:
+            request = json.loads(base64.b64decode(event["kv"].get("value", "")))
+            state = request["state"].lower()
+            reason = " ".join(str(request.get("reason", "")).split())
+        except (ValueError, TypeError, KeyError, AttributeError):
+            logger.warning(f"## Ignoring malformed request for {node}")
+            return
+
+        if state not in REQUEST_STATES:
+            logger.warning(f"## Ignoring request for {node}: invalid state {state}")
+            return
+
+        logger.debug(f"## {node} requested state {state}")
+        # an explicit request overrides what the heartbeat would do
+        self._pending_drain.discard(node)
+        self._pending_resume.discard(node)
+        self._drained.discard(node)
+        self._pending_requests[node] = (state, reason, int(event["kv"].get("mod_revision", 0)))
+
+    def _apply_requests(self) -> None:
+        """Apply the pending requests, one `scontrol update` per state and reason."""
+        requests, self._pending_requests = self._pending_requests, {}
+
+        batches = {}
+        for node, (state, reason, _) in requests.items():
+            batches.setdefault((state, reason), set()).add(node)
+
+        for (state, reason), nodes in batches.items():
+            if not scontrol_update(nodes, state, reason):
+                # retry with the next batch, unless a newer request came in
+                for node in nodes:
+                    self._pending_requests.setdefault(node, requests[node])
+                continue
+
+            for node in nodes:
+                self._ack(node, requests[node][2])
+
+    def _ack(self, node: str, mod_revision: int) -> None:
+        """Delete an applied request key, unless the node posted a newer one."""
+        key = _encode(REQUESTS_PREFIX + node)
+        txn = {
+            "compare": [
+                {
+                    "key": key,
+                    "result": "EQUAL",
+                    "target": "MOD",
+                    "mod_revision": mod_revision,
+                }
+            ],
+            "success": [{"request_delete_range": {"key": key}}],
+        }
+        try:
+            self._client.transaction(txn)
+        except Exception as e:
+            logger.warning(f"## Could not delete the request of {node}: {e}")
+
+    def flush(self) -> None:
+        """Apply the pending node state changes."""
+        self._apply_requests()
+
+        drain, self._pending_drain = self._pending_drain, set()
+        if drain:
+            if scontrol_update(drain, "drain", DRAIN_REASON):
+                self._drained |= drain
+            else:
+                # retry with the next batch
+                self._pending_drain |= drain
+
+        resume, self._pending_resume = self._pending_resume, set()
+        if resume:
+            if scontrol_update(resume, "resume"):
+                self._drained -= resume
+            else:
+                self._pending_resume |= resume
+
+        self._state_file.write_text(json.dumps(sorted(self._drained)))
+
+    def _watch(self, events: queue.Queue, start_revision: int) -> None:
+        """Stream the watch events for the node keys into the queue."""
+        create_request = {
+            "key": _encode(NODES_PREFIX),
+            "range_end": _encode(_range_end(NODES_PREFIX)),
+        }
+
+        try:
+            self._client.authenticate()
+            if not start_revision:
+                # pick up the requests posted while we were not watching
+                start_revision = self._queue_requests(events) + 1
+            create_request["start_revision"] = start_revision
+
+            response = self._client.session.post(
+                self._client.get_url("/watch"),
+                json={"create_request": create_request},
+                stream=True,
+            )
+            for line in response.iter_lines():
+                if not line:
+                    continue
+                result = json.loads(line).get("result", {})
+                if result.get("canceled"):
+                    logger.warning(
+                        f"## etcd watch canceled at compact revision "
+                        f"{result.get('compact_revision')}: {result.get('cancel_reason', '')}"
+                    )
+                    events.put(WATCH_CANCELED)
+                    break
+                for event in result.get("events", []):
+                    events.put(event)
+        except Exception as e:
+            logger.error(f"## etcd watch failed: {e}")
+        finally:
+            # tell the main loop to reconnect
+            events.put(None)
+
+    def _queue_requests(self, events: queue.Queue) -> int:
+        """Queue the pending request keys and return the current revision."""
+        result = self._client.post(
+            self._client.get_url("/kv/range"),
+            json={
+                "key": _encode(REQUESTS_PREFIX),
+                "range_end": _encode(_range_end(REQUESTS_PREFIX)),
+            },
+        )
+        for kv in result.get("kvs", []):
+            events.put({"type": "PUT", "kv": kv})
+        return int(result["header"]["revision"])
+
+    def _process(self, event: dict, revision: int) -> int:
+        """Handle a queued event and return the revision to resume the watch from."""
+        if event is WATCH_CANCELED:
+            # the missed events are gone, list the requests again and watch
+            # from the current revision
+            return 0
+
+        try:
+            self.handle_event(event)
+        except Exception as e:
+            logger.error(f"## Ignoring etcd event {event}: {e}")
+        return max(revision, int(event["kv"].get("mod_revision", 0)))
+
+    def run(self) -> None:
+        """Watch the node keys forever, applying changes every batch interval."""
+        events = queue.Queue()
+        revision = 0
+        watcher = None
+        next_flush = time.monotonic() + self._batch_interval
+
+        while True:
+            if watcher is None or not watcher.is_alive() and events.empty():
+                watcher = threading.Thread(
+                    target=self._watch, args=(events, revision and revision + 1), daemon=True
+                )
+                watcher.start()
+
+            try:
+                event = events.get(timeout=max(0, next_flush - time.monotonic()))
+                if event is None:
+                    time.sleep(1)
+                else:
+                    revision = self._process(event, revision)
+            except queue.Empty:
+                pass
+
+            if time.monotonic() >= next_flush or self.pending >= self._batch_size:
+                self.flush()
+                next_flush = time.monotonic() + self._batch_interval
+
+
+def main():
+    """Run the node watcher with the configuration file given as argument."""
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s %(message)s")
+    config = json.loads(Path(sys.argv[1]).read_text())
+    NodeWatcher(config).run()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,15 @@
 """Omnivector wrapper for etcd3gw."""
 # heavily copied from Calico project
 
+import asyncio
+import functools
 import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, Optional, Tuple
 
 from etcd3gw.client import Etcd3Client
 from etcd3gw.exceptions import Etcd3Exception
+from etcd3gw.utils import _decode, _encode
 
 logger = logging.getLogger(__name__)
 
@@ -84,3 +89,106 @@ class Etcd3AuthClient(Etcd3Client):
                 return super(Etcd3AuthClient, self).post(*args, **kwargs)
 
             raise
+
+    def post_many(
+        self, requests: Iterable[Tuple[str, dict]], max_in_flight: int = 8, return_exceptions=False
+    ) -> list:
+        """Send (path, payload) requests concurrently and return their responses.
+
+        Blocking facade over `AsyncEtcd3AuthClient` for hook code.
+        """
+
+        async def run():
+            async with AsyncEtcd3AuthClient(self, max_in_flight) as client:
+                return await asyncio.gather(
+                    *(client.post(path, payload) for path, payload in requests),
+                    return_exceptions=return_exceptions,
+                )
+
+        return asyncio.run(run())
+
+    def put_many(self, items: Dict[str, str], max_in_flight: int = 8) -> None:
+        """Put several keys concurrently."""
+        self.post_many(
+            [("/kv/put", {"key": _encode(k), "value": _encode(v)}) for k, v in items.items()],
+            max_in_flight,
+        )
+
+
+class AsyncEtcd3AuthClient:
+    """Issue concurrent etcd requests with the auth of an `Etcd3AuthClient`.
+
+    The requests share the session of the wrapped client and run on a pool of
+    `max_in_flight` threads, so at most that many are in flight at a time.
+    When a token expires, only one request re-authenticates; the others
+    retry with the new token.
+
+    Use it as an async context manager:
+
+        async with AsyncEtcd3AuthClient(client) as aclient:
+            await asyncio.gather(aclient.put("a", "1"), aclient.put("b", "2"))
+    """
+
+    def __init__(self, client: Etcd3AuthClient, max_in_flight: int = 8):
+        """Initialize class."""
+        self._client = client
+        self._max_in_flight = max_in_flight
+        self._executor = None
+        self._semaphore = None
+        self._auth_lock = None
+
+    async def __aenter__(self):
+        """Start the thread pool."""
+        self._executor = ThreadPoolExecutor(max_workers=self._max_in_flight)
+        self._semaphore = asyncio.Semaphore(self._max_in_flight)
+        self._auth_lock = asyncio.Lock()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        """Stop the thread pool."""
+        self._executor.shutdown(wait=True)
+
+    async def _call(self, function, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._executor, functools.partial(function, *args, **kwargs)
+        )
+
+    async def _authenticate(self, stale_token: Optional[str]) -> None:
+        """Authenticate, unless another request already replaced the stale token."""
+        async with self._auth_lock:
+            if self._client.session.headers.get("Authorization") == stale_token:
+                await self._call(self._client.authenticate)
+
+    async def post(self, path: str, payload: dict) -> dict:
+        """Post a request to the etcd gateway, (re)authenticating if needed."""
+        url = self._client.get_url(path)
+        async with self._semaphore:
+            token = self._client.session.headers.get("Authorization")
+            try:
+                return await self._call(Etcd3Client.post, self._client, url, json=payload)
+            except Etcd3Exception as e:
+                if not (self._client.username and self._client.password):
+                    raise
+                logger.info("## etcd: Might need to (re)authenticate: %r:\n%s", e, e.detail_text)
+
+            await self._authenticate(token)
+            return await self._call(Etcd3Client.post, self._client, url, json=payload)
+
+    async def put(self, key: str, value: str) -> dict:
+        """Put a key."""
+        return await self.post("/kv/put", {"key": _encode(key), "value": _encode(value)})
+
+    async def get(self, key: str) -> Optional[str]:
+        """Get the value of a key, or None if it does not exist."""
+        return _value(await self.post("/kv/range", {"key": _encode(key)}))
+
+    async def delete(self, key: str) -> dict:
+        """Delete a key."""
+        return await self.post("/kv/deleterange", {"key": _encode(key)})
+
+
+def _value(response: dict) -> Optional[str]:
+    """Return the decoded value of the first key in a range response."""
+    kvs = response.get("kvs")
+    return _decode(kvs[0].get("value", "")).decode() if kvs else None
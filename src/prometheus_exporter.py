@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+"""Export the Slurm node, partition, job and scheduler state to Prometheus.
+
+This daemon runs on the leader, managed by
+`MetricsOps.setup_prometheus_exporter`. Every interval it takes a snapshot
+with a single `sinfo`, `squeue` and `sdiag` call, and renders it once in the
+Prometheus text format. Scrapes are served from that snapshot in memory and
+never reach slurmctld, so the load on the controller does not depend on the
+number of scrapers or how often they scrape.
+"""
+
+import json
+import logging
+import subprocess
+import sys
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+from slurmctld_ops import parse_sdiag
+
+logger = logging.getLogger("prometheus-exporter")
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# `sinfo --format=%C` reports the CPUs in these states
+CPU_STATES = ["allocated", "idle", "other", "total"]
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _run(cmd: list) -> str:
+    return subprocess.check_output(cmd, stderr=subprocess.STDOUT).decode()
+
+
+class Metrics:
+    """Collect samples and render them in the Prometheus text format."""
+
+    def __init__(self):
+        """Initialize class."""
+        self._metrics = {}
+
+    def add(self, name: str, kind: str, help_text: str, value, labels: dict = None) -> None:
+        """Add a sample to a metric."""
+        metric = self._metrics.setdefault(name, {"kind": kind, "help": help_text, "samples": []})
+        metric["samples"].append((labels or {}, value))
+
+    def render(self) -> bytes:
+        """Render the metrics in the Prometheus text format."""
+        lines = []
+        for name, metric in self._metrics.items():
+            lines.append(f"# HELP {name} {metric['help']}")
+            lines.append(f"# TYPE {name} {metric['kind']}")
+            for labels, value in metric["samples"]:
+                label_text = ",".join(f'{k}="{_escape(v)}"' for k, v in sorted(labels.items()))
+                lines.append(f"{name}{{{label_text}}} {value}" if labels else f"{name} {value}")
+        return ("\n".join(lines) + "\n").encode()
+
+
+def node_metrics(metrics: Metrics, sinfo: str) -> None:
+    """Add the node and partition metrics from `sinfo --Node --format=%N|%P|%T|%C`."""
+    node_states = {}
+    cpus = {}
+    partitions = Counter()
+    for line in sinfo.splitlines():
+        fields = line.strip().split("|")
+        if len(fields) != 4:
+            continue
+        node, partition, state, node_cpus = fields
+        # nodes are listed once per partition
+        node_states[node] = state
+        cpus[node] = [int(cpu) for cpu in node_cpus.split("/")]
+        partitions[partition.rstrip("*"), state] += 1
+
+    for state, count in sorted(Counter(node_states.values()).items()):
+        metrics.add("slurm_nodes", "gauge", "Nodes by state.", count, {"state": state})
+    for (partition, state), count in sorted(partitions.items()):
+        metrics.add(
+            "slurm_partition_nodes",
+            "gauge",
+            "Nodes by partition and state.",
+            count,
+            {"partition": partition, "state": state},
+        )
+    for i, state in enumerate(CPU_STATES):
+        total = sum(node_cpus[i] for node_cpus in cpus.values())
+        metrics.add("slurm_cpus", "gauge", "CPUs by state.", total, {"state": state})
+
+
+def job_metrics(metrics: Metrics, squeue: str) -> None:
+    """Add the job metrics from `squeue --format=%P|%T`."""
+    jobs = Counter(tuple(line.strip().split("|")) for line in squeue.splitlines() if "|" in line)
+    for (partition, state), count in sorted(jobs.items()):
+        metrics.add(
+            "slurm_jobs",
+            "gauge",
+            "Jobs by partition and state.",
+            count,
+            {"partition": partition, "state": state.lower()},
+        )
+
+
+def scheduler_metrics(metrics: Metrics, sdiag: str) -> None:
+    """Add the scheduler and RPC metrics from `sdiag`."""
+    stats = parse_sdiag(sdiag)
+    for name, value in stats.items():
+        if isinstance(value, int):
+            metrics.add(f"slurmctld_{name}", "gauge", f"sdiag {name}.", value)
+
+    for section, label in [("rpc_by_type", "type"), ("rpc_by_user", "user")]:
+        for name, counters in stats[section].items():
+            metrics.add(
+                f"slurmctld_{section}_total",
+                "counter",
+                f"RPCs by {label}, since the last sdiag reset.",
+                counters.get("count", 0),
+                {label: name},
+            )
+            metrics.add(
+                f"slurmctld_{section}_time_microseconds_total",
+                "counter",
+                f"Time spent on the RPCs by {label}, since the last sdiag reset.",
+                counters.get("total_time", 0),
+                {label: name},
+            )
+    for name, count in stats["pending_rpcs"].items():
+        metrics.add(
+            "slurmctld_pending_rpcs", "gauge", "Pending RPCs by type.", count, {"type": name}
+        )
+
+
+class PrometheusExporter:
+    """Take snapshots every interval and serve the latest one."""
+
+    def __init__(self, config: dict):
+        """Initialize class."""
+        self._interval = config.get("interval", 30)
+        self._address = config.get("address", "")
+        self._port = config["port"]
+
+        self._errors = 0
+        self._snapshot = b""
+
+    @property
+    def snapshot(self) -> bytes:
+        """Return the latest snapshot, rendered in the Prometheus text format."""
+        return self._snapshot
+
+    def take_snapshot(self) -> None:
+        """Query Slurm and replace the snapshot.
+
+        A failed query only leaves out its metrics, so the others stay fresh.
+        """
+        start = time.time()
+        metrics = Metrics()
+        sources = [
+            (node_metrics, ["sinfo", "--noheader", "--Node", "--format=%N|%P|%T|%C"]),
+            (job_metrics, ["squeue", "--noheader", "--all", "--format=%P|%T"]),
+            (scheduler_metrics, ["sdiag"]),
+        ]
+        for add_metrics, cmd in sources:
+            try:
+                add_metrics(metrics, _run(cmd))
+            except (OSError, subprocess.CalledProcessError) as e:
+                logger.warning(f"## {cmd[0]} failed: {e}")
+                self._errors += 1
+
+        metrics.add(
+            "slurm_exporter_snapshot_timestamp_seconds",
+            "gauge",
+            "When the snapshot was taken.",
+            round(start, 3),
+        )
+        metrics.add(
+            "slurm_exporter_snapshot_duration_seconds",
+            "gauge",
+            "Time taken to query Slurm for the snapshot.",
+            round(time.time() - start, 3),
+        )
+        metrics.add(
+            "slurm_exporter_errors_total", "counter", "Failed Slurm queries.", self._errors
+        )
+        self._snapshot = metrics.render()
+
+    def _take_snapshots(self) -> None:
+        while True:
+            time.sleep(self._interval)
+            # keep serving the last snapshot rather than stopping the thread
+            try:
+                self.take_snapshot()
+            except Exception as e:
+                logger.error(f"## snapshot failed: {e}")
+                self._errors += 1
+
+    def handler(self):
+        """Return the request handler serving the snapshot."""
+        exporter = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):  # noqa: N802
+                if self.path.split("?")[0] not in ["/", "/metrics"]:
+                    self.send_error(404)
+                    return
+                body = exporter.snapshot
+                self.send_response(200)
+                self.send_header("Content-Type", CONTENT_TYPE)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def run(self) -> None:
+        """Take snapshots in the background and serve them forever."""
+        self.take_snapshot()
+        threading.Thread(target=self._take_snapshots, daemon=True).start()
+
+        server = ThreadingHTTPServer((self._address, self._port), self.handler())
+        logger.info(f"## serving metrics on port {self._port}")
+        server.serve_forever()
+
+
+def main():
+    """Run the exporter with the configuration file given as argument."""
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s %(message)s")
+    config = json.loads(Path(sys.argv[1]).read_text())
+    PrometheusExporter(config).run()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+"""Collect the slurmctld scheduler statistics from `sdiag` into InfluxDB.
+
+This daemon runs on the leader, managed by `MetricsOps.setup_sdiag_collector`,
+and writes to the database provisioned by the influxdb relation. Every
+interval it parses `sdiag` and writes one batch of points:
+
+- `slurmctld`: the server thread count, agent queue, job counters and the
+  main and backfill scheduler cycle statistics.
+- `slurmctld_rpc_type` and `slurmctld_rpc_user`: the RPC count and times,
+  tagged by message type and user.
+- `slurmctld_pending_rpc`: the pending RPCs by message type.
+
+The points of failed writes are kept and written with the next batch, up to
+`max_buffered_points`.
+"""
+
+import json
+import logging
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import influxdb
+from slurmctld_ops import parse_sdiag
+
+logger = logging.getLogger("sdiag-collector")
+
+RPC_MEASUREMENTS = {
+    "rpc_by_type": ("slurmctld_rpc_type", "type"),
+    "rpc_by_user": ("slurmctld_rpc_user", "user"),
+}
+
+
+def points(stats: dict, tags: dict, timestamp: int) -> list:
+    """Return the InfluxDB points for the parsed `sdiag` statistics."""
+    fields = {key: value for key, value in stats.items() if isinstance(value, int)}
+    batch = [{"measurement": "slurmctld", "tags": tags, "time": timestamp, "fields": fields}]
+
+    for section, (measurement, tag) in RPC_MEASUREMENTS.items():
+        for name, counters in stats.get(section, {}).items():
+            batch.append(
+                {
+                    "measurement": measurement,
+                    "tags": {**tags, tag: name},
+                    "time": timestamp,
+                    "fields": counters,
+                }
+            )
+
+    for name, count in stats.get("pending_rpcs", {}).items():
+        batch.append(
+            {
+                "measurement": "slurmctld_pending_rpc",
+                "tags": {**tags, "type": name},
+                "time": timestamp,
+                "fields": {"count": count},
+            }
+        )
+    return batch
+
+
+class SdiagCollector:
+    """Write the `sdiag` statistics to InfluxDB every interval."""
+
+    def __init__(self, config: dict):
+        """Initialize class."""
+        self._interval = config.get("interval", 60)
+        self._max_buffered_points = config.get("max_buffered_points", 10000)
+        self._retention_policy = config.get("retention_policy")
+        self._tags = {"cluster": config["cluster"], "host": config["host"]}
+        self._buffer = []
+
+        self._client = influxdb.InfluxDBClient(
+            host=config["ingress"],
+            port=config["port"],
+            username=config["user"],
+            password=config["password"],
+            database=config["database"],
+        )
+
+    def collect(self) -> None:
+        """Queue the points of the current `sdiag` statistics."""
+        try:
+            output = subprocess.check_output(["sdiag"], stderr=subprocess.STDOUT).decode()
+        except (OSError, subprocess.CalledProcessError) as e:
+            logger.warning(f"## sdiag failed: {e}")
+            return
+
+        self._buffer.extend(points(parse_sdiag(output), self._tags, int(time.time())))
+        # drop the oldest points if InfluxDB has been unreachable for long
+        del self._buffer[: -self._max_buffered_points]
+
+    def write(self) -> None:
+        """Write the queued points in a single request."""
+        if not self._buffer:
+            return
+
+        try:
+            self._client.write_points(
+                self._buffer, time_precision="s", retention_policy=self._retention_policy
+            )
+            self._buffer = []
+        except Exception as e:
+            logger.error(f"## Could not write {len(self._buffer)} points: {e}")
+
+    def run(self) -> None:
+        """Collect and write the statistics forever."""
+        while True:
+            start = time.monotonic()
+            self.collect()
+            self.write()
+            time.sleep(max(0, self._interval - (time.monotonic() - start)))
+
+
+def main():
+    """Run the collector with the configuration file given as argument."""
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s %(message)s")
+    config = json.loads(Path(sys.argv[1]).read_text())
+    SdiagCollector(config).run()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,570 @@
+#!/usr/bin/env python3
+"""SlurmctldOps."""
+import logging
+import math
+import os
+import re
+import subprocess
+import time
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger()
+
+
+# Communication settings by cluster size, following the Slurm large cluster
+# administration guide: (max nodes, MessageTimeout, TCPTimeout, SlurmdTimeout)
+CLUSTER_SIZE_TUNING = [
+    (256, 10, 2, 300),
+    (1024, 20, 5, 300),
+    (4096, 30, 10, 600),
+    (None, 60, 15, 900),
+]
+# clusters larger than this fan out over three levels instead of two
+TREE_WIDTH_CUBE_ROOT_MIN_NODES = 2500
+# clusters from this size on queue the RPCs in slurmctld, Slurm 23.02+
+RPC_QUEUE_MIN_NODES = 1024
+# SlurmctldParameters of the slurm.conf template. slurm.conf only keeps the
+# last SlurmctldParameters line, so the derived parameters and those from
+# custom-config are merged with these into a single line.
+TEMPLATE_SLURMCTLD_PARAMETERS = ["enable_configless"]
+SLURMCTLD_PARAMETERS_LINE = re.compile(
+    r"^\s*SlurmctldParameters\s*=\s*(\S*)\s*$", re.MULTILINE | re.IGNORECASE
+)
+# per-user RPC rate limiting, Slurm 23.02+
+RPC_RATE_LIMIT_MIN_VERSION = (23, 2)
+RPC_RATE_LIMIT_PARAMETERS = {
+    "rpc-rate-limit-bucket-size": "rl_bucket_size",
+    "rpc-rate-limit-refill-rate": "rl_refill_rate",
+    "rpc-rate-limit-refill-period": "rl_refill_period",
+}
+
+# sdiag sections whose statistics share names, e.g. `Last cycle`
+SDIAG_SECTIONS = {
+    "Main schedule statistics": "main",
+    "Main scheduler exit": "main_exit",
+    "Backfilling stats": "backfill",
+    "Backfill exit": "backfill_exit",
+}
+SDIAG_RPC_SECTIONS = {
+    "Remote Procedure Call statistics by message type": "rpc_by_type",
+    "Remote Procedure Call statistics by user": "rpc_by_user",
+    "Pending RPC statistics": "pending_rpcs",
+}
+
+# Job table sizing: estimated slurmctld memory per job record and for
+# everything else, the most records one core can walk each scheduling pass,
+# and Slurm's limits
+JOB_RECORD_BYTES = 16 * 1024
+SLURMCTLD_BASE_BYTES = 512 * 1024**2
+JOB_RECORDS_PER_CPU = 100000
+MIN_MAX_JOB_COUNT = 10000
+MIN_JOB_AGE_RANGE = (2, 300)
+MAX_ARRAY_SIZE_RANGE = (1001, 4000001)
+
+# SchedulerParameters presets. `htc` favours many short jobs and keeps the
+# controller responsive under RPC load, `hpc` looks far ahead to reserve
+# resources for large jobs, `balanced` is in between. Flags have no value.
+SCHEDULER_PROFILES = {
+    "none": {},
+    "htc": {
+        "batch_sched_delay": "20",
+        "bf_continue": None,
+        "bf_interval": "60",
+        "bf_max_job_test": "500",
+        "bf_resolution": "600",
+        "bf_window": "1440",
+        "default_queue_depth": "1000",
+        "defer": None,
+        "max_rpc_cnt": "150",
+        "sched_min_interval": "2000000",
+    },
+    "hpc": {
+        "bf_continue": None,
+        "bf_interval": "30",
+        "bf_max_job_test": "1000",
+        "bf_resolution": "300",
+        "bf_window": "10080",
+        "max_rpc_cnt": "64",
+    },
+    "balanced": {
+        "batch_sched_delay": "5",
+        "bf_continue": None,
+        "bf_interval": "30",
+        "bf_max_job_test": "500",
+        "bf_resolution": "300",
+        "bf_window": "2880",
+        "max_rpc_cnt": "100",
+        "sched_min_interval": "500000",
+    },
+}
+
+# the parameters the charm manages: the Slurm version that introduced them,
+# and whether they are flags, which take no value, or take a number
+SCHEDULER_PARAMETERS = {
+    "batch_sched_delay": ((14, 11), False),
+    "bf_continue": ((14, 11), True),
+    "bf_interval": ((14, 11), False),
+    "bf_max_job_test": ((14, 11), False),
+    "bf_max_job_user": ((14, 11), False),
+    "bf_resolution": ((14, 11), False),
+    "bf_window": ((14, 11), False),
+    "default_queue_depth": ((14, 11), False),
+    "defer": ((14, 11), True),
+    "max_rpc_cnt": ((14, 11), False),
+    "sched_interval": ((14, 11), False),
+    "sched_min_interval": ((15, 8), False),
+}
+
+
+class SlurmctldOpsError(Exception):
+    """Raised when a slurmctld operation fails."""
+
+
+def _auto(value: str, derived: int) -> int:
+    """Return the configured number of seconds, or the derived one for `auto`."""
+    return derived if value == "auto" else int(value)
+
+
+def _ceil_root(value: int, degree: int) -> int:
+    """Return the smallest integer whose power of degree is at least value."""
+    root = math.ceil(value ** (1 / degree))
+    while root > 1 and (root - 1) ** degree >= value:
+        root -= 1
+    return root
+
+
+def custom_slurmctld_parameters(custom_config: str) -> List[str]:
+    """Return the SlurmctldParameters set in custom-config, the last line wins."""
+    lines = SLURMCTLD_PARAMETERS_LINE.findall(custom_config or "")
+    return [item for item in lines[-1].split(",") if item] if lines else []
+
+
+def strip_slurmctld_parameters(custom_config: str) -> str:
+    """Return custom-config without its SlurmctldParameters, which are merged."""
+    return SLURMCTLD_PARAMETERS_LINE.sub("", custom_config or "").strip("\n")
+
+
+def _parse_scheduler_parameters(value: str) -> Dict[str, Optional[str]]:
+    """Parse `key=value,flag,-flag` overrides; removed parameters map to `-`."""
+    parameters = {}
+    for item in filter(None, (i.strip() for i in value.split(","))):
+        if item.startswith("-"):
+            parameters[item[1:]] = "-"
+        else:
+            key, _, val = item.partition("=")
+            parameters[key] = val or None
+    return parameters
+
+
+def _snake_case(label: str) -> str:
+    return re.sub(r"[^a-z0-9]+", "_", label.lower()).strip("_")
+
+
+def parse_sdiag(output: str) -> dict:
+    """Parse the output of `sdiag`.
+
+    The statistics are returned by snake case name, prefixed with their
+    section when the name is not unique, e.g. `server_thread_count` and
+    `backfill_last_cycle`. The RPC counters are returned per message type,
+    user and pending message type, under `rpc_by_type`, `rpc_by_user` and
+    `pending_rpcs`.
+    """
+    stats = {section: {} for section in SDIAG_RPC_SECTIONS.values()}
+    prefix = section = ""
+    for line in output.splitlines():
+        if not line.strip() or line.startswith("*"):
+            continue
+
+        if not line[0].isspace():
+            heading = line.split("(")[0].rstrip(": ").strip()
+            if heading in SDIAG_SECTIONS or heading in SDIAG_RPC_SECTIONS:
+                prefix = SDIAG_SECTIONS.get(heading, "")
+                section = SDIAG_RPC_SECTIONS.get(heading, "")
+                continue
+            # a statistic outside of the sections ends them
+            prefix = section = ""
+
+        if section:
+            match = re.match(r"\s*(\S+)\s+\(\s*\d+\)\s+(.*)", line)
+            if match:
+                counters = {
+                    key: int(value) for key, value in re.findall(r"(\w+):\s*(\d+)", match[2])
+                }
+                if section == "pending_rpcs":
+                    stats[section][match[1]] = counters.get("count", 0)
+                else:
+                    stats[section][match[1]] = counters
+            continue
+
+        label, _, value = line.partition(":")
+        match = re.match(r"\s*(-?\d+)\s*$", value)
+        if match:
+            name = _snake_case(label)
+            stats[f"{prefix}_{name}" if prefix else name] = int(match[1])
+
+    return stats
+
+
+def _backup_is_up(ping_output: str) -> bool:
+    """Return True if `scontrol ping` reports a backup controller as UP."""
+    return bool(re.search(r"^Slurmctld\(backup\d*\) at \S+ is UP", ping_output, re.MULTILINE))
+
+
+def _primary_is_down(ping_output: str) -> bool:
+    """Return True if `scontrol ping` reports the primary controller as DOWN."""
+    return bool(re.search(r"^Slurmctld\(primary\) at \S+ is DOWN", ping_output, re.MULTILINE))
+
+
+class SlurmctldOps:
+    """Slurmctld ops.
+
+    Owns the slurm.conf settings the charm derives from its config, and
+    operations on the running controllers.
+    """
+
+    def __init__(self, charm):
+        """Initialize class."""
+        self._charm = charm
+        self._slurm_version = None
+        self._meminfo = Path("/proc/meminfo")
+
+    @property
+    def slurm_version(self) -> Tuple[int, int]:
+        """Return the major and minor version of slurmctld, (0, 0) if unknown."""
+        if self._slurm_version is None:
+            try:
+                output = subprocess.check_output(["slurmctld", "-V"]).decode()
+                match = re.search(r"(\d+)\.(\d+)", output)
+                self._slurm_version = (int(match[1]), int(match[2])) if match else (0, 0)
+            except (OSError, subprocess.CalledProcessError) as e:
+                logger.warning(f"## Could not get the Slurm version: {e}")
+                self._slurm_version = (0, 0)
+        return self._slurm_version
+
+    @staticmethod
+    def _node_count(slurmd_info: list) -> int:
+        return len({node["node_name"] for p in slurmd_info for node in p.get("inventory", [])})
+
+    def tuning(self, slurmd_info: list) -> dict:
+        """Return the communication settings for the size of the cluster.
+
+        The fan-out and timeouts are derived from the number of nodes, unless
+        set explicitly in the charm config. SlurmctldParameters always keeps
+        those of the slurm.conf template, and those from custom-config win
+        over the derived ones.
+        """
+        node_count = self._node_count(slurmd_info)
+        for max_nodes, message_timeout, tcp_timeout, slurmd_timeout in CLUSTER_SIZE_TUNING:
+            if max_nodes is None or node_count <= max_nodes:
+                break
+
+        config = self._charm.model.config
+        tuning = {
+            "TreeWidth": self._tree_width(node_count),
+            "MessageTimeout": _auto(config.get("message-timeout"), message_timeout),
+            "TCPTimeout": tcp_timeout,
+            "SlurmdTimeout": _auto(config.get("slurmd-timeout"), slurmd_timeout),
+            "SlurmctldTimeout": config.get("slurmctld-timeout"),
+        }
+
+        slurmctld_parameters = []
+        if node_count >= RPC_QUEUE_MIN_NODES and self.slurm_version >= (23, 2):
+            slurmctld_parameters.append("enable_rpc_queue")
+        if config.get("rpc-rate-limit"):
+            slurmctld_parameters.append("rl_enable")
+            slurmctld_parameters.extend(
+                f"{parameter}={config.get(key)}"
+                for key, parameter in RPC_RATE_LIMIT_PARAMETERS.items()
+            )
+
+        merged = {}
+        for item in (
+            TEMPLATE_SLURMCTLD_PARAMETERS
+            + slurmctld_parameters
+            + custom_slurmctld_parameters(config.get("custom-config"))
+        ):
+            merged[item.partition("=")[0]] = item
+        tuning["SlurmctldParameters"] = ",".join(merged.values())
+        return tuning
+
+    @staticmethod
+    def _tree_width(node_count: int) -> int:
+        """Return the fan-out reaching every node in two hops, three on large clusters."""
+        levels = 3 if node_count > TREE_WIDTH_CUBE_ROOT_MIN_NODES else 2
+        return max(16, _ceil_root(node_count, levels))
+
+    def _host_memory(self) -> int:
+        """Return the total memory of the host in bytes."""
+        match = re.search(r"^MemTotal:\s+(\d+) kB", self._meminfo.read_text(), re.MULTILINE)
+        return int(match[1]) * 1024
+
+    def job_table_sizing(self, jobs_per_hour: int = None, array_size: int = None) -> dict:
+        """Size the job table to keep slurmctld within its memory budget.
+
+        MaxJobCount is what fits in the budget, capped by what the CPUs can
+        schedule. MinJobAge keeps finished jobs for as long as half of the
+        table holds at the submission rate, and MaxArraySize leaves room
+        for several arrays.
+        """
+        config = self._charm.model.config
+        if jobs_per_hour is None:
+            jobs_per_hour = config.get("job-submission-rate")
+        if array_size is None:
+            array_size = config.get("average-array-size")
+
+        memory = self._host_memory()
+        cpus = os.cpu_count() or 1
+        budget = memory * config.get("slurmctld-memory-budget") // 100
+
+        max_job_count = max(
+            MIN_MAX_JOB_COUNT,
+            min((budget - SLURMCTLD_BASE_BYTES) // JOB_RECORD_BYTES, cpus * JOB_RECORDS_PER_CPU),
+        )
+
+        # every array task that starts gets its own job record
+        records_per_hour = jobs_per_hour * max(1, array_size)
+        min_job_age = MIN_JOB_AGE_RANGE[1]
+        if records_per_hour:
+            min_job_age = int(max_job_count / 2 / records_per_hour * 3600)
+            min_job_age = min(max(min_job_age, MIN_JOB_AGE_RANGE[0]), MIN_JOB_AGE_RANGE[1])
+
+        max_array_size = min(
+            max(MAX_ARRAY_SIZE_RANGE[0], array_size * 4 + 1),
+            MAX_ARRAY_SIZE_RANGE[1],
+            max_job_count // 4,
+        )
+
+        return {
+            "memory-bytes": memory,
+            "cpus": cpus,
+            "budget-bytes": budget,
+            "records-per-hour": records_per_hour,
+            "max-job-count": max_job_count,
+            "min-job-age": min_job_age,
+            "max-array-size": max_array_size,
+        }
+
+    def scheduler_parameters(self) -> Dict[str, Optional[str]]:
+        """Return the SchedulerParameters of the profile, with the overrides applied."""
+        config = self._charm.model.config
+        parameters = dict(SCHEDULER_PROFILES.get(config.get("scheduler-profile"), {}))
+        if config.get("max-rpc-count") > 0:
+            parameters["max_rpc_cnt"] = str(config.get("max-rpc-count"))
+        for key, value in _parse_scheduler_parameters(config.get("scheduler-parameters")).items():
+            if value == "-":
+                parameters.pop(key, None)
+            else:
+                parameters[key] = value
+        return parameters
+
+    def _check_scheduler_config(self) -> str:
+        config = self._charm.model.config
+        profile = config.get("scheduler-profile")
+        if profile not in SCHEDULER_PROFILES:
+            return f"scheduler-profile must be one of {', '.join(SCHEDULER_PROFILES)}"
+
+        overrides = _parse_scheduler_parameters(config.get("scheduler-parameters"))
+        for key in overrides:
+            if key not in SCHEDULER_PARAMETERS:
+                return f"scheduler-parameters: unsupported parameter {key}"
+
+        for key, value in self.scheduler_parameters().items():
+            min_version, flag = SCHEDULER_PARAMETERS[key]
+            if flag and value is not None:
+                return f"scheduler-parameters: {key} is a flag and takes no value"
+            if not flag and not (value and value.isdigit()):
+                return f"scheduler-parameters: {key} must be a number"
+            # an unknown version, e.g. before installing, is not an error
+            if (0, 0) < self.slurm_version < min_version:
+                version = ".".join(f"{v:02d}" for v in min_version)
+                return f"scheduler parameter {key} requires Slurm {version}"
+
+        return ""
+
+    def _check_limits_config(self) -> str:
+        config = self._charm.model.config
+        if config.get("rpc-rate-limit"):
+            # an unknown version, e.g. before installing, is not an error
+            if (0, 0) < self.slurm_version < RPC_RATE_LIMIT_MIN_VERSION:
+                return "rpc-rate-limit requires Slurm 23.02"
+            for key in RPC_RATE_LIMIT_PARAMETERS:
+                if config.get(key) < 1:
+                    return f"{key} must be at least 1"
+
+        for key in ["max-rpc-count", "job-submission-rate", "average-array-size"]:
+            if config.get(key) < 0:
+                return f"{key} must not be negative"
+        if not 1 <= config.get("slurmctld-memory-budget") <= 100:
+            return "slurmctld-memory-budget must be between 1 and 100"
+
+        return ""
+
+    def check_config(self, slurmd_info: list) -> str:
+        """Validate the slurm.conf related options.
+
+        Returns:
+            A message describing the first invalid option, or an empty
+            string if the configuration is valid.
+        """
+        scheduler_error = self._check_scheduler_config()
+        if scheduler_error:
+            return scheduler_error
+
+        limits_error = self._check_limits_config()
+        if limits_error:
+            return limits_error
+
+        config = self._charm.model.config
+        for key in ["message-timeout", "slurmd-timeout"]:
+            if config.get(key) != "auto" and not config.get(key).isdigit():
+                return f"{key} must be auto or a number of seconds"
+
+        tuning = self.tuning(slurmd_info)
+        message_timeout = tuning["MessageTimeout"]
+
+        if not 1 <= message_timeout <= 100:
+            return "message-timeout must be between 1 and 100"
+        # a controller must not be declared dead before a message could time out
+        if tuning["SlurmctldTimeout"] <= message_timeout:
+            return "slurmctld-timeout must be greater than message-timeout"
+        if tuning["SlurmdTimeout"] != 0 and tuning["SlurmdTimeout"] <= message_timeout:
+            return "slurmd-timeout must be 0 or greater than message-timeout"
+
+        return ""
+
+    def slurm_conf_lines(self, slurmd_info: list, job_table_sizing: dict = None) -> List[str]:
+        """Return the slurm.conf lines derived from the charm config and cluster.
+
+        The job table sizing is the one of the leader, so every controller
+        renders the same limits whatever its own host.
+        """
+        lines = [f"{key}={value}" for key, value in self.tuning(slurmd_info).items()]
+
+        if job_table_sizing:
+            lines.append(f"MaxJobCount={job_table_sizing['max-job-count']}")
+            lines.append(f"MinJobAge={job_table_sizing['min-job-age']}")
+            lines.append(f"MaxArraySize={job_table_sizing['max-array-size']}")
+
+        scheduler_parameters = self.scheduler_parameters()
+        if scheduler_parameters:
+            parameters = [
+                key if value is None else f"{key}={value}"
+                for key, value in sorted(scheduler_parameters.items())
+            ]
+            lines.append(f"SchedulerParameters={','.join(parameters)}")
+
+        return lines
+
+    def rpc_stats(self, top: int = 5, reset: bool = False) -> dict:
+        """Return the RPC throttling counters reported by `sdiag`.
+
+        These are the server thread count, which slurmctld compares to
+        `max_rpc_cnt` to defer scheduling, the queued and pending RPCs, and
+        the busiest users and message types.
+        """
+        stats = parse_sdiag(self._run(["sdiag"]))
+        if reset:
+            self._run(["sdiag", "--reset"])
+
+        def busiest(rpcs: dict) -> str:
+            counts = sorted(rpcs.items(), key=lambda item: item[1]["count"], reverse=True)
+            return ",".join(f"{name}:{counters['count']}" for name, counters in counts[:top])
+
+        config = self._charm.model.config
+        return {
+            "server-thread-count": stats.get("server_thread_count", 0),
+            "max-rpc-count": self.scheduler_parameters().get("max_rpc_cnt") or "unset",
+            "rpc-rate-limit": "enabled" if config.get("rpc-rate-limit") else "disabled",
+            "agent-queue-size": stats.get("agent_queue_size", 0),
+            "pending-rpcs": sum(stats["pending_rpcs"].values()),
+            "rpc-count": sum(counters["count"] for counters in stats["rpc_by_type"].values()),
+            "top-users": busiest(stats["rpc_by_user"]),
+            "top-message-types": busiest(stats["rpc_by_type"]),
+        }
+
+    def failover_benchmark(self, timeout: int, partition: str = "") -> dict:
+        """Kill the local slurmctld and measure how long scheduling is unavailable.
+
+        A backup answers `scontrol ping` while it is in standby, so the
+        takeover is timed with an RPC instead: once `scontrol ping` reports
+        the primary DOWN, measures the time until `scontrol show config`
+        succeeds, which it only does once a backup took control, and until
+        a trivial job starts. The local slurmctld is started again
+        afterwards, and takes control back from the backup.
+        """
+        if not _backup_is_up(self._ping()):
+            raise SlurmctldOpsError("No backup controller is up")
+
+        results = {}
+        start = time.monotonic()
+        deadline = start + timeout
+
+        logger.debug("## killing the local slurmctld")
+        subprocess.call(["systemctl", "kill", "--signal=SIGKILL", "slurmctld"])
+        # keep systemd from restarting it while we measure
+        subprocess.call(["systemctl", "stop", "slurmctld"])
+
+        try:
+            while not _primary_is_down(self._ping()):
+                self._wait(deadline, "the primary controller to be down")
+            results["primary-down-seconds"] = round(time.monotonic() - start, 3)
+
+            while True:
+                try:
+                    self._run(["scontrol", "show", "config"])
+                    break
+                except SlurmctldOpsError:
+                    # the backup refuses RPCs until it took control
+                    self._wait(deadline, "a backup controller to take control")
+            results["takeover-seconds"] = round(time.monotonic() - start, 3)
+
+            sbatch = ["sbatch", "--parsable", "--wrap=true", "--time=1"]
+            if partition:
+                sbatch.append(f"--partition={partition}")
+            while True:
+                try:
+                    job_id = self._run(sbatch).split(";")[0]
+                    break
+                except SlurmctldOpsError:
+                    # the backup may still be loading the state
+                    self._wait(deadline, "the job to be accepted")
+            results["job-id"] = job_id
+
+            while self._job_state(job_id) in ["PENDING", "CONFIGURING"]:
+                self._wait(deadline, "the job to start")
+            results["job-started-seconds"] = round(time.monotonic() - start, 3)
+        finally:
+            logger.debug("## starting the local slurmctld again")
+            subprocess.call(["systemctl", "start", "slurmctld"])
+
+        return results
+
+    @staticmethod
+    def _wait(deadline: float, what: str) -> None:
+        if time.monotonic() > deadline:
+            raise SlurmctldOpsError(f"Timed out waiting for {what}")
+        time.sleep(0.1)
+
+    @staticmethod
+    def _ping() -> str:
+        # scontrol ping fails when any controller is down, but still reports
+        # the state of each of them
+        result = subprocess.run(
+            ["scontrol", "ping"], stdout=subprocess.PIPE, stderr=subprocess.STDOUT
+        )
+        return result.stdout.decode()
+
+    def _job_state(self, job_id: str) -> str:
+        try:
+            return self._run(["squeue", "--noheader", "--jobs", job_id, "--format=%T"])
+        except SlurmctldOpsError:
+            # the job already finished and was purged
+            return ""
+
+    @staticmethod
+    def _run(cmd: List[str]) -> str:
+        try:
+            return subprocess.check_output(cmd, stderr=subprocess.STDOUT).decode().strip()
+        except subprocess.CalledProcessError as e:
+            raise SlurmctldOpsError(f"{' '.join(cmd)} failed: {e.output.decode().strip()}")
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+"""StateSyncOps."""
+import logging
+import re
+import shutil
+from pathlib import Path
+from typing import List
+
+from systemd_ops import SystemdOps
+
+logger = logging.getLogger()
+
+
+class StateSyncOps:
+    """Replicate the StateSaveLocation of the active controller to its peers.
+
+    The leader serves its StateSaveLocation read-only with an rsync daemon,
+    the standby units pull it periodically with a systemd timer. The daemon
+    only serves the state while slurmctld is active on the leader, and the
+    pull is skipped while slurmctld is active on the standby, so a
+    controller that took over is never overwritten with a stale copy.
+    """
+
+    def __init__(self, charm):
+        """Initialize class."""
+        self._charm = charm
+
+        self._user = "slurmctld-sync"
+        # not 873, so it does not conflict with a system wide rsyncd
+        self._port = 8873
+
+        self._path = Path("/etc/slurmctld-state-sync")
+        self._rsyncd_config = self._path / "rsyncd.conf"
+        self._secrets_file = self._path / "rsyncd.secrets"
+        self._password_file = self._path / "password"
+
+        self._systemd = SystemdOps(self._path)
+        self._server_service = "slurmctld-state-sync-server.service"
+        self._client_service = "slurmctld-state-sync.service"
+        self._client_timer = "slurmctld-state-sync.timer"
+
+    def state_save_location(self) -> str:
+        """Return the StateSaveLocation of the rendered slurm.conf."""
+        try:
+            slurm_conf = self._charm._slurm_manager.get_slurm_conf()
+        except OSError:
+            slurm_conf = ""
+
+        # the last definition wins, e.g. one from custom-config
+        locations = re.findall(r"^\s*StateSaveLocation\s*=\s*(\S+)", slurm_conf, re.MULTILINE)
+        return locations[-1] if locations else "/var/spool/slurmctld"
+
+    def setup_server(self, address: str, peer_addresses: List[str], secret: str) -> None:
+        """Serve the StateSaveLocation to the peers, on the leader."""
+        self._systemd.stop(self._client_timer)
+        if not (peer_addresses and self._has_rsync()):
+            self._systemd.stop(self._server_service)
+            return
+
+        rsyncd_config = self._systemd.render(
+            "state-sync-rsyncd.conf.tmpl",
+            {
+                "address": address,
+                "port": self._port,
+                "user": self._user,
+                "state_save_location": self.state_save_location(),
+                "secrets_file": self._secrets_file,
+                "hosts_allow": " ".join(sorted(peer_addresses)),
+            },
+        )
+        unit = self._systemd.render(
+            "state-sync-server.service.tmpl", {"rsyncd_config": self._rsyncd_config}
+        )
+
+        changed = self._systemd.write(self._rsyncd_config, rsyncd_config)
+        changed |= self._systemd.write(self._secrets_file, f"{self._user}:{secret}\n", mode=0o600)
+        changed |= self._systemd.write_unit(self._server_service, unit)
+        self._systemd.start(self._server_service, changed)
+
+    def setup_client(self, source: str, secret: str, interval: int) -> None:
+        """Pull the StateSaveLocation of the leader every interval seconds."""
+        self._systemd.stop(self._server_service)
+        if not self._has_rsync():
+            self._systemd.stop(self._client_timer)
+            return
+
+        service = self._systemd.render(
+            "state-sync.service.tmpl",
+            {
+                "source": f"rsync://{self._user}@{source}:{self._port}/state/",
+                "password_file": self._password_file,
+                "state_save_location": self.state_save_location(),
+            },
+        )
+        timer = self._systemd.render("state-sync.timer.tmpl", {"interval": interval})
+
+        changed = self._systemd.write(self._password_file, f"{secret}\n", mode=0o600)
+        changed |= self._systemd.write_unit(self._client_service, service)
+        changed |= self._systemd.write_unit(self._client_timer, timer)
+        self._systemd.start(self._client_timer, changed)
+
+    def stop(self) -> None:
+        """Stop replicating the StateSaveLocation."""
+        self._systemd.stop(self._server_service)
+        self._systemd.stop(self._client_timer)
+
+    @staticmethod
+    def _has_rsync() -> bool:
+        if shutil.which("rsync"):
+            return True
+        logger.error("## rsync is not installed, can not replicate StateSaveLocation")
+        return False
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""SystemdOps."""
+import logging
+import os
+import subprocess
+from pathlib import Path
+
+from jinja2 import Environment, FileSystemLoader
+
+logger = logging.getLogger()
+
+
+def atomic_write(path: Path, content: str, mode: int = 0o644) -> None:
+    """Write a file atomically, so readers never see a partial file."""
+    tmp = path.with_name(f".{path.name}.tmp")
+    tmp.unlink(missing_ok=True)
+    with os.fdopen(os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode), "w") as f:
+        f.write(content)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+class SystemdOps:
+    """Write the configuration and systemd units of the charm's daemons.
+
+    Files are only rewritten when their content changed, so the callers
+    restart a daemon only when its configuration did.
+    """
+
+    def __init__(self, path: Path, systemd_path: Path = Path("/etc/systemd/system")):
+        """Initialize class."""
+        self._path = path
+        self._systemd_path = systemd_path
+
+    @staticmethod
+    def render(template_name: str, context: dict) -> str:
+        """Render a template of the charm."""
+        template_dir = Path(__file__).parent / "templates"
+        environment = Environment(loader=FileSystemLoader(template_dir))
+        return environment.get_template(template_name).render(context)
+
+    def write(self, path: Path, content: str, mode: int = 0o644) -> bool:
+        """Write the file if its content changed, returning True if it did."""
+        if path.exists() and path.read_text() == content:
+            return False
+
+        if not self._path.exists():
+            self._path.mkdir(mode=0o700, parents=True)
+        atomic_write(path, content, mode=mode)
+        return True
+
+    def write_unit(self, name: str, content: str) -> bool:
+        """Write a systemd unit and reload systemd if it changed."""
+        changed = self.write(self._systemd_path / name, content)
+        if changed:
+            subprocess.call(["systemctl", "daemon-reload"])
+        return changed
+
+    @staticmethod
+    def start(unit: str, restart: bool) -> None:
+        """Enable and start the unit, restarting it if asked to."""
+        is_active = subprocess.call(["systemctl", "is-active", "--quiet", unit]) == 0
+        if restart or not is_active:
+            logger.debug(f"## (re)starting {unit}")
+            subprocess.call(["systemctl", "enable", unit])
+            subprocess.call(["systemctl", "restart", unit])
+
+    @staticmethod
+    def stop(unit: str) -> None:
+        """Disable and stop the unit, if it is enabled."""
+        if subprocess.call(["systemctl", "is-enabled", "--quiet", unit]) == 0:
+            logger.debug(f"## stopping {unit}")
+            subprocess.call(["systemctl", "disable", "--now", unit])
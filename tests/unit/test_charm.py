@@ -15,13 +15,37 @@
 
 """Test default charm events such as upgrade charm, install, etc."""
 
+import base64
+import gzip
+import hashlib
+import http.server
+import io
+import json
+import queue
+import subprocess
+import tarfile
+import tempfile
+import threading
+import time
 import unittest
-from unittest.mock import patch
+import urllib.request
+from pathlib import Path
+from unittest.mock import MagicMock, PropertyMock, call, patch
 
 import ops.testing
 from charm import SlurmctldCharm
-from ops.model import BlockedStatus
+from etcd3gw.exceptions import Etcd3Exception
+from etcd_ops import EtcdOpsError, _latency_summary, _parse_histogram
+from interface_slurmctld_peer import SlurmctldPeer
+from interface_slurmrestd import decode_slurm_config
+from node_watcher import WATCH_CANCELED, NodeWatcher, scontrol_update
+from omnietcd3 import Etcd3AuthClient
+from ops.model import BlockedStatus, ModelError
 from ops.testing import Harness
+from prometheus_exporter import PrometheusExporter
+from sdiag_collector import SdiagCollector
+from slurmctld_ops import parse_sdiag, strip_slurmctld_parameters
+from systemd_ops import SystemdOps
 
 ops.testing.SIMULATE_CAN_CONNECT = True
 
@@ -235,3 +259,1303 @@ class TestCharm(unittest.TestCase):
         """Test that the on_slurmdbd_unavailable method works."""
         self.harness.charm._slurmdbd.on.slurmdbd_unavailable.emit()
         self.assertEqual(self.harness.charm._stored.slurmdbd_available, False)
+
+    def _make_etcd_tarball(
+        self, path: Path, top_level: str, binaries=("etcd", "etcdutl", "etcdctl")
+    ):
+        """Create a fake etcd resource tarball."""
+        with tarfile.open(path, "w:gz") as tar:
+            for name in [*binaries, "README.md"]:
+                data = f"#!/bin/sh\necho {name}\n".encode()
+                info = tarfile.TarInfo(f"{top_level}/{name}")
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data))
+
+    @patch("etcd_ops.shutil.chown")
+    @patch("etcd_ops.EtcdOps._setup_systemd")
+    @patch("etcd_ops.EtcdOps._create_etcd_user_group")
+    def test_etcd_install_skips_identical_binaries(self, create_user, *_) -> None:
+        """Test that etcd install extracts the binaries once and then skips."""
+        etcd = self.harness.charm._etcd
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            tmp = Path(tmp_dir)
+            etcd._bin_dir = tmp / "bin"
+            etcd._bin_dir.mkdir()
+            etcd._varlib = tmp / "varlib"
+            resource = tmp / "etcd-v3.5.9-linux-amd64.tar.gz"
+            self._make_etcd_tarball(resource, "etcd-v3.5.9-linux-amd64")
+
+            self.assertTrue(etcd.install(resource))
+            self.assertEqual(
+                sorted(p.name for p in etcd._bin_dir.iterdir()), ["etcd", "etcdctl", "etcdutl"]
+            )
+            self.assertFalse(etcd.install(resource))
+            self.assertEqual(create_user.call_count, 1)
+
+            # a tampered binary must be reinstalled
+            (etcd._bin_dir / "etcd").write_text("tampered")
+            self.assertTrue(etcd.install(resource))
+            self.assertIn("echo etcd", (etcd._bin_dir / "etcd").read_text())
+
+    def test_etcd_snapshot_metadata_is_private(self) -> None:
+        """Test that the snapshot credentials are only readable by root, even if overwritten."""
+        self.harness.charm._stored.etcd_root_pass = "root-pass"
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = Path(tmp_dir) / "snapshot.db.gz"
+            metadata = Path(f"{path}.json")
+            metadata.write_text("{}")
+            metadata.chmod(0o644)
+
+            event = MagicMock(params={"path": path.as_posix()})
+            with patch.object(
+                self.harness.charm._etcd, "snapshot", return_value={"sha256": "abc"}
+            ):
+                self.harness.charm._etcd_snapshot_action(event)
+
+            self.assertEqual(metadata.stat().st_mode & 0o777, 0o600)
+            self.assertEqual(json.loads(metadata.read_text())["root_pass"], "root-pass")
+
+    @patch("etcd_ops.EtcdOps.store_cluster_state")
+    @patch("etcd_ops.EtcdOps.restore")
+    @patch("charm.SlurmctldCharm._reconcile_etcd_cluster")
+    @patch("charm.SlurmctldCharm._on_leader_elected", autospec=True)
+    def test_etcd_restore_updates_slurmd(self, _, __, restore, store_cluster_state):
+        """Test that a restore hands the restored password to slurmd and keeps the keys."""
+        self.harness.set_leader(True)
+        self.harness.charm._stored.munge_key = "CURRENT"
+        self.harness.charm._stored.etcd_slurmd_pass = "old"
+        rel_id = self.harness.add_relation("slurmd", "slurmd")
+        self.harness.update_relation_data(rel_id, "slurmctld", {"etcd_slurmd_pass": "old"})
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = Path(tmp_dir) / "snapshot.db.gz"
+            Path(f"{path}.json").write_text(
+                json.dumps({"sha256": "abc", "root_pass": "root", "slurmd_pass": "restored"})
+            )
+            event = MagicMock(params={"path": path.as_posix()})
+            with patch.object(SlurmctldCharm, "_accounted_nodes", return_value=["node-1"]):
+                self.harness.charm._etcd_restore_action(event)
+
+        event.fail.assert_not_called()
+        restore.assert_called_once_with(path, "abc")
+        app_data = self.harness.get_relation_data(rel_id, "slurmctld")
+        self.assertEqual(app_data["etcd_slurmd_pass"], "restored")
+        store_cluster_state.assert_called_once_with("root", "CURRENT", ["node-1"])
+
+    def test_etcd_install_missing_binary(self) -> None:
+        """Test that etcd install fails, replacing nothing, if the resource lacks a binary."""
+        etcd = self.harness.charm._etcd
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            tmp = Path(tmp_dir)
+            etcd._bin_dir = tmp / "bin"
+            etcd._bin_dir.mkdir()
+            (etcd._bin_dir / "etcd").write_text("installed")
+            resource = tmp / "etcd.tar.gz"
+            self._make_etcd_tarball(resource, "etcd-v3.5.0-linux-amd64", binaries=("etcd",))
+            with self.assertRaises(EtcdOpsError):
+                etcd.install(resource)
+            self.assertEqual([p.name for p in etcd._bin_dir.iterdir()], ["etcd"])
+            self.assertEqual((etcd._bin_dir / "etcd").read_text(), "installed")
+
+    @patch("etcd_ops.shutil.chown")
+    @patch("etcd_ops.EtcdOps.restart")
+    def test_etcd_setup_tls_restarts_only_on_change(self, restart, _) -> None:
+        """Test that etcd is only restarted when the TLS material changes."""
+        etcd = self.harness.charm._etcd
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            tmp = Path(tmp_dir)
+            etcd._etcd_environment_file = tmp / "etcd.env"
+            etcd._certs_path = tmp / "certs"
+            etcd._tls_key_path = etcd._certs_path / "tls.key"
+            etcd._tls_crt_path = etcd._certs_path / "tls.crt"
+            etcd._tls_ca_crt_path = etcd._certs_path / "tls-ca.crt"
+            self.harness.update_config({"etcd-data-dir": f"{tmp_dir}/data"})
+
+            self.assertTrue(etcd.setup_tls())
+            self.assertFalse(etcd.setup_tls())
+            self.assertEqual(restart.call_count, 1)
+            self.assertIn("http://", etcd._etcd_environment_file.read_text())
+
+            self.harness.update_config({"tls-key": "KEY", "tls-cert": "CERT"})
+            self.harness.charm._stored.use_tls = True
+            self.assertTrue(etcd.setup_tls())
+            self.assertFalse(etcd.setup_tls())
+            self.assertEqual(restart.call_count, 2)
+            self.assertEqual(etcd._tls_crt_path.read_text(), "CERT")
+            self.assertIn("https://", etcd._etcd_environment_file.read_text())
+            etcd._certs_path.chmod(0o700)
+
+    def test_etcd_tuning_rendered(self) -> None:
+        """Test that the etcd tuning options are rendered into the environment file."""
+        self.harness.update_config(
+            {
+                "etcd-wal-dir": "/srv/etcd-wal",
+                "etcd-quota-backend-bytes": 8589934592,
+                "etcd-auto-compaction-retention": "1h",
+            }
+        )
+        env = self.harness.charm._etcd._render_environment_file()
+        self.assertIn("ETCD_DATA_DIR=/var/lib/etcd\n", env)
+        self.assertIn("ETCD_WAL_DIR=/srv/etcd-wal\n", env)
+        self.assertIn("ETCD_QUOTA_BACKEND_BYTES=8589934592\n", env)
+        self.assertIn("ETCD_AUTO_COMPACTION_MODE=periodic\n", env)
+        self.assertIn("ETCD_AUTO_COMPACTION_RETENTION=1h\n", env)
+        self.assertNotIn("ETCD_SNAPSHOT_COUNT", env)
+
+    def test_etcd_check_config(self) -> None:
+        """Test that invalid etcd tuning options are reported."""
+        self.assertEqual(self.harness.charm._etcd.check_config(), "")
+        self.harness.update_config({"etcd-election-timeout": 200})
+        self.assertIn("etcd-election-timeout", self.harness.charm._etcd.check_config())
+        self.harness.update_config({"etcd-election-timeout": 1000, "etcd-wal-dir": "wal"})
+        self.assertIn("etcd-wal-dir", self.harness.charm._etcd.check_config())
+
+    @patch("etcd_ops.EtcdOps._client")
+    def test_etcd_maintenance(self, client) -> None:
+        """Test that etcd maintenance compacts, defragments and reports sizes."""
+        client.return_value.status.side_effect = [
+            {"header": {"revision": "42"}, "dbSize": "1000"},
+            {"header": {"revision": "42"}, "dbSize": "1000", "dbSizeInUse": "200"},
+            {"header": {"revision": "42"}, "dbSize": "250"},
+        ]
+        result = self.harness.charm._etcd.maintenance("pass")
+        self.assertEqual(result["revision"], 42)
+        self.assertTrue(result["defragmented"])
+        self.assertEqual(result["db-size-before"], 1000)
+        self.assertEqual(result["db-size-after"], 250)
+        urls = [c.args[0] for c in client.return_value.get_url.call_args_list]
+        self.assertEqual(urls, ["/kv/compaction", "/maintenance/defragment"])
+
+    @patch("charm.SlurmctldCharm._is_leader", return_value=True)
+    @patch("etcd_ops.EtcdOps.maintenance", return_value={})
+    def test_scheduled_etcd_maintenance(self, maintenance, _) -> None:
+        """Test that scheduled etcd maintenance honours the configured interval."""
+        self.harness.charm._stored.etcd_configured = True
+        self.harness.charm._run_scheduled_etcd_maintenance()
+        self.harness.charm._run_scheduled_etcd_maintenance()
+        self.assertEqual(maintenance.call_count, 1)
+
+        self.harness.update_config({"etcd-maintenance-interval": 0})
+        self.harness.charm._stored.etcd_last_maintenance = 0.0
+        self.harness.charm._run_scheduled_etcd_maintenance()
+        self.assertEqual(maintenance.call_count, 1)
+
+    @patch("etcd_ops.EtcdOps._client")
+    def test_etcd_reconcile_members(self, client) -> None:
+        """Test that etcd members are added as learners and departed ones removed."""
+        etcd = self.harness.charm._etcd
+        client.return_value.status.return_value = {"header": {"member_id": "1", "cluster_id": "7"}}
+        client.return_value.members.side_effect = [
+            [
+                {"ID": "1", "name": "osd-etcd", "peerURLs": ["http://localhost:2380"]},
+                {"ID": "2", "name": "slurmctld-2", "peerURLs": ["http://10.0.0.2:2380"]},
+            ],
+            [
+                {
+                    "ID": "1",
+                    "name": "slurmctld-0",
+                    "peerURLs": ["http://10.0.0.0:2380"],
+                    "clientURLs": ["http://10.0.0.0:2379"],
+                },
+            ],
+            [
+                {
+                    "ID": "1",
+                    "name": "slurmctld-0",
+                    "peerURLs": ["http://10.0.0.0:2380"],
+                    "clientURLs": ["http://10.0.0.0:2379"],
+                },
+                {"ID": "3", "name": "", "peerURLs": ["http://10.0.0.1:2380"], "isLearner": True},
+            ],
+        ]
+        desired = {"slurmctld-0": "http://10.0.0.0:2380", "slurmctld-1": "http://10.0.0.1:2380"}
+        cluster = etcd.reconcile_members("pass", desired)
+
+        urls = [c.args[0] for c in client.return_value.get_url.call_args_list]
+        self.assertEqual(
+            urls, ["/cluster/member/update", "/cluster/member/remove", "/cluster/member/add"]
+        )
+        self.assertEqual(cluster["members"], desired)
+        self.assertEqual(cluster["client_urls"], ["http://10.0.0.0:2379"])
+        self.assertEqual(cluster["cluster_id"], "7")
+
+    @patch("etcd_ops.EtcdOps._client")
+    @patch("subprocess.run")
+    @patch("subprocess.call")
+    @patch("subprocess.check_output", side_effect=AssertionError("unexpected fork"))
+    @patch("charm.SlurmctldCharm._on_leader_elected", autospec=True)
+    @patch("charm.SlurmctldCharm._on_etcd_cluster_changed", autospec=True)
+    @patch("charm.SlurmctldCharm._on_write_slurm_config", autospec=True)
+    def test_peer_changed_benchmark(self, _, __, ___, *forks) -> None:
+        """Test that peer relation-changed stays in memory at 3, 5 and 9 controllers."""
+        for controllers in [3, 5, 9]:
+            harness = Harness(SlurmctldCharm)
+            self.addCleanup(harness.cleanup)
+            harness.begin()
+            rel_id = harness.add_relation("slurmctld-peer", "slurmctld")
+            harness.update_relation_data(rel_id, "slurmctld/0", {"ingress-address": "10.0.0.0"})
+            harness.set_leader(True)
+            for i in range(1, controllers):
+                harness.add_relation_unit(rel_id, f"slurmctld/{i}")
+                harness.update_relation_data(
+                    rel_id,
+                    f"slurmctld/{i}",
+                    {"ingress-address": f"10.0.0.{i}", "hostname": f"ctld-{i}", "port": "6817"},
+                )
+
+            peer = harness.charm._slurmctld_peer
+            rounds = 100
+            with patch.dict("os.environ", {"JUJU_CONTEXT_ID": "ctx"}), patch.object(
+                SlurmctldPeer,
+                "_get_active_peers",
+                autospec=True,
+                side_effect=SlurmctldPeer._get_active_peers,
+            ) as get_active_peers:
+                peer._on_relation_changed(None)
+                active_peers = peer._active_peers
+                for _ in range(rounds - 1):
+                    peer._on_relation_changed(None)
+
+            # the peers are listed once per hook, then served from the cache
+            self.assertEqual(get_active_peers.call_count, rounds)
+            self.assertIs(peer._active_peers, active_peers)
+            # no subprocess or etcd calls
+            for mock in forks:
+                mock.assert_not_called()
+
+            app_data = harness.get_relation_data(rel_id, "slurmctld")
+            self.assertEqual(
+                json.loads(app_data["backup_controllers"]), ["slurmctld/1", "slurmctld/2"]
+            )
+            self.assertEqual(
+                json.loads(app_data["standby_controllers"]),
+                [f"slurmctld/{i}" for i in range(3, controllers)],
+            )
+            info = peer.get_slurmctld_info()
+            self.assertEqual(info["backup_controller_hostname"], "ctld-1")
+            self.assertEqual(
+                [b["hostname"] for b in info["backup_controllers"]], ["ctld-1", "ctld-2"]
+            )
+
+    @patch("charm.SlurmctldCharm._on_leader_elected", autospec=True)
+    @patch("charm.SlurmctldCharm._on_etcd_cluster_changed", autospec=True)
+    @patch("charm.SlurmctldCharm._on_write_slurm_config", autospec=True)
+    def test_peer_without_address_is_not_a_backup(self, *_) -> None:
+        """Test that peers become backups only once they published their address."""
+        rel_id = self.harness.add_relation("slurmctld-peer", "slurmctld")
+        self.harness.update_relation_data(rel_id, "slurmctld/0", {"ingress-address": "10.0.0.0"})
+        self.harness.set_leader(True)
+        self.harness.add_relation_unit(rel_id, "slurmctld/1")
+        self.harness.update_relation_data(rel_id, "slurmctld/1", {"ingress-address": "10.0.0.1"})
+
+        app_data = self.harness.get_relation_data(rel_id, "slurmctld")
+        self.assertEqual(app_data["backup_controllers"], "[]")
+        self.assertEqual(app_data["standby_controllers"], '["slurmctld/1"]')
+
+        self.harness.update_relation_data(
+            rel_id, "slurmctld/1", {"hostname": "ctld-1", "port": "6817"}
+        )
+        app_data = self.harness.get_relation_data(rel_id, "slurmctld")
+        self.assertEqual(app_data["backup_controllers"], '["slurmctld/1"]')
+        info = json.loads(app_data["slurmctld_info"])
+        self.assertEqual(info["backup_controller_hostname"], "ctld-1")
+
+    @patch("charm.SlurmctldCharm._on_leader_elected", autospec=True)
+    @patch("charm.SlurmctldCharm._on_etcd_cluster_changed", autospec=True)
+    @patch("charm.SlurmctldCharm._on_write_slurm_config", autospec=True)
+    def test_peer_changed_only_emits_on_controller_change(self, write_config, *_) -> None:
+        """Test that only active/backup controller changes rewrite the config."""
+        self.harness.update_config({"backup-controllers": 1})
+        rel_id = self.harness.add_relation("slurmctld-peer", "slurmctld")
+        self.harness.update_relation_data(rel_id, "slurmctld/0", {"ingress-address": "10.0.0.0"})
+        self.harness.set_leader(True)
+        for i in [1, 2, 3]:
+            self.harness.add_relation_unit(rel_id, f"slurmctld/{i}")
+            self.harness.update_relation_data(
+                rel_id,
+                f"slurmctld/{i}",
+                {"ingress-address": f"10.0.0.{i}", "hostname": f"ctld-{i}", "port": "6817"},
+            )
+        app_data = self.harness.get_relation_data(rel_id, "slurmctld")
+        self.assertEqual(app_data["backup_controller"], "slurmctld/1")
+        write_config.reset_mock()
+
+        # unrelated keys and standby controllers do not matter
+        self.harness.update_relation_data(rel_id, "slurmctld/2", {"etcd_ready": "true"})
+        self.harness.update_relation_data(rel_id, "slurmctld/2", {"ingress-address": "10.0.1.2"})
+        write_config.assert_not_called()
+
+        # a new address of the backup does
+        self.harness.update_relation_data(rel_id, "slurmctld/1", {"ingress-address": "10.0.1.1"})
+        write_config.assert_called_once()
+        info = json.loads(app_data["slurmctld_info"])
+        self.assertEqual(info["backup_controller_ingress_address"], "10.0.1.1")
+
+        # more backups are appended in order, rewriting the config only once
+        write_config.reset_mock()
+        self.harness.update_config({"backup-controllers": 2})
+        write_config.assert_called_once()
+        self.assertEqual(
+            json.loads(app_data["backup_controllers"]), ["slurmctld/1", "slurmctld/2"]
+        )
+
+        # losing a backup keeps the order of the others and promotes a standby
+        write_config.reset_mock()
+        self.harness.remove_relation_unit(rel_id, "slurmctld/1")
+        write_config.assert_called_once()
+        self.assertEqual(
+            json.loads(app_data["backup_controllers"]), ["slurmctld/2", "slurmctld/3"]
+        )
+        self.assertEqual(app_data["backup_controller"], "slurmctld/2")
+        self.assertEqual(app_data["standby_controllers"], "[]")
+
+        # the backups after the first are added to slurm.conf in order
+        with patch.object(
+            SlurmctldCharm, "_slurmd_info", new_callable=PropertyMock, return_value=[{}]
+        ), patch.object(
+            SlurmctldCharm, "slurmdbd_info", new_callable=PropertyMock, return_value={"x": "y"}
+        ), patch.object(
+            SlurmctldCharm,
+            "_cluster_info",
+            new_callable=PropertyMock,
+            return_value={"custom_config": "FirstJobId=10"},
+        ), patch.object(
+            SlurmctldCharm, "_assemble_partitions", return_value=[]
+        ), patch.object(
+            SlurmctldCharm, "_assemble_down_nodes", return_value=[]
+        ):
+            slurm_config = self.harness.charm._assemble_slurm_config()
+        self.assertEqual(slurm_config["backup_controller_hostname"], "ctld-2")
+        custom_config = slurm_config["custom_config"].split("\n")
+        self.assertEqual(custom_config[0], "SlurmctldHost=ctld-3(10.0.0.3)")
+        self.assertEqual(custom_config[-1], "FirstJobId=10")
+
+    @patch("state_sync_ops.StateSyncOps.stop")
+    @patch("state_sync_ops.StateSyncOps.setup_client")
+    def test_standby_mirrors_leader(self, setup_client, stop_state_sync) -> None:
+        """Test that a non-leader installs the keys and renders slurm.conf once."""
+        self.harness.charm._stored.slurm_installed = True
+        self.harness.update_config({"state-sync-interval": 30})
+        manager = self.harness.charm._slurm_manager
+        slurm_config = {"active_controller_hostname": "ctld-0"}
+        with patch.object(manager, "configure_munge_key") as configure_munge_key, patch.object(
+            manager, "render_slurm_configs"
+        ) as render, patch.object(manager, "slurm_systemctl") as systemctl, patch.object(
+            SlurmctldCharm, "_assemble_slurm_config", return_value=slurm_config
+        ), patch.object(
+            SlurmctldCharm,
+            "_slurmctld_info",
+            new_callable=PropertyMock,
+            return_value={"active_controller_ingress_address": "10.0.0.0"},
+        ):
+            rel_id = self.harness.add_relation("slurmctld-peer", "slurmctld")
+            self.harness.add_relation_unit(rel_id, "slurmctld/1")
+            self.harness.update_relation_data(
+                rel_id,
+                "slurmctld",
+                {"munge_key": "MUNGE", "jwt_rsa": "JWT", "state_sync_secret": "secret"},
+            )
+            # standbys pull the state of the leader
+            setup_client.assert_called_with("10.0.0.0", "secret", 30)
+            setup_client.reset_mock()
+            stop_state_sync.reset_mock()
+
+            self.harness.update_relation_data(
+                rel_id, "slurmctld", {"backup_controllers": '["slurmctld/0"]'}
+            )
+            self.harness.update_relation_data(rel_id, "slurmctld", {"other": "value"})
+
+            configure_munge_key.assert_called_once_with("MUNGE")
+            self.assertEqual(self.harness.charm.get_jwt_rsa(), "JWT")
+            # rendered as a standby, then once more when promoted to backup
+            render.assert_called_with(slurm_config)
+            self.assertEqual(render.call_count, 2)
+            self.assertEqual(systemctl.call_args_list, [call("stop"), call("restart")])
+            # backups run slurmctld, so they are never synced into
+            setup_client.assert_not_called()
+            stop_state_sync.assert_called()
+
+    @patch("subprocess.call", return_value=1)
+    @patch("shutil.which", return_value="/usr/bin/rsync")
+    def test_state_sync_server(self, _, systemctl) -> None:
+        """Test that the rsync daemon serves the state only to the peers."""
+        state_sync = self.harness.charm._state_sync
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            state_sync._path = Path(tmp_dir) / "sync"
+            state_sync._rsyncd_config = state_sync._path / "rsyncd.conf"
+            state_sync._secrets_file = state_sync._path / "rsyncd.secrets"
+            state_sync._systemd = SystemdOps(state_sync._path, systemd_path=Path(tmp_dir))
+
+            with patch.object(
+                self.harness.charm._slurm_manager,
+                "get_slurm_conf",
+                return_value="StateSaveLocation=/var/spool/slurmctld\nStateSaveLocation=/shared\n",
+            ):
+                state_sync.setup_server("10.0.0.0", ["10.0.0.2", "10.0.0.1"], "secret")
+
+            rsyncd_config = state_sync._rsyncd_config.read_text()
+            self.assertIn("path = /shared\n", rsyncd_config)
+            self.assertIn("hosts allow = 10.0.0.1 10.0.0.2\n", rsyncd_config)
+            self.assertIn(
+                "pre-xfer exec = /bin/systemctl is-active --quiet slurmctld", rsyncd_config
+            )
+            self.assertEqual(state_sync._secrets_file.stat().st_mode & 0o777, 0o600)
+            systemctl.assert_any_call(
+                ["systemctl", "restart", "slurmctld-state-sync-server.service"]
+            )
+
+            # nothing changed, and the daemon is running
+            systemctl.reset_mock()
+            systemctl.return_value = 0
+            with patch.object(
+                self.harness.charm._slurm_manager,
+                "get_slurm_conf",
+                return_value="StateSaveLocation=/shared\n",
+            ):
+                state_sync.setup_server("10.0.0.0", ["10.0.0.1", "10.0.0.2"], "secret")
+            self.assertNotIn(
+                call(["systemctl", "restart", "slurmctld-state-sync-server.service"]),
+                systemctl.call_args_list,
+            )
+
+    def test_slurmctld_tuning(self) -> None:
+        """Test that the communication settings scale with the cluster."""
+        slurmctld_ops = self.harness.charm._slurmctld_ops
+        slurmctld_ops._slurm_version = (23, 2)
+
+        def slurmd_info(node_count):
+            nodes = [{"node_name": f"node-{i}"} for i in range(node_count)]
+            return [
+                {"inventory": nodes[: node_count // 2]},
+                {"inventory": nodes[node_count // 2 :]},
+            ]
+
+        self.assertEqual(
+            slurmctld_ops.slurm_conf_lines(slurmd_info(4)),
+            [
+                "TreeWidth=16",
+                "MessageTimeout=10",
+                "TCPTimeout=2",
+                "SlurmdTimeout=300",
+                "SlurmctldTimeout=120",
+                "SlurmctldParameters=enable_configless",
+            ],
+        )
+        # two levels up to 2500 nodes, three above
+        self.assertEqual(slurmctld_ops.tuning(slurmd_info(2500))["TreeWidth"], 50)
+        self.assertEqual(slurmctld_ops.tuning(slurmd_info(10000))["TreeWidth"], 22)
+        tuning = slurmctld_ops.tuning(slurmd_info(4000))
+        self.assertEqual(tuning["TreeWidth"], 16)
+        self.assertEqual(tuning["MessageTimeout"], 30)
+        self.assertEqual(tuning["SlurmdTimeout"], 600)
+        self.assertEqual(tuning["SlurmctldParameters"], "enable_configless,enable_rpc_queue")
+        slurmctld_ops._slurm_version = (22, 5)
+        tuning = slurmctld_ops.tuning(slurmd_info(4000))
+        self.assertEqual(tuning["SlurmctldParameters"], "enable_configless")
+        slurmctld_ops._slurm_version = (23, 2)
+
+        # SlurmctldParameters from custom-config are merged into a single line
+        custom_config = "SlurmctldParameters=idle_on_node_suspend\nFirstJobId=10"
+        self.harness.update_config({"custom-config": custom_config})
+        tuning = slurmctld_ops.tuning(slurmd_info(4000))
+        self.assertEqual(
+            tuning["SlurmctldParameters"],
+            "enable_configless,enable_rpc_queue,idle_on_node_suspend",
+        )
+        self.assertEqual(strip_slurmctld_parameters(custom_config), "FirstJobId=10")
+        self.harness.update_config({"custom-config": ""})
+
+        # explicit values win over the derived ones
+        self.harness.update_config({"message-timeout": "15", "slurmd-timeout": "0"})
+        tuning = slurmctld_ops.tuning(slurmd_info(4000))
+        self.assertEqual((tuning["MessageTimeout"], tuning["SlurmdTimeout"]), (15, 0))
+        self.assertEqual(slurmctld_ops.check_config([]), "")
+
+        self.harness.update_config({"slurmctld-timeout": 10})
+        self.assertIn("slurmctld-timeout", slurmctld_ops.check_config([]))
+        self.harness.update_config({"slurmctld-timeout": 120, "message-timeout": "101"})
+        self.assertIn("message-timeout", slurmctld_ops.check_config([]))
+        self.harness.update_config({"message-timeout": "soon"})
+        self.assertIn("message-timeout", slurmctld_ops.check_config([]))
+
+    def test_scheduler_profile(self) -> None:
+        """Test the SchedulerParameters presets and their overrides."""
+        slurmctld_ops = self.harness.charm._slurmctld_ops
+        slurmctld_ops._slurm_version = (23, 2)
+        self.assertFalse(
+            any(line.startswith("Sched") for line in slurmctld_ops.slurm_conf_lines([]))
+        )
+
+        self.harness.update_config(
+            {
+                "scheduler-profile": "htc",
+                "scheduler-parameters": "bf_window=4320,-defer,bf_max_job_user=10",
+            }
+        )
+        self.assertEqual(slurmctld_ops.check_config([]), "")
+        self.assertEqual(
+            slurmctld_ops.slurm_conf_lines([])[-1],
+            "SchedulerParameters=batch_sched_delay=20,bf_continue,bf_interval=60,"
+            "bf_max_job_test=500,bf_max_job_user=10,bf_resolution=600,bf_window=4320,"
+            "default_queue_depth=1000,max_rpc_cnt=150,sched_min_interval=2000000",
+        )
+
+        slurmctld_ops._slurm_version = (15, 2)
+        self.assertIn("sched_min_interval requires Slurm 15.08", slurmctld_ops.check_config([]))
+
+        self.harness.update_config({"scheduler-parameters": "bf_window=week"})
+        self.assertIn("bf_window must be a number", slurmctld_ops.check_config([]))
+        self.harness.update_config({"scheduler-parameters": "bf_window"})
+        self.assertIn("bf_window must be a number", slurmctld_ops.check_config([]))
+        self.harness.update_config({"scheduler-parameters": "defer=5"})
+        self.assertIn("defer is a flag", slurmctld_ops.check_config([]))
+        self.harness.update_config({"scheduler-parameters": "bf_magic=1"})
+        self.assertIn("unsupported parameter bf_magic", slurmctld_ops.check_config([]))
+        self.harness.update_config({"scheduler-profile": "fast", "scheduler-parameters": ""})
+        self.assertIn("scheduler-profile", slurmctld_ops.check_config([]))
+
+    @patch("subprocess.check_output")
+    def test_rpc_rate_limit(self, check_output) -> None:
+        """Test the RPC rate limiting settings and the sdiag counters."""
+        slurmctld_ops = self.harness.charm._slurmctld_ops
+        slurmctld_ops._slurm_version = (23, 2)
+        self.harness.update_config({"rpc-rate-limit": True, "max-rpc-count": 80})
+        self.assertEqual(slurmctld_ops.check_config([]), "")
+        lines = slurmctld_ops.slurm_conf_lines([])
+        self.assertIn(
+            "SlurmctldParameters=enable_configless,"
+            "rl_enable,rl_bucket_size=30,rl_refill_rate=2,rl_refill_period=1",
+            lines,
+        )
+        self.assertEqual(lines[-1], "SchedulerParameters=max_rpc_cnt=80")
+
+        # a single line, merged with custom-config, whose values win
+        self.harness.update_config(
+            {"custom-config": "SlurmctldParameters=rl_bucket_size=50,rl_log_freq=10"}
+        )
+        lines = slurmctld_ops.slurm_conf_lines([])
+        self.assertEqual(
+            [line for line in lines if line.startswith("SlurmctldParameters")],
+            [
+                "SlurmctldParameters=enable_configless,rl_enable,rl_bucket_size=50,"
+                "rl_refill_rate=2,rl_refill_period=1,rl_log_freq=10"
+            ],
+        )
+        self.harness.update_config({"custom-config": ""})
+
+        check_output.return_value = (
+            b"*******************************************************\n"
+            b"sdiag output at Tue Oct 17 10:00:00 2023 (1697536800)\n"
+            b"Server thread count:  12\n"
+            b"Agent queue size:     3\n"
+            b"\n"
+            b"Main schedule statistics (microseconds):\n"
+            b"\tLast cycle:   1234\n"
+            b"Backfilling stats\n"
+            b"\tLast cycle when: Tue Oct 17 09:59:00 2023 (1697536740)\n"
+            b"\tLast cycle: 23456\n"
+            b"\n"
+            b"Remote Procedure Call statistics by message type\n"
+            b"\tREQUEST_JOB_INFO      ( 2003) count:900  ave_time:300  total_time:270000\n"
+            b"\tREQUEST_NODE_INFO     ( 2007) count:100  ave_time:100  total_time:10000\n"
+            b"\n"
+            b"Remote Procedure Call statistics by user\n"
+            b"\talice           (    1000) count:950    ave_time:280   total_time:266000\n"
+            b"\troot            (       0) count:50     ave_time:280   total_time:14000\n"
+            b"\n"
+            b"Pending RPC statistics\n"
+            b"\tREQUEST_TERMINATE_JOB ( 6011) count:2\n"
+        )
+        stats = parse_sdiag(check_output.return_value.decode())
+        self.assertEqual((stats["main_last_cycle"], stats["backfill_last_cycle"]), (1234, 23456))
+
+        self.assertEqual(
+            slurmctld_ops.rpc_stats(top=1),
+            {
+                "server-thread-count": 12,
+                "max-rpc-count": "80",
+                "rpc-rate-limit": "enabled",
+                "agent-queue-size": 3,
+                "pending-rpcs": 2,
+                "rpc-count": 1000,
+                "top-users": "alice:950",
+                "top-message-types": "REQUEST_JOB_INFO:900",
+            },
+        )
+
+        slurmctld_ops._slurm_version = (22, 5)
+        self.assertIn("requires Slurm 23.02", slurmctld_ops.check_config([]))
+
+    @patch("influxdb.InfluxDBClient")
+    @patch("subprocess.check_output")
+    def test_sdiag_collector(self, check_output, influxdb_client) -> None:
+        """Test that the sdiag statistics are written in batches, and kept on failure."""
+        check_output.return_value = (
+            b"Server thread count:  4\n"
+            b"Backfilling stats\n"
+            b"\tLast cycle: 23456\n"
+            b"Remote Procedure Call statistics by user\n"
+            b"\talice           (    1000) count:950    ave_time:280   total_time:266000\n"
+            b"Pending RPC statistics\n"
+            b"\tREQUEST_TERMINATE_JOB ( 6011) count:2\n"
+        )
+        collector = SdiagCollector(
+            {
+                "ingress": "10.0.0.9",
+                "port": "8086",
+                "user": "slurm",
+                "password": "secret",
+                "database": "cluster",
+                "retention_policy": "autogen",
+                "cluster": "cluster",
+                "host": "ctld-0",
+                "max_buffered_points": 4,
+            }
+        )
+        client = influxdb_client.return_value
+
+        client.write_points.side_effect = ConnectionError
+        collector.collect()
+        collector.write()
+        collector.collect()
+        # the oldest points are dropped
+        self.assertEqual(len(collector._buffer), 4)
+
+        client.write_points.side_effect = None
+        collector.write()
+        batch = client.write_points.call_args.args[0]
+        self.assertEqual(
+            batch[-3:],
+            [
+                {
+                    "measurement": "slurmctld",
+                    "tags": {"cluster": "cluster", "host": "ctld-0"},
+                    "time": batch[-1]["time"],
+                    "fields": {"server_thread_count": 4, "backfill_last_cycle": 23456},
+                },
+                {
+                    "measurement": "slurmctld_rpc_user",
+                    "tags": {"cluster": "cluster", "host": "ctld-0", "user": "alice"},
+                    "time": batch[-1]["time"],
+                    "fields": {"count": 950, "ave_time": 280, "total_time": 266000},
+                },
+                {
+                    "measurement": "slurmctld_pending_rpc",
+                    "tags": {
+                        "cluster": "cluster",
+                        "host": "ctld-0",
+                        "type": "REQUEST_TERMINATE_JOB",
+                    },
+                    "time": batch[-1]["time"],
+                    "fields": {"count": 2},
+                },
+            ],
+        )
+        self.assertEqual(client.write_points.call_args.kwargs["retention_policy"], "autogen")
+        self.assertEqual(collector._buffer, [])
+
+    @patch("subprocess.check_output")
+    def test_prometheus_exporter(self, check_output) -> None:
+        """Test that scrapes are served from the snapshot without querying Slurm."""
+        outputs = {
+            "sinfo": b"node-1|debug*|idle|0/4/0/4\nnode-1|batch|idle|0/4/0/4\n"
+            b"node-2|batch|allocated|8/0/0/8\n",
+            "squeue": b"batch|RUNNING\nbatch|PENDING\nbatch|PENDING\n",
+        }
+
+        def run(cmd, **kwargs):
+            if cmd[0] not in outputs:
+                raise subprocess.CalledProcessError(1, cmd, b"slurmctld is down")
+            return outputs[cmd[0]]
+
+        check_output.side_effect = run
+        exporter = PrometheusExporter({"port": 0})
+        exporter.take_snapshot()
+        snapshot = exporter.snapshot.decode()
+        self.assertIn('slurm_nodes{state="idle"} 1\n', snapshot)
+        self.assertIn('slurm_partition_nodes{partition="debug",state="idle"} 1\n', snapshot)
+        self.assertIn('slurm_cpus{state="allocated"} 8\n', snapshot)
+        self.assertIn('slurm_cpus{state="total"} 12\n', snapshot)
+        self.assertIn('slurm_jobs{partition="batch",state="pending"} 2\n', snapshot)
+        self.assertIn("slurm_exporter_errors_total 1\n", snapshot)
+
+        outputs["sdiag"] = (
+            b"Server thread count:  12\n"
+            b"Remote Procedure Call statistics by message type\n"
+            b"\tREQUEST_JOB_INFO      ( 2003) count:900  ave_time:300  total_time:270000\n"
+            b"\n"
+            b"Remote Procedure Call statistics by user\n"
+            b"\talice           (    1000) count:950    ave_time:280   total_time:266000\n"
+        )
+        exporter.take_snapshot()
+        snapshot = exporter.snapshot.decode()
+        self.assertIn("slurmctld_server_thread_count 12\n", snapshot)
+        self.assertIn("# TYPE slurmctld_rpc_by_type_total counter\n", snapshot)
+        self.assertIn('slurmctld_rpc_by_type_total{type="REQUEST_JOB_INFO"} 900\n', snapshot)
+        self.assertIn(
+            'slurmctld_rpc_by_user_time_microseconds_total{user="alice"} 266000\n', snapshot
+        )
+        self.assertIn("slurm_exporter_errors_total 1\n", snapshot)
+
+        server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), exporter.handler())
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.shutdown)
+        check_output.reset_mock()
+        for _ in range(3):
+            url = f"http://127.0.0.1:{server.server_port}/metrics"
+            with urllib.request.urlopen(url) as response:
+                self.assertEqual(response.read().decode(), snapshot)
+        check_output.assert_not_called()
+
+        # an unexpected error keeps the snapshot thread alive
+        with patch("time.sleep", side_effect=[None, None, StopIteration]), patch.object(
+            exporter, "take_snapshot", side_effect=[ValueError("bad output"), None]
+        ) as take_snapshot:
+            with self.assertRaises(StopIteration):
+                exporter._take_snapshots()
+        self.assertEqual(take_snapshot.call_count, 2)
+
+    def test_prometheus_exporter_config(self) -> None:
+        """Test that the exporter port and interval are validated."""
+        metrics = self.harness.charm._metrics
+        self.assertEqual(metrics.check_config(), "")
+        self.harness.update_config({"prometheus-exporter-port": 70000})
+        self.assertIn("prometheus-exporter-port", metrics.check_config())
+        self.harness.update_config({"prometheus-exporter-port": 9100})
+        self.harness.update_config({"prometheus-exporter-interval": 0})
+        self.assertIn("prometheus-exporter-interval", metrics.check_config())
+
+    @patch("charm.SlurmctldCharm._on_leader_elected", autospec=True)
+    def test_slurmrestd_cache_config(self, _) -> None:
+        """Test that the slurmrestd cache is configured on the relation when it changes."""
+        # the options do not block the unit without slurmrestd
+        self.harness.update_config({"slurmrestd-cache-ttls": "diag=5"})
+        self.assertEqual(self.harness.charm._slurmrestd.check_config(), "")
+        self.harness.update_config({"slurmrestd-cache-ttls": ""})
+
+        relation_id = self.harness.add_relation("slurmrestd", "slurmrestd")
+        self.harness.set_leader(True)
+        slurmrestd = self.harness.charm._slurmrestd
+
+        slurmrestd.set_cache_config_on_app_relation_data()
+        app_data = self.harness.get_relation_data(relation_id, "slurmctld")
+        self.assertNotIn("cache_config", app_data)
+
+        self.harness.update_config({"slurmrestd-cache-ttls": "jobs=5, nodes=30"})
+        self.assertEqual(slurmrestd.check_config(), "")
+        slurmrestd.set_cache_config_on_app_relation_data()
+        cache_config = json.loads(app_data["cache_config"])
+        self.assertTrue(cache_config["coalesce"] and cache_config["etag"])
+        self.assertEqual(cache_config["methods"], ["GET", "HEAD"])
+        self.assertEqual(
+            {endpoint: c["ttl"] for endpoint, c in cache_config["endpoints"].items()},
+            {"jobs": 5, "nodes": 30},
+        )
+        self.assertRegex("/slurm/v0.0.39/job/42", cache_config["endpoints"]["jobs"]["path"])
+        self.assertNotRegex(
+            "/slurm/v0.0.39/job/submit/x", cache_config["endpoints"]["jobs"]["path"]
+        )
+
+        self.harness.update_config({"slurmrestd-cache-ttls": "diag=5"})
+        self.assertIn("diag is not one of", slurmrestd.check_config())
+        self.harness.update_config({"slurmrestd-cache-ttls": "jobs=soon"})
+        self.assertIn("must be a positive number", slurmrestd.check_config())
+        # an invalid configuration disables the cache
+        slurmrestd.set_cache_config_on_app_relation_data()
+        self.assertNotIn("cache_config", app_data)
+
+    @patch("charm.SlurmctldCharm._on_leader_elected", autospec=True)
+    def test_slurmrestd_slurm_config(self, _) -> None:
+        """Test that slurm_config is sent compressed, and only when it changed."""
+        relation_id = self.harness.add_relation("slurmrestd", "slurmrestd")
+        self.harness.set_leader(True)
+        self.harness.update_relation_data(relation_id, "slurmctld", {"slurm_config": "{}"})
+        slurmrestd = self.harness.charm._slurmrestd
+
+        def app_data():
+            return self.harness.get_relation_data(relation_id, "slurmctld")
+
+        nodes = [{"node_name": f"node-{i}", "cpus": 64} for i in range(1000)]
+        slurm_config = {
+            "cluster_name": "cluster",
+            "partitions": [{"partition_name": "batch", "inventory": nodes}],
+            "down_nodes": [],
+        }
+        self.assertTrue(slurmrestd.set_slurm_config_on_app_relation_data(slurm_config))
+        # the plain JSON is kept until slurmrestd supports the sections
+        self.assertEqual(json.loads(app_data()["slurm_config"]), slurm_config)
+        self.assertEqual(app_data()["slurm_config_version"], "2")
+        self.assertEqual(decode_slurm_config(app_data()), slurm_config)
+
+        self.harness.update_relation_data(
+            relation_id, "slurmrestd", {"slurm_config_versions": "1,2"}
+        )
+        self.assertTrue(slurmrestd.set_slurm_config_on_app_relation_data(slurm_config))
+        self.assertNotIn("slurm_config", app_data())
+        self.assertEqual(decode_slurm_config(app_data()), slurm_config)
+        size = sum(len(value) for key, value in app_data().items() if key.startswith("slurm_"))
+        self.assertLess(size * 10, len(json.dumps(slurm_config)))
+
+        self.assertFalse(slurmrestd.set_slurm_config_on_app_relation_data(slurm_config))
+
+        # only the changed section is rewritten
+        slurm_config["down_nodes"] = ["node-1"]
+        setitem = ops.model.RelationDataContent.__setitem__
+        with patch.object(
+            ops.model.RelationDataContent, "__setitem__", autospec=True, side_effect=setitem
+        ) as written:
+            self.assertTrue(slurmrestd.set_slurm_config_on_app_relation_data(slurm_config))
+        self.assertEqual(
+            [c.args[1] for c in written.call_args_list],
+            ["slurm_config_hash", "slurm_config_nodes"],
+        )
+        self.assertEqual(decode_slurm_config(app_data())["down_nodes"], ["node-1"])
+
+    @patch("charm.SlurmctldCharm._on_leader_elected", autospec=True)
+    def test_slurmrestd_restart(self, _) -> None:
+        """Test that slurmrestd is only restarted when the config it uses changed."""
+        relation_id = self.harness.add_relation("slurmrestd", "slurmrestd")
+        self.harness.set_leader(True)
+        slurmrestd = self.harness.charm._slurmrestd
+
+        def restart_token(slurm_config):
+            slurmrestd.set_slurm_config_on_app_relation_data(slurm_config)
+            slurmrestd.restart_slurmrestd()
+            app_data = self.harness.get_relation_data(relation_id, "slurmctld")
+            self.assertEqual(app_data["restart_slurmrestd_mode"], "reload-or-restart")
+            return app_data["restart_slurmrestd_uuid"]
+
+        slurm_config = {
+            "cluster_name": "cluster",
+            "custom_config": "TreeWidth=16\nSlurmdTimeout=300",
+            "partitions": [],
+            "down_nodes": [],
+        }
+        token = restart_token(slurm_config)
+        self.assertEqual(restart_token(slurm_config), token)
+        # slurmrestd does not use the nodes, nor the settings derived from their number
+        slurm_config["down_nodes"] = ["node-1"]
+        self.assertEqual(restart_token(slurm_config), token)
+        slurm_config["custom_config"] = "TreeWidth=17\nSlurmdTimeout=600"
+        self.assertEqual(restart_token(slurm_config), token)
+        slurm_config["custom_config"] = "TreeWidth=17\nMessageTimeout=20"
+        self.assertNotEqual(restart_token(slurm_config), token)
+        slurm_config["custom_config"] = "TreeWidth=16\nSlurmdTimeout=300"
+        slurm_config["cluster_name"] = "other"
+        self.assertNotEqual(restart_token(slurm_config), token)
+
+        self.harness.update_config({"slurmrestd-restart-mode": "kill"})
+        self.assertIn("slurmrestd-restart-mode", slurmrestd.check_config())
+
+    @patch("os.cpu_count", return_value=4)
+    def test_job_table_sizing(self, _) -> None:
+        """Test that the job table is sized from the host memory and the workload."""
+        slurmctld_ops = self.harness.charm._slurmctld_ops
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        slurmctld_ops._meminfo = Path(tmp_dir.name) / "meminfo"
+        slurmctld_ops._meminfo.write_text("MemTotal:        8388608 kB\nMemFree: 1024 kB\n")
+        self.assertFalse(
+            any(line.startswith("MaxJobCount") for line in slurmctld_ops.slurm_conf_lines([]))
+        )
+
+        self.harness.update_config({"job-submission-rate": 10000, "average-array-size": 1000})
+        sizing = slurmctld_ops.job_table_sizing()
+        self.assertEqual(sizing["budget-bytes"], 4 * 1024**3)
+        # (4 GiB - 512 MiB) / 16 KiB records, below the 4 * 100000 CPU cap
+        self.assertEqual(sizing["max-job-count"], 229376)
+        # half the table holds 41 seconds of 10 million records per hour
+        self.assertEqual(sizing["min-job-age"], 41)
+        self.assertEqual(sizing["max-array-size"], 4001)
+        self.assertEqual(
+            slurmctld_ops.slurm_conf_lines([], sizing)[-3:],
+            ["MaxJobCount=229376", "MinJobAge=41", "MaxArraySize=4001"],
+        )
+
+        # the leader shares its sizing, the standbys never size from their host
+        rel_id = self.harness.add_relation("slurmctld-peer", "slurmctld")
+        with patch("charm.SlurmctldCharm._on_leader_elected", autospec=True):
+            self.harness.set_leader(True)
+        self.assertEqual(self.harness.charm._job_table_sizing(), sizing)
+        app_data = self.harness.get_relation_data(rel_id, "slurmctld")
+        self.assertEqual(json.loads(app_data["job_table_sizing"]), sizing)
+        self.harness.set_leader(False)
+        with patch.object(slurmctld_ops, "job_table_sizing") as job_table_sizing:
+            self.assertEqual(self.harness.charm._job_table_sizing(), sizing)
+        job_table_sizing.assert_not_called()
+
+        # a slow submission rate keeps Slurm's default MinJobAge
+        self.assertEqual(slurmctld_ops.job_table_sizing(100, 1)["min-job-age"], 300)
+
+        self.harness.update_config({"slurmctld-memory-budget": 0})
+        self.assertIn("slurmctld-memory-budget", slurmctld_ops.check_config([]))
+
+    @patch("time.sleep")
+    @patch("subprocess.call")
+    def test_failover_benchmark(self, systemctl, _) -> None:
+        """Test that the failover benchmark times the takeover of the backup and the job."""
+        standby = "Slurmctld(primary) at ctld-0 is UP\nSlurmctld(backup) at ctld-1 is UP\n"
+        killed = "Slurmctld(primary) at ctld-0 is DOWN\nSlurmctld(backup) at ctld-1 is UP\n"
+        pings = iter([standby, standby, killed])
+        in_standby = subprocess.CalledProcessError(1, "scontrol", b"Slurm backup in standby mode")
+        outputs = iter(
+            [
+                in_standby,
+                in_standby,
+                b"Configuration data as of ...",
+                subprocess.CalledProcessError(1, "sbatch", b"Socket timed out"),
+                b"42",
+                b"PENDING",
+                b"RUNNING",
+            ]
+        )
+        commands = []
+
+        def check_output(cmd, **kwargs):
+            commands.append(cmd[0:2])
+            output = next(outputs)
+            if isinstance(output, Exception):
+                raise output
+            return output
+
+        clock = iter(range(100))
+        with patch("subprocess.run") as run, patch(
+            "subprocess.check_output", side_effect=check_output
+        ), patch("time.monotonic", side_effect=lambda: next(clock)):
+            run.side_effect = lambda *a, **kw: MagicMock(stdout=next(pings).encode())
+            results = self.harness.charm._slurmctld_ops.failover_benchmark(60, "debug")
+
+        # the backup answers ping in standby, only the config RPC marks the takeover
+        self.assertEqual(run.call_count, 3)
+        self.assertEqual(commands[:3], [["scontrol", "show"]] * 3)
+        self.assertEqual(results["job-id"], "42")
+        self.assertLess(results["primary-down-seconds"], results["takeover-seconds"])
+        self.assertLess(results["takeover-seconds"], results["job-started-seconds"])
+        self.assertEqual(
+            systemctl.call_args_list,
+            [
+                call(["systemctl", "kill", "--signal=SIGKILL", "slurmctld"]),
+                call(["systemctl", "stop", "slurmctld"]),
+                call(["systemctl", "start", "slurmctld"]),
+            ],
+        )
+
+    @patch("slurmctld_ops.SlurmctldOps.failover_benchmark")
+    @patch("charm.SlurmctldCharm._on_leader_elected", autospec=True)
+    def test_failover_benchmark_refused_with_state_sync(self, _, failover_benchmark) -> None:
+        """Test that the failover benchmark is refused while the state is synced."""
+        self.harness.set_leader(True)
+        self.harness.update_config({"state-sync-interval": 30})
+        event = MagicMock(params={})
+        self.harness.charm._failover_benchmark_action(event)
+        event.fail.assert_called_once()
+        failover_benchmark.assert_not_called()
+
+        self.harness.update_config({"state-sync-interval": 0})
+        event = MagicMock(params={})
+        self.harness.charm._failover_benchmark_action(event)
+        event.fail.assert_not_called()
+        failover_benchmark.assert_called_once_with(600, "")
+
+    @patch("etcd_ops.EtcdOps.join")
+    def test_join_etcd_cluster(self, join) -> None:
+        """Test that a non-leader joins the etcd cluster once it was added."""
+        rel_id = self.harness.add_relation("slurmctld-peer", "slurmctld")
+        self.harness.add_relation_unit(rel_id, "slurmctld/1")
+        self.harness.update_relation_data(
+            rel_id,
+            "slurmctld",
+            {
+                "etcd_cluster": '{"members": {"slurmctld-1": "http://10.0.0.1:2380"}}',
+                "etcd_root_pass": "root",
+                "etcd_slurmd_pass": "slurmd",
+            },
+        )
+        join.assert_not_called()
+
+        self.harness.update_relation_data(
+            rel_id,
+            "slurmctld",
+            {
+                "etcd_cluster": (
+                    '{"members": {"slurmctld-1": "http://10.0.0.1:2380", '
+                    '"slurmctld-0": "http://10.0.0.0:2380"}}'
+                ),
+            },
+        )
+        join.assert_called_once_with(
+            "slurmctld-1=http://10.0.0.1:2380,slurmctld-0=http://10.0.0.0:2380"
+        )
+        self.assertTrue(self.harness.charm._stored.etcd_configured)
+        self.assertEqual(self.harness.charm._stored.etcd_root_pass, "root")
+
+    @patch("etcd_ops.EtcdOps.join")
+    @patch("etcd_ops.EtcdOps.reset")
+    @patch("etcd_ops.EtcdOps.configure")
+    @patch("etcd_ops.EtcdOps.cluster_id", return_value="99")
+    def test_upgrade_non_leader_joins_etcd_cluster(self, cluster_id, configure, reset, join):
+        """Test that an upgraded non-leader leaves its own etcd and joins the leader's."""
+        rel_id = self.harness.add_relation("slurmctld-peer", "slurmctld")
+        self.harness.add_relation_unit(rel_id, "slurmctld/1")
+        cluster = {
+            "members": {
+                "slurmctld-1": "http://10.0.0.1:2380",
+                "slurmctld-0": "http://10.0.0.0:2380",
+            },
+            "cluster_id": "7",
+        }
+        with patch.object(SlurmctldCharm, "_on_etcd_cluster_changed"):
+            self.harness.update_relation_data(
+                rel_id,
+                "slurmctld",
+                {
+                    "etcd_cluster": json.dumps(cluster),
+                    "etcd_root_pass": "root",
+                    "etcd_slurmd_pass": "slurmd",
+                },
+            )
+        # set up by an older revision, with an etcd cluster of its own
+        self.harness.charm._stored.etcd_configured = True
+        self.harness.charm._stored.etcd_root_pass = "standalone"
+
+        with patch("charm.Path") as path, patch.object(
+            self.harness.charm.model.resources, "fetch", side_effect=ModelError("no resource")
+        ):
+            path.return_value.read_text.return_value = "2.0\n"
+            self.harness.charm._on_upgrade(MagicMock())
+
+        configure.assert_not_called()
+        reset.assert_called_once()
+        join.assert_called_once_with(
+            "slurmctld-1=http://10.0.0.1:2380,slurmctld-0=http://10.0.0.0:2380"
+        )
+        self.assertTrue(self.harness.charm._stored.etcd_configured)
+        self.assertEqual(self.harness.charm._stored.etcd_root_pass, "root")
+
+        # once in the cluster of the leader, it stays there
+        cluster_id.return_value = "7"
+        join.reset_mock()
+        self.harness.charm._join_etcd_cluster()
+        self.harness.charm._join_etcd_cluster()
+        self.assertEqual(cluster_id.call_count, 2)
+        join.assert_not_called()
+
+    def test_etcd_jwt_auth_token(self) -> None:
+        """Test that etcd is configured with JWT auth tokens once a key exists."""
+        etcd = self.harness.charm._etcd
+        self.assertNotIn("ETCD_AUTH_TOKEN", etcd._render_environment_file())
+
+        self.harness.charm._stored.etcd_jwt_key = "KEY"
+        self.harness.update_config({"etcd-auth-token-ttl": "30m"})
+        env = etcd._render_environment_file()
+        self.assertIn("ETCD_AUTH_TOKEN=jwt,pub-key=/var/lib/etcd/jwt/jwt.pub,", env)
+        self.assertIn("sign-method=RS256,ttl=30m\n", env)
+
+        self.harness.update_config({"etcd-auth-token-ttl": "forever"})
+        self.assertIn("etcd-auth-token-ttl", etcd.check_config())
+
+    def test_etcd_async_client(self) -> None:
+        """Test that the async etcd client bounds concurrency and reauthenticates once."""
+        client = Etcd3AuthClient(username="root", password="pass")
+        client.session.headers["Authorization"] = "expired"
+        lock = threading.Lock()
+        in_flight = []
+        peak = []
+
+        def post(self, url, json):
+            with lock:
+                in_flight.append(url)
+                peak.append(len(in_flight))
+            time.sleep(0.01)
+            with lock:
+                in_flight.remove(url)
+            if self.session.headers["Authorization"] != "token":
+                raise Etcd3Exception("invalid auth token")
+            return {}
+
+        def authenticate(self):
+            time.sleep(0.01)
+            self.session.headers["Authorization"] = "token"
+
+        with patch("omnietcd3.Etcd3Client.post", post), patch.object(
+            Etcd3AuthClient, "authenticate", autospec=True, side_effect=authenticate
+        ) as mock_authenticate:
+            client.put_many({f"key-{i}": "value" for i in range(20)}, max_in_flight=4)
+            mock_authenticate.assert_called_once()
+            self.assertLessEqual(max(peak), 4)
+
+    def test_etcd_benchmark_summaries(self) -> None:
+        """Test the etcd benchmark latency and histogram summaries."""
+        summary = _latency_summary([0.001 * i for i in range(1, 101)], 2.0)
+        self.assertEqual(summary["count"], 100)
+        self.assertEqual(summary["p50-ms"], 51.0)
+        self.assertEqual(summary["p99-ms"], 100.0)
+        self.assertEqual(summary["ops-per-second"], 50.0)
+        self.assertEqual(_latency_summary([], 1.0), {})
+
+        metrics = "\n".join(
+            [
+                "# TYPE etcd_disk_wal_fsync_duration_seconds histogram",
+                'etcd_disk_wal_fsync_duration_seconds_bucket{le="0.001"} 10',
+                'etcd_disk_wal_fsync_duration_seconds_bucket{le="+Inf"} 20',
+                "etcd_disk_wal_fsync_duration_seconds_sum 0.04",
+                "etcd_disk_wal_fsync_duration_seconds_count 20",
+            ]
+        )
+        histogram = _parse_histogram(metrics, "etcd_disk_wal_fsync_duration_seconds")
+        self.assertEqual(histogram["buckets"], "0.001:10 +Inf:20")
+        self.assertEqual(histogram["mean-ms"], 2.0)
+        self.assertIsNone(_parse_histogram(metrics, "etcd_disk_backend_commit_duration_seconds"))
+
+    @patch("etcd_ops.EtcdOps._client")
+    def test_etcd_snapshot(self, client) -> None:
+        """Test that etcd snapshots are streamed to a compressed file and verified."""
+        db = b"etcd-database" * 1000
+        data = db + hashlib.sha256(db).digest()
+        response = client.return_value.session.post.return_value
+        response.status_code = 200
+
+        def messages(data):
+            return [
+                json.dumps({"result": {"blob": base64.b64encode(data[i : i + 4096]).decode()}})
+                for i in range(0, len(data), 4096)
+            ]
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = Path(tmp_dir) / "snapshots" / "etcd.db.gz"
+            response.iter_lines.return_value = messages(data)
+            result = self.harness.charm._etcd.snapshot("pass", path)
+            self.assertEqual(result["sha256"], hashlib.sha256(data).hexdigest())
+            self.assertEqual(result["size"], len(data))
+            with gzip.open(path, "rb") as f:
+                self.assertEqual(f.read(), data)
+
+            response.iter_lines.return_value = messages(data[:-1] + b"x")
+            with self.assertRaises(EtcdOpsError):
+                self.harness.charm._etcd.snapshot("pass", Path(tmp_dir) / "corrupted.db.gz")
+            self.assertEqual(sorted(p.name for p in Path(tmp_dir).iterdir()), ["snapshots"])
+
+    @patch("node_watcher.scontrol_update", return_value=True)
+    def test_node_watcher_heartbeats(self, scontrol_update) -> None:
+        """Test that expired heartbeats drain nodes in batches and resume them."""
+
+        def event(node, event_type=None):
+            key = base64.b64encode(f"nodes/heartbeat/{node}".encode()).decode()
+            return {"type": event_type, "kv": {"key": key}} if event_type else {"kv": {"key": key}}
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            state_file = Path(tmp_dir) / "state.json"
+            watcher = NodeWatcher({"root_pass": "pass", "state_file": state_file.as_posix()})
+
+            watcher.handle_event(event("node-1", "DELETE"))
+            watcher.handle_event(event("node-2", "DELETE"))
+            watcher.handle_event(event("node-3"))
+            watcher.flush()
+            scontrol_update.assert_called_once_with(
+                {"node-1", "node-2"}, "drain", "etcd heartbeat expired"
+            )
+            self.assertEqual(json.loads(state_file.read_text()), ["node-1", "node-2"])
+
+            # the drained nodes survive a restart of the watcher
+            watcher = NodeWatcher({"root_pass": "pass", "state_file": state_file.as_posix()})
+            scontrol_update.reset_mock()
+            watcher.handle_event(event("node-1"))
+            watcher.flush()
+            scontrol_update.assert_called_once_with({"node-1"}, "resume")
+            self.assertEqual(json.loads(state_file.read_text()), ["node-2"])
+
+    @patch("subprocess.check_output")
+    def test_node_watcher_scontrol_update(self, check_output) -> None:
+        """Test that the scontrol arguments are passed without shell parsing."""
+        check_output.return_value = b"node-[1-2]\n"
+        self.assertTrue(scontrol_update({"node-1", "node-2"}, "drain", "it's \"broken"))
+        check_output.assert_called_with(
+            ["scontrol", "update", "nodename=node-[1-2]", "state=drain", "reason=it's \"broken"],
+            stderr=subprocess.STDOUT,
+        )
+
+        check_output.side_effect = FileNotFoundError("scontrol")
+        self.assertFalse(scontrol_update({"node-1"}, "resume"))
+
+    def test_node_watcher_watch_compacted(self) -> None:
+        """Test that a watch canceled by compaction lists the requests again."""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            state_file = Path(tmp_dir) / "state.json"
+            watcher = NodeWatcher({"root_pass": "pass", "state_file": state_file.as_posix()})
+            watcher._client = mock_client = MagicMock()
+            canceled = {"result": {"canceled": True, "compact_revision": "90"}}
+            mock_client.session.post.return_value.iter_lines.return_value = [
+                json.dumps({"result": {"created": True}}).encode(),
+                json.dumps(canceled).encode(),
+            ]
+
+            events = queue.Queue()
+            watcher._watch(events, 51)
+            self.assertEqual(list(events.queue), [WATCH_CANCELED, None])
+            revision = watcher._process(events.get(), 50)
+            self.assertEqual(revision, 0)
+
+            # the next watch lists the pending requests, then resumes after them
+            key = base64.b64encode(b"nodes/requests/node-1").decode()
+            mock_client.post.return_value = {
+                "header": {"revision": "100"},
+                "kvs": [{"key": key, "value": "", "mod_revision": "95"}],
+            }
+            mock_client.session.post.return_value.iter_lines.return_value = []
+            events = queue.Queue()
+            watcher._watch(events, revision)
+            self.assertEqual(events.get()["kv"]["key"], key)
+            create_request = mock_client.session.post.call_args.kwargs["json"]["create_request"]
+            self.assertEqual(create_request["start_revision"], 101)
+
+    @patch("node_watcher.scontrol_update", return_value=True)
+    def test_node_watcher_requests(self, scontrol_update) -> None:
+        """Test that node requests are applied in batches and acknowledged."""
+
+        def request(node, revision, **value):
+            return {
+                "kv": {
+                    "key": base64.b64encode(f"nodes/requests/{node}".encode()).decode(),
+                    "value": base64.b64encode(json.dumps(value).encode()).decode(),
+                    "mod_revision": str(revision),
+                }
+            }
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            state_file = Path(tmp_dir) / "state.json"
+            watcher = NodeWatcher(
+                {"root_pass": "pass", "state_file": state_file.as_posix(), "batch_size": 3}
+            )
+            watcher._client = mock_client = MagicMock()
+
+            watcher.handle_event(request("node-1", 10, state="resume"))
+            watcher.handle_event(request("node-2", 11, state="RESUME"))
+            watcher.handle_event(request("node-3", 12, state="drain", reason="maint"))
+            watcher.handle_event(request("node-4", 13, state="bogus"))
+            # node names that would add arguments to scontrol are ignored
+            watcher.handle_event(request("node-6 partitionname=debug", 13, state="down"))
+            # so are events that cannot be decoded, without stopping the watcher
+            watcher._process({"kv": {"key": "not base64!", "mod_revision": "13"}}, 0)
+            self.assertEqual(watcher.pending, 3)
+
+            watcher.flush()
+            self.assertCountEqual(
+                scontrol_update.call_args_list,
+                [
+                    call({"node-1", "node-2"}, "resume", ""),
+                    call({"node-3"}, "drain", "maint"),
+                ],
+            )
+            self.assertEqual(mock_client.transaction.call_count, 3)
+            revisions = [
+                c.args[0]["compare"][0]["mod_revision"]
+                for c in mock_client.transaction.call_args_list
+            ]
+            self.assertCountEqual(revisions, [10, 11, 12])
+            self.assertEqual(watcher.pending, 0)
+
+            # failed updates are retried with the next batch
+            scontrol_update.return_value = False
+            watcher.handle_event(request("node-5", 14, state="down", reason="bad"))
+            watcher.flush()
+            self.assertEqual(watcher.pending, 1)